@@ -0,0 +1,247 @@
+import argparse
+from dataclasses import dataclass
+
+import boto3  # type: ignore
+
+# Application Auto Scaling for the endpoint variant (instances) or, for scale to
+# zero, the inference component (model copies, the instances follow through
+# managed instance scaling).
+#
+# Scaling metrics:
+#   concurrency: requests being processed per instance or copy, sampled every 10 seconds.
+#                Best for LLMs, where the request duration varies with the output length.
+#   invocations: requests per minute per instance or copy.
+
+PREDEFINED_METRICS = {
+    ("concurrency", "variant"): "SageMakerVariantConcurrentRequestsPerModelHighResolution",
+    ("invocations", "variant"): "SageMakerVariantInvocationsPerInstance",
+    ("concurrency", "inference-component"): "SageMakerInferenceComponentConcurrentRequestsPerCopyHighResolution",
+    ("invocations", "inference-component"): "SageMakerInferenceComponentInvocationsPerCopy",
+}
+# (CloudWatch metric name, statistic, period in seconds) for the step scaling alarms
+CLOUDWATCH_METRICS = {
+    ("concurrency", "variant"): ("ConcurrentRequestsPerModel", "Maximum", 10),
+    ("invocations", "variant"): ("InvocationsPerInstance", "Sum", 60),
+    ("concurrency", "inference-component"): ("ConcurrentRequestsPerCopy", "Maximum", 10),
+    ("invocations", "inference-component"): ("InvocationsPerCopy", "Sum", 60),
+}
+
+
+@dataclass
+class ScalingConfig:
+    min_capacity: int
+    max_capacity: int
+    target_value: float
+    metric: str = "concurrency"
+    scale_in_cooldown: int = 300
+    scale_out_cooldown: int = 60
+    # Add capacity in steps when the metric exceeds the target by `step_threshold` times,
+    # faster than target tracking for bursts. +1 above the threshold, +2 once the metric
+    # exceeds the threshold by another half of the target.
+    step_scaling: bool = False
+    step_threshold: float = 1.5
+
+
+@dataclass
+class ScalableResource:
+    endpoint_name: str
+    variant_name: str = "default"
+    inference_component_name: str | None = None
+
+    @property
+    def kind(self) -> str:
+        return "inference-component" if self.inference_component_name else "variant"
+
+    @property
+    def resource_id(self) -> str:
+        if self.inference_component_name:
+            return f"inference-component/{self.inference_component_name}"
+        return f"endpoint/{self.endpoint_name}/variant/{self.variant_name}"
+
+    @property
+    def scalable_dimension(self) -> str:
+        if self.inference_component_name:
+            return "sagemaker:inference-component:DesiredCopyCount"
+        return "sagemaker:variant:DesiredInstanceCount"
+
+    @property
+    def dimensions(self) -> list[dict[str, str]]:
+        if self.inference_component_name:
+            return [{"Name": "InferenceComponentName", "Value": self.inference_component_name}]
+        return [{"Name": "EndpointName", "Value": self.endpoint_name}, {"Name": "VariantName", "Value": self.variant_name}]
+
+    @property
+    def policy_prefix(self) -> str:
+        return self.inference_component_name or f"{self.endpoint_name}-{self.variant_name}"
+
+
+def configure_autoscaling(autoscaling, cloudwatch, resource: ScalableResource, config: ScalingConfig) -> dict[str, str]:
+    """ Register the scalable target and put the scaling policies, returns the policy ARNs by name. """
+    if config.metric not in ("concurrency", "invocations"):
+        raise ValueError(f"Unknown scaling metric {config.metric}, expected concurrency or invocations")
+    if config.min_capacity == 0 and resource.kind != "inference-component":
+        raise ValueError("Scaling to zero requires an inference component")
+    if not 0 <= config.min_capacity <= config.max_capacity:
+        raise ValueError(f"Invalid capacity range {config.min_capacity}-{config.max_capacity}")
+
+    autoscaling.register_scalable_target(
+        ServiceNamespace="sagemaker",
+        ResourceId=resource.resource_id,
+        ScalableDimension=resource.scalable_dimension,
+        MinCapacity=config.min_capacity,
+        MaxCapacity=config.max_capacity,
+    )
+    policies = {}
+
+    name = f"{resource.policy_prefix}-{config.metric}-target-tracking"
+    response = autoscaling.put_scaling_policy(
+        PolicyName=name,
+        ServiceNamespace="sagemaker",
+        ResourceId=resource.resource_id,
+        ScalableDimension=resource.scalable_dimension,
+        PolicyType="TargetTrackingScaling",
+        TargetTrackingScalingPolicyConfiguration={
+            "TargetValue": config.target_value,
+            "PredefinedMetricSpecification": {
+                "PredefinedMetricType": PREDEFINED_METRICS[(config.metric, resource.kind)],
+            },
+            "ScaleInCooldown": config.scale_in_cooldown,
+            "ScaleOutCooldown": config.scale_out_cooldown,
+        },
+    )
+    policies[name] = response["PolicyARN"]
+
+    if config.step_scaling:
+        threshold = config.target_value * config.step_threshold
+        metric_name, statistic, period = CLOUDWATCH_METRICS[(config.metric, resource.kind)]
+        name = f"{resource.policy_prefix}-{config.metric}-step"
+        policies[name] = put_step_policy(
+            autoscaling, cloudwatch, resource, name, metric_name, statistic, period, threshold,
+            step_adjustments=[
+                # bounds are relative to the alarm threshold
+                {"MetricIntervalLowerBound": 0, "MetricIntervalUpperBound": config.target_value / 2,
+                 "ScalingAdjustment": 1},
+                {"MetricIntervalLowerBound": config.target_value / 2, "ScalingAdjustment": 2},
+            ],
+            cooldown=config.scale_out_cooldown,
+        )
+
+    if config.min_capacity == 0:
+        # target tracking doesn't scale out from zero copies, there is no metric without
+        # a copy. Requests failing for lack of capacity trigger the first copy instead.
+        name = f"{resource.policy_prefix}-scale-out-from-zero"
+        policies[name] = put_step_policy(
+            autoscaling, cloudwatch, resource, name, "NoCapacityInvocationFailures", "Maximum", 10, 1,
+            step_adjustments=[{"MetricIntervalLowerBound": 0, "ScalingAdjustment": 1}],
+            cooldown=config.scale_out_cooldown,
+            comparison="GreaterThanOrEqualToThreshold",
+        )
+    return policies
+
+
+def put_step_policy(autoscaling, cloudwatch, resource: ScalableResource, name: str, metric_name: str,
+                    statistic: str, period: int, threshold: float, step_adjustments: list[dict],
+                    cooldown: int, comparison: str = "GreaterThanThreshold") -> str:
+    response = autoscaling.put_scaling_policy(
+        PolicyName=name,
+        ServiceNamespace="sagemaker",
+        ResourceId=resource.resource_id,
+        ScalableDimension=resource.scalable_dimension,
+        PolicyType="StepScaling",
+        StepScalingPolicyConfiguration={
+            "AdjustmentType": "ChangeInCapacity",
+            "StepAdjustments": step_adjustments,
+            "Cooldown": cooldown,
+            "MetricAggregationType": "Maximum",
+        },
+    )
+    cloudwatch.put_metric_alarm(
+        AlarmName=name,
+        Namespace="AWS/SageMaker",
+        MetricName=metric_name,
+        Dimensions=resource.dimensions,
+        Statistic=statistic,
+        Period=period,
+        EvaluationPeriods=1,
+        Threshold=threshold,
+        ComparisonOperator=comparison,
+        TreatMissingData="notBreaching",
+        AlarmActions=[response["PolicyARN"]],
+    )
+    return response["PolicyARN"]
+
+
+def remove_autoscaling(autoscaling, cloudwatch, resource: ScalableResource):
+    """ Delete the policies, their alarms and the scalable target, before deleting the endpoint. """
+    policies = autoscaling.describe_scaling_policies(
+        ServiceNamespace="sagemaker", ResourceId=resource.resource_id,
+        ScalableDimension=resource.scalable_dimension)["ScalingPolicies"]
+    alarms = [alarm["AlarmName"] for policy in policies for alarm in policy.get("Alarms", [])]
+    for policy in policies:
+        autoscaling.delete_scaling_policy(
+            PolicyName=policy["PolicyName"], ServiceNamespace="sagemaker",
+            ResourceId=resource.resource_id, ScalableDimension=resource.scalable_dimension)
+    # the target tracking alarms are removed with their policy, the step scaling ones are ours
+    step_alarms = [name for name in alarms if not name.startswith("TargetTracking-")]
+    if step_alarms:
+        cloudwatch.delete_alarms(AlarmNames=step_alarms)
+    autoscaling.deregister_scalable_target(
+        ServiceNamespace="sagemaker", ResourceId=resource.resource_id, ScalableDimension=resource.scalable_dimension)
+
+
+def add_scaling_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument('--min-instances', type=int, default=1, help='Lower bound of the autoscaling')
+    parser.add_argument('--max-instances', type=int, default=None,
+                        help='Upper bound of the autoscaling, autoscaling is disabled without it')
+    parser.add_argument('--scaling-metric', choices=['concurrency', 'invocations'], default='concurrency',
+                        help='Concurrent requests per instance, or invocations per instance and minute')
+    parser.add_argument('--target-value', type=float, default=None,
+                        help='Target of the scaling metric, see capacity_calculator.py')
+    parser.add_argument('--scale-in-cooldown', type=int, default=300, help='Seconds between two scale-ins')
+    parser.add_argument('--scale-out-cooldown', type=int, default=60, help='Seconds between two scale-outs')
+    parser.add_argument('--step-scaling', action='store_true',
+                        help='Also add instances in steps when the metric exceeds the target by half')
+    parser.add_argument('--scale-to-zero', action='store_true',
+                        help='Deploy the model as an inference component which scales down to zero copies')
+
+
+def scaling_config_from_args(args: argparse.Namespace) -> ScalingConfig | None:
+    if args.max_instances is None:
+        if args.scale_to_zero:
+            raise SystemExit("--max-instances is required with --scale-to-zero")
+        return None
+    if args.target_value is None:
+        raise SystemExit("--target-value is required with --max-instances")
+    return ScalingConfig(
+        min_capacity=0 if args.scale_to_zero else args.min_instances,
+        max_capacity=args.max_instances,
+        target_value=args.target_value,
+        metric=args.scaling_metric,
+        scale_in_cooldown=args.scale_in_cooldown,
+        scale_out_cooldown=args.scale_out_cooldown,
+        step_scaling=args.step_scaling,
+    )
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Configure the autoscaling of an existing SageMaker endpoint.')
+    parser.add_argument('--region', default='us-east-1', help='The region of the endpoint')
+    parser.add_argument('--endpoint-name', required=True, help='The name of the endpoint')
+    parser.add_argument('--variant-name', default='default', help='The production variant to scale')
+    parser.add_argument('--inference-component-name', default=None, help='Scale this inference component instead')
+    parser.add_argument('--remove', action='store_true', help='Remove the autoscaling instead')
+    add_scaling_arguments(parser)
+    args = parser.parse_args()
+
+    resource = ScalableResource(args.endpoint_name, args.variant_name, args.inference_component_name)
+    autoscaling = boto3.client('application-autoscaling', region_name=args.region)
+    cloudwatch = boto3.client('cloudwatch', region_name=args.region)
+    if args.remove:
+        remove_autoscaling(autoscaling, cloudwatch, resource)
+        print(f"Removed the autoscaling of {resource.resource_id}")
+    else:
+        config = scaling_config_from_args(args)
+        if config is None:
+            raise SystemExit("--max-instances is required")
+        for name, arn in configure_autoscaling(autoscaling, cloudwatch, resource, config).items():
+            print(f"Scaling policy {name}: {arn}")
@@ -0,0 +1,348 @@
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+from dataclasses import dataclass, field
+from typing import Any, Iterator
+
+import httpx
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+from compression import ENCODINGS, compress  # noqa: E402
+from invocation_policy import is_retryable, retry_delay  # noqa: E402
+from json_codec import dumps, loads  # noqa: E402
+from sigv4_client import COMPRESSION_MIN_BYTES, AsyncSageMakerRuntimeClient  # noqa: E402
+
+
+@dataclass
+class BatchItem:
+    line: int
+    id: Any
+    # None for blank lines and for lines which are not valid requests, see `error`
+    payload: dict | None
+    error: str | None = None
+
+
+def parse_line(line_number: int, line: str, id_field: str | None = None, prompt_field: str | None = None,
+               model: str | None = None) -> BatchItem:
+    """
+    Lines are OpenAI-format payloads, OpenAI batch requests ({"custom_id": ..., "body": {...}}),
+    or records with the prompt in `prompt_field`. The id is taken from `id_field`, the
+    `custom_id` of batch requests, or is the line number.
+    """
+    record = loads(line)
+    if isinstance(record.get("body"), dict):
+        payload, item_id = record["body"], record.get("custom_id", line_number)
+    elif prompt_field is not None:
+        payload, item_id = {"messages": [{"role": "user", "content": record[prompt_field]}]}, line_number
+    else:
+        payload, item_id = record, line_number
+    if id_field is not None and id_field in record:
+        item_id = record[id_field]
+    # the results are collected whole, streaming would only add framing
+    payload = {key: value for key, value in payload.items() if key not in ("stream", "stream_options")}
+    if model and "model" not in payload:
+        payload["model"] = model
+    return BatchItem(line_number, item_id, payload)
+
+
+class TokenBucket:
+    """ Allows `rate` requests per second on average and bursts of up to `burst` requests. """
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+@dataclass
+class Checkpoint:
+    """
+    Progress of a run: every line before `watermark` is done, and so are the
+    lines in `done` after it. Results are written as they complete, out of
+    order, `output_bytes` is the size of the output file when the checkpoint was
+    taken, anything after it is discarded when resuming.
+    """
+    path: str
+    input_path: str = ""
+    watermark: int = 0
+    done: set[int] = field(default_factory=set)
+    output_bytes: int = 0
+
+    @classmethod
+    def load(cls, path: str) -> "Checkpoint":
+        with open(path) as f:
+            data = json.load(f)
+        return cls(path, data["input_path"], data["watermark"], set(data["done"]), data["output_bytes"])
+
+    def is_done(self, line: int) -> bool:
+        return line < self.watermark or line in self.done
+
+    def mark_done(self, line: int):
+        self.done.add(line)
+        while self.watermark in self.done:
+            self.done.remove(self.watermark)
+            self.watermark += 1
+
+    def save(self):
+        temporary = self.path + ".tmp"
+        with open(temporary, "w") as f:
+            json.dump({"input_path": self.input_path, "watermark": self.watermark, "done": sorted(self.done),
+                       "output_bytes": self.output_bytes}, f)
+        # atomic, an interrupted run leaves either the old or the new checkpoint
+        os.replace(temporary, self.path)
+
+
+@dataclass
+class Stats:
+    started: float = field(default_factory=time.perf_counter)
+    succeeded: int = 0
+    failed: int = 0
+    skipped: int = 0
+    retries: int = 0
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+
+    def summary(self) -> dict:
+        elapsed = time.perf_counter() - self.started
+        completed = self.succeeded + self.failed
+        return {
+            "succeeded": self.succeeded,
+            "failed": self.failed,
+            "skipped": self.skipped,
+            "retries": self.retries,
+            "elapsed_s": round(elapsed, 2),
+            "requests_per_s": round(completed / elapsed, 2) if elapsed else None,
+            "prompt_tokens": self.prompt_tokens,
+            "completion_tokens": self.completion_tokens,
+            "completion_tokens_per_s": round(self.completion_tokens / elapsed, 1) if elapsed else None,
+        }
+
+
+class SageMakerTarget:
+    def __init__(self, endpoint_name: str, region: str, pool_size: int, inference_component: str | None = None,
+                 compression: str | None = None):
+        self.endpoint_name = endpoint_name
+        self.client = AsyncSageMakerRuntimeClient(region=region, pool_size=pool_size, compression=compression)
+        self.headers = {"X-Amzn-SageMaker-Inference-Component": inference_component} if inference_component else None
+
+    async def invoke(self, body: bytes) -> httpx.Response:
+        return await self.client.invoke(self.endpoint_name, body, headers=self.headers)
+
+    async def aclose(self):
+        await self.client.aclose()
+
+
+class URLTarget:
+    """ A local server, e.g. src/example_serving.py. """
+
+    def __init__(self, url: str, pool_size: int, timeout: float = 600, compression: str | None = None):
+        self.url = url
+        self.compression = compression
+        # httpx asks for gzip responses and decodes them by itself
+        self.client = httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size), timeout=timeout)
+
+    async def invoke(self, body: bytes) -> httpx.Response:
+        headers = {"Content-Type": "application/json"}
+        if self.compression is not None and len(body) >= COMPRESSION_MIN_BYTES:
+            body = compress(body, self.compression)
+            headers["Content-Encoding"] = self.compression
+        response = await self.client.post(self.url, content=body, headers=headers)
+        response.raise_for_status()
+        return response
+
+    async def aclose(self):
+        await self.client.aclose()
+
+
+class BatchRunner:
+    def __init__(self, target, output_path: str, checkpoint: Checkpoint, concurrency: int = 32,
+                 rate: float | None = None, burst: int | None = None, max_attempts: int = 8,
+                 backoff_base: float = 0.5, backoff_cap: float = 30.0, checkpoint_interval: float = 5.0):
+        self.target = target
+        self.output_path = output_path
+        self.checkpoint = checkpoint
+        self.concurrency = concurrency
+        self.bucket = TokenBucket(rate, burst or max(1, int(rate))) if rate else None
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+        self.checkpoint_interval = checkpoint_interval
+        self.stats = Stats()
+        self._last_checkpoint = time.monotonic()
+        self._output = None
+
+    async def run(self, items: Iterator[BatchItem], progress_interval: float = 10.0) -> dict:
+        # drop the results written after the last checkpoint, they are redone
+        mode = "r+b" if os.path.exists(self.output_path) else "wb"
+        self._output = open(self.output_path, mode)
+        self._output.truncate(self.checkpoint.output_bytes)
+        self._output.seek(self.checkpoint.output_bytes)
+
+        queue: asyncio.Queue[BatchItem | None] = asyncio.Queue(maxsize=self.concurrency * 2)
+        workers = [asyncio.create_task(self._worker(queue)) for _ in range(self.concurrency)]
+        progress = asyncio.create_task(self._report_progress(progress_interval))
+        try:
+            for item in items:
+                if self.checkpoint.is_done(item.line):
+                    self.stats.skipped += 1
+                    continue
+                if item.error is not None:
+                    self._write(item, {"status": None, "response": None, "error": item.error, "attempts": 0,
+                                       "latency_s": 0.0})
+                elif item.payload is None:
+                    # blank lines are done right away, or the watermark would stop at them
+                    self.checkpoint.mark_done(item.line)
+                else:
+                    await queue.put(item)
+            for _ in workers:
+                await queue.put(None)
+            await asyncio.gather(*workers)
+        finally:
+            progress.cancel()
+            for worker in workers:
+                worker.cancel()
+            self._save_checkpoint()
+            self._output.close()
+        return self.stats.summary()
+
+    async def _worker(self, queue: asyncio.Queue):
+        while (item := await queue.get()) is not None:
+            self._write(item, await self._invoke(item))
+
+    async def _invoke(self, item: BatchItem) -> dict:
+        body = dumps(item.payload)
+        started = time.perf_counter()
+        for attempt in range(self.max_attempts):
+            if self.bucket is not None:
+                await self.bucket.acquire()
+            try:
+                response = await self.target.invoke(body)
+            except httpx.HTTPError as e:
+                # recorded as a failed line, also e.g. DecodingError or TooManyRedirects, and the run goes on
+                if is_retryable(e) and attempt + 1 < self.max_attempts:
+                    self.stats.retries += 1
+                    await asyncio.sleep(retry_delay(attempt, self.backoff_base, self.backoff_cap, e))
+                    continue
+                status = e.response.status_code if isinstance(e, httpx.HTTPStatusError) else None
+                detail = e.response.text[:1000] if isinstance(e, httpx.HTTPStatusError) else repr(e)
+                return {"status": status, "response": None, "error": detail, "attempts": attempt + 1,
+                        "latency_s": round(time.perf_counter() - started, 3)}
+            try:
+                result = response.json()
+            except ValueError:
+                result = response.text
+            return {"status": response.status_code, "response": result, "error": None, "attempts": attempt + 1,
+                    "latency_s": round(time.perf_counter() - started, 3)}
+
+    def _write(self, item: BatchItem, result: dict):
+        if result["error"] is None:
+            self.stats.succeeded += 1
+            usage = result["response"].get("usage") if isinstance(result["response"], dict) else None
+            if usage:
+                self.stats.prompt_tokens += usage.get("prompt_tokens") or 0
+                self.stats.completion_tokens += usage.get("completion_tokens") or 0
+        else:
+            self.stats.failed += 1
+        record = {"id": item.id, "line": item.line, **result}
+        self._output.write(dumps(record) + b"\n")
+        self.checkpoint.mark_done(item.line)
+        if time.monotonic() - self._last_checkpoint >= self.checkpoint_interval:
+            self._save_checkpoint()
+
+    def _save_checkpoint(self):
+        self._output.flush()
+        os.fsync(self._output.fileno())
+        self.checkpoint.output_bytes = self._output.tell()
+        self.checkpoint.save()
+        self._last_checkpoint = time.monotonic()
+
+    async def _report_progress(self, interval: float):
+        while True:
+            await asyncio.sleep(interval)
+            print(f"[batch] {json.dumps(self.stats.summary())}", file=sys.stderr, flush=True)
+
+
+def read_items(path: str, **parse_args) -> Iterator[BatchItem]:
+    """ Stream the input file, it's never loaded whole. Invalid lines become items with an error. """
+    with open(path) as f:
+        for line_number, line in enumerate(f):
+            if not line.strip():
+                yield BatchItem(line_number, line_number, None)
+                continue
+            try:
+                yield parse_line(line_number, line, **parse_args)
+            except (ValueError, KeyError, TypeError, AttributeError) as e:
+                # json.JSONDecodeError is a ValueError, records which are not objects raise AttributeError
+                yield BatchItem(line_number, line_number, None, error=f"Invalid input line: {e!r}")
+
+
+async def main(args) -> dict:
+    checkpoint_path = args.checkpoint or args.output + ".checkpoint"
+    if os.path.exists(checkpoint_path) and not args.restart:
+        checkpoint = Checkpoint.load(checkpoint_path)
+        if checkpoint.input_path != os.path.abspath(args.input):
+            sys.exit(f"{checkpoint_path} belongs to {checkpoint.input_path}, pass --restart to start over")
+        print(f"Resuming after line {checkpoint.watermark} ({len(checkpoint.done)} more lines done)", file=sys.stderr)
+    else:
+        checkpoint = Checkpoint(checkpoint_path, os.path.abspath(args.input))
+
+    if args.endpoint_name:
+        target = SageMakerTarget(args.endpoint_name, args.region, args.concurrency, args.inference_component,
+                                 args.compression)
+    else:
+        target = URLTarget(args.url, args.concurrency, compression=args.compression)
+    runner = BatchRunner(target, args.output, checkpoint, concurrency=args.concurrency, rate=args.rate,
+                         burst=args.burst, max_attempts=args.max_attempts)
+    items = read_items(args.input, id_field=args.id_field, prompt_field=args.prompt_field, model=args.model)
+    try:
+        return await runner.run(items)
+    finally:
+        await target.aclose()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Run a JSONL file of requests through an endpoint, resumable.')
+    parser.add_argument('input', help='JSONL file of OpenAI-format payloads or OpenAI batch requests')
+    parser.add_argument('--output', required=True, help='JSONL results, one line per input line, in completion order')
+    target_group = parser.add_mutually_exclusive_group(required=True)
+    target_group.add_argument('--endpoint-name', type=str, help='The SageMaker endpoint')
+    target_group.add_argument('--url', type=str, help='Local URL, e.g. http://localhost:8000/invocations')
+    parser.add_argument('--region', type=str, default='us-east-1', help='The region of the SageMaker endpoint')
+    parser.add_argument('--inference-component', type=str, default=None,
+                        help='The inference component of endpoints created with --scale-to-zero')
+    parser.add_argument('--model', type=str, default=None, help='Set as "model" in payloads without one')
+    parser.add_argument('--id-field', type=str, default=None, help='Field of the input lines to use as id')
+    parser.add_argument('--prompt-field', type=str, default=None,
+                        help='Field of the input lines to send as a user message, for lines which are not payloads')
+    parser.add_argument('--compression', choices=ENCODINGS, default=None,
+                        help='Send the request bodies compressed and receive compressed responses')
+    parser.add_argument('--concurrency', type=int, default=32, help='Requests in flight')
+    parser.add_argument('--rate', type=float, default=None, help='Max requests per second')
+    parser.add_argument('--burst', type=int, default=None, help='Requests allowed at once above the rate')
+    parser.add_argument('--max-attempts', type=int, default=8, help='Attempts per request on throttling and 5XX')
+    parser.add_argument('--checkpoint', type=str, default=None, help='Defaults to <output>.checkpoint')
+    parser.add_argument('--restart', action='store_true', help='Ignore the checkpoint and start over')
+    args = parser.parse_args()
+
+    try:
+        summary = asyncio.run(main(args))
+    except KeyboardInterrupt:
+        sys.exit("Interrupted, run again to resume from the checkpoint")
+    print(json.dumps(summary, indent=2))
@@ -0,0 +1,240 @@
+import argparse
+import json
+import os
+import random
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+from dataclasses import dataclass, field
+from typing import Any
+
+import boto3  # type: ignore
+import requests
+from botocore.config import Config  # type: ignore
+
+from test_endpoint import process_response
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+from json_codec import dumps  # noqa: E402
+
+
+@dataclass
+class RequestResult:
+    start: float
+    end: float = 0.0
+    # arrival time of every chunk which carried generated content
+    token_times: list[float] = field(default_factory=list)
+    output_tokens: int = 0
+    error: str | None = None
+
+    @property
+    def ttft(self) -> float | None:
+        if not self.token_times:
+            return None
+        return self.token_times[0] - self.start
+
+    @property
+    def itl(self) -> list[float]:
+        return [b - a for a, b in zip(self.token_times, self.token_times[1:])]
+
+    @property
+    def latency(self) -> float:
+        return self.end - self.start
+
+
+def percentile(values: list[float], q: float) -> float | None:
+    """ Linear-interpolated percentile, `q` in [0, 100]. """
+    if not values:
+        return None
+    values = sorted(values)
+    pos = (len(values) - 1) * q / 100
+    lo = int(pos)
+    hi = min(lo + 1, len(values) - 1)
+    return values[lo] + (values[hi] - values[lo]) * (pos - lo)
+
+
+def summarize(values: list[float]) -> dict[str, float | None]:
+    return {f"p{q}": percentile(values, q) for q in (50, 90, 95, 99)}
+
+
+class SageMakerTarget:
+    def __init__(self, endpoint_name: str, region: str, inference_component: str | None = None):
+        self.endpoint_name = endpoint_name
+        self.extra_args = {"InferenceComponentName": inference_component} if inference_component else {}
+        # boto3 clients are thread safe, the connection pool is sized for the workers
+        config = Config(max_pool_connections=256)
+        self.client = boto3.client("runtime.sagemaker", region_name=region, config=config)
+
+    def invoke(self, body: bytes, stream: bool):
+        if stream:
+            response = self.client.invoke_endpoint_with_response_stream(
+                EndpointName=self.endpoint_name,
+                Body=body,
+                ContentType="application/json",
+                **self.extra_args,
+            )
+        else:
+            response = self.client.invoke_endpoint(
+                EndpointName=self.endpoint_name,
+                Body=body,
+                ContentType="application/json",
+                **self.extra_args,
+            )
+        return response['Body']
+
+
+class URLTarget:
+    """ Any server exposing the `/invocations` API, e.g. `src/example_serving.py`. """
+
+    def __init__(self, url: str, pool_size: int = 256):
+        self.url = url
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def invoke(self, body: bytes, stream: bool):
+        response = self.session.post(
+            self.url, data=body, headers={"Content-Type": "application/json"}, stream=True, timeout=600)
+        response.raise_for_status()
+        return response.iter_content(chunk_size=None)
+
+
+def run_request(target, payload: dict[str, Any], stream: bool, start: float | None = None) -> RequestResult:
+    payload = {**payload, "stream": stream}
+    if stream:
+        # ask vLLM for the token counts in the last chunk
+        payload["stream_options"] = {"include_usage": True}
+    body = dumps(payload)
+    # in open-loop mode the latency is measured from the arrival time, including client-side queueing
+    result = RequestResult(start=start if start is not None else time.perf_counter())
+    usage_tokens = None
+
+    def on_data(data: dict[str, Any]):
+        nonlocal usage_tokens
+        now = time.perf_counter()
+        if data.get("usage"):
+            usage_tokens = data["usage"].get("completion_tokens")
+        for choice in data.get("choices", []):
+            content = (choice.get("delta") or choice.get("message") or {}).get("content")
+            if content:
+                result.token_times.append(now)
+
+    try:
+        process_response(target.invoke(body, stream), on_data=on_data, verbose=False)
+    except Exception as e:
+        result.error = repr(e)
+    result.end = time.perf_counter()
+    # vLLM sends one delta per generated token, use it when usage is not reported
+    result.output_tokens = usage_tokens if usage_tokens is not None else len(result.token_times)
+    return result
+
+
+def run_closed_loop(target, payload, num_requests: int, concurrency: int, stream: bool) -> list[RequestResult]:
+    """ `concurrency` workers each sending the next request as soon as the previous one finished. """
+    results: list[RequestResult] = []
+    counter = iter(range(num_requests))
+    lock = threading.Lock()
+
+    def worker():
+        while True:
+            with lock:
+                if next(counter, None) is None:
+                    return
+            result = run_request(target, payload, stream)
+            with lock:
+                results.append(result)
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for _ in range(concurrency):
+            pool.submit(worker)
+    return results
+
+
+def run_open_loop(target, payload, num_requests: int, rate: float, stream: bool,
+                  max_concurrency: int, seed: int | None = None) -> list[RequestResult]:
+    """ Requests arrive as a Poisson process with `rate` requests per second, regardless of the responses. """
+    rng = random.Random(seed)
+    with ThreadPoolExecutor(max_workers=max_concurrency) as pool:
+        futures = []
+        next_arrival = time.perf_counter()
+        for _ in range(num_requests):
+            delay = next_arrival - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            futures.append(pool.submit(run_request, target, payload, stream, time.perf_counter()))
+            next_arrival += rng.expovariate(rate)
+        wait(futures)
+    return [f.result() for f in futures]
+
+
+def build_report(results: list[RequestResult], wall_time: float) -> dict[str, Any]:
+    ok = [r for r in results if r.error is None]
+    output_tokens = sum(r.output_tokens for r in ok)
+    return {
+        "requests": len(results),
+        "errors": len(results) - len(ok),
+        "wall_time_s": wall_time,
+        "requests_per_s": len(ok) / wall_time if wall_time else None,
+        "output_tokens": output_tokens,
+        "output_tokens_per_s": output_tokens / wall_time if wall_time else None,
+        "ttft_s": summarize([r.ttft for r in ok if r.ttft is not None]),
+        "itl_s": summarize([d for r in ok for d in r.itl]),
+        "latency_s": summarize([r.latency for r in ok]),
+        "error_samples": [r.error for r in results if r.error][:5],
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Load-test the /invocations API of a SageMaker endpoint or a local server.')
+    target_group = parser.add_mutually_exclusive_group(required=True)
+    target_group.add_argument('--endpoint-name', type=str, help='The SageMaker endpoint')
+    target_group.add_argument('--url', type=str, help='Local URL, e.g. http://localhost:8000/invocations')
+    parser.add_argument('--region', type=str, default='us-east-1', help='The region of the SageMaker endpoint')
+    parser.add_argument('--inference-component', type=str, default=None,
+                        help='The inference component of endpoints created with --scale-to-zero')
+    parser.add_argument('--model', type=str, required=True, help='The model name')
+    parser.add_argument('--prompt', type=str, default='Write a short story about a lighthouse keeper.')
+    parser.add_argument('--max-tokens', type=int, default=256)
+    parser.add_argument('--num-requests', type=int, default=100)
+    parser.add_argument('--concurrency', type=int, default=8, help='Workers in closed-loop mode, max in-flight requests in open-loop mode')
+    parser.add_argument('--rate', type=float, default=None, help='Poisson arrival rate (req/s), enables open-loop mode')
+    parser.add_argument('--mode', choices=['stream', 'non-stream', 'both'], default='both')
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--output', type=str, default=None, help='Write the JSON report to this file')
+    args = parser.parse_args()
+
+    if args.endpoint_name:
+        target = SageMakerTarget(args.endpoint_name, args.region, args.inference_component)
+    else:
+        target = URLTarget(args.url, pool_size=args.concurrency)
+
+    payload = {
+        "model": args.model,
+        "messages": [{"role": "user", "content": args.prompt}],
+        "max_tokens": args.max_tokens,
+    }
+
+    report: dict[str, Any] = {
+        "target": args.endpoint_name or args.url,
+        "loop": "open" if args.rate else "closed",
+        "concurrency": args.concurrency,
+        "rate": args.rate,
+    }
+    modes = {'stream': [True], 'non-stream': [False], 'both': [False, True]}[args.mode]
+    for stream in modes:
+        started = time.perf_counter()
+        if args.rate:
+            results = run_open_loop(target, payload, args.num_requests, args.rate, stream,
+                                    max_concurrency=args.concurrency, seed=args.seed)
+        else:
+            results = run_closed_loop(target, payload, args.num_requests, args.concurrency, stream)
+        report["stream" if stream else "non_stream"] = build_report(results, time.perf_counter() - started)
+
+    report_json = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(report_json)
+    print(report_json)
+    sys.stdout.flush()
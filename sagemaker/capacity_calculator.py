@@ -0,0 +1,135 @@
+import argparse
+import json
+import math
+import sys
+from dataclasses import asdict, dataclass
+
+
+@dataclass
+class LoadPoint:
+    """ One closed-loop benchmark run against a single instance. """
+    concurrency: float
+    requests_per_s: float
+    p95_s: float
+    error_rate: float
+
+
+@dataclass
+class Recommendation:
+    # the highest load one instance sustains within the latency target
+    max_concurrency: float
+    max_requests_per_s: float
+    # scaling targets, with headroom for the time new instances take to start
+    concurrency_target: float
+    invocations_per_minute_target: float
+    min_instances: int | None = None
+    max_instances: int | None = None
+
+
+def load_points(reports: list[dict], mode: str = "stream", latency_metric: str = "latency_s") -> list[LoadPoint]:
+    """ Read the JSON reports of benchmark_endpoint.py, each run at a different --concurrency. """
+    points = []
+    for report in reports:
+        if report.get("loop") != "closed":
+            raise ValueError("Only closed-loop reports (without --rate) have a fixed concurrency")
+        results = report.get(mode)
+        if results is None:
+            raise ValueError(f"The report at concurrency {report.get('concurrency')} has no {mode} results")
+        p95 = results[latency_metric]["p95"]
+        if p95 is None:
+            raise ValueError(f"The report at concurrency {report['concurrency']} has no {latency_metric} p95")
+        points.append(LoadPoint(
+            concurrency=report["concurrency"],
+            requests_per_s=results["requests_per_s"] or 0.0,
+            p95_s=p95,
+            error_rate=results["errors"] / results["requests"] if results["requests"] else 1.0,
+        ))
+    return sorted(points, key=lambda point: point.concurrency)
+
+
+def max_sustainable(points: list[LoadPoint], target_p95: float, max_error_rate: float = 0.01) -> LoadPoint:
+    """
+    The highest load within the p95 target. Between the last run within the
+    target and the first one above it, the concurrency and the throughput are
+    interpolated linearly on the p95.
+    """
+    def within(point: LoadPoint) -> bool:
+        return point.p95_s <= target_p95 and point.error_rate <= max_error_rate
+
+    best_index = None
+    for i, point in enumerate(points):
+        if not within(point):
+            break
+        best_index = i
+    if best_index is None:
+        raise ValueError(f"Even the lowest concurrency misses the p95 target of {target_p95} s")
+
+    best = points[best_index]
+    if best_index + 1 < len(points):
+        above = points[best_index + 1]
+        if above.error_rate <= max_error_rate and above.p95_s > best.p95_s:
+            fraction = (target_p95 - best.p95_s) / (above.p95_s - best.p95_s)
+            return LoadPoint(
+                concurrency=best.concurrency + fraction * (above.concurrency - best.concurrency),
+                requests_per_s=best.requests_per_s + fraction * (above.requests_per_s - best.requests_per_s),
+                p95_s=target_p95,
+                error_rate=best.error_rate,
+            )
+    return best
+
+
+def recommend(points: list[LoadPoint], target_p95: float, headroom: float = 0.8, peak_rps: float | None = None,
+              baseline_rps: float | None = None, max_error_rate: float = 0.01) -> Recommendation:
+    best = max_sustainable(points, target_p95, max_error_rate)
+    sustainable_rps = best.requests_per_s * headroom
+    recommendation = Recommendation(
+        max_concurrency=round(best.concurrency, 2),
+        max_requests_per_s=round(best.requests_per_s, 3),
+        concurrency_target=round(max(1.0, best.concurrency * headroom), 1),
+        invocations_per_minute_target=round(sustainable_rps * 60, 1),
+    )
+    if peak_rps is not None:
+        recommendation.max_instances = max(1, math.ceil(peak_rps / sustainable_rps))
+    if baseline_rps is not None:
+        # no traffic at all is the case for scaling to zero
+        recommendation.min_instances = 0 if baseline_rps == 0 else max(1, math.ceil(baseline_rps / sustainable_rps))
+    return recommendation
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Turn benchmark_endpoint.py reports of one instance into autoscaling targets.')
+    parser.add_argument('reports', nargs='+', help='JSON reports of closed-loop runs at increasing --concurrency')
+    parser.add_argument('--target-p95', type=float, required=True, help='Latency target in seconds')
+    parser.add_argument('--mode', choices=['stream', 'non_stream'], default='stream')
+    parser.add_argument('--latency-metric', choices=['latency_s', 'ttft_s'], default='latency_s',
+                        help='End-to-end latency or time to first token')
+    parser.add_argument('--headroom', type=float, default=0.8,
+                        help='Share of the sustainable load to target, the rest absorbs bursts while scaling out')
+    parser.add_argument('--peak-rps', type=float, default=None, help='Expected peak traffic, for --max-instances')
+    parser.add_argument('--baseline-rps', type=float, default=None, help='Expected lowest traffic, for --min-instances')
+    parser.add_argument('--max-error-rate', type=float, default=0.01)
+    args = parser.parse_args()
+
+    reports = []
+    for path in args.reports:
+        with open(path) as f:
+            reports.append(json.load(f))
+    try:
+        points = load_points(reports, args.mode, args.latency_metric)
+        recommendation = recommend(points, args.target_p95, args.headroom, args.peak_rps, args.baseline_rps,
+                                   args.max_error_rate)
+    except ValueError as e:
+        sys.exit(str(e))
+
+    print(json.dumps(asdict(recommendation), indent=2))
+    flags = [f"--scaling-metric concurrency --target-value {recommendation.concurrency_target:g}"]
+    if recommendation.max_instances is not None:
+        flags.append(f"--max-instances {recommendation.max_instances}")
+    if recommendation.min_instances == 0:
+        flags.append("--scale-to-zero")
+    elif recommendation.min_instances is not None:
+        flags.append(f"--min-instances {recommendation.min_instances}")
+    print(f"create_sagemaker_endpoint.py flags: {' '.join(flags)}")
+    print(f"or, scaling on invocations: --scaling-metric invocations "
+          f"--target-value {recommendation.invocations_per_minute_target:g}")
@@ -1,25 +1,48 @@
 import argparse
 import os
+import sys
+import time
 
 import boto3  # type: ignore
 
+from autoscaling import (ScalableResource, ScalingConfig, add_scaling_arguments, configure_autoscaling,
+                         scaling_config_from_args)
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+from engine_config import get_instance_spec  # noqa: E402
+
 
 def get_env_for_sagemaker(verbose: bool = True):    
     """
-    Collect all environment variables prefixed with 'SM_VLLM_' and return as a new dict.
+    Collect all environment variables prefixed with 'SM_VLLM_' (vLLM arguments),
+    'SM_PROXY_' (the /invocations proxy settings), 'SM_PREFETCH_' (the model
+    download) or 'SM_ENGINE_' (the engine configuration) and return as a new dict.
     This is used to pass environment variables to the SageMaker container.
     """
     env = {}
     for key, value in os.environ.items():
-        if key.startswith('SM_VLLM'):
+        if key.startswith(('SM_VLLM', 'SM_PROXY', 'SM_PREFETCH', 'SM_ENGINE')):
             env[key] = value
     if verbose:
         variables = "\n".join([f"{key}: {value}" for key, value in env.items()])
-        print(f"Environment variables passed to vLLM: {variables}")
+        print(f"Environment variables passed to the container: {variables}")
     return env
 
 
-def create_sagemaker_endpoint(region, instance_type, role_arn, image_uri, endpoint_name):
+def wait_for_inference_component(sagemaker, name: str, delay: int = 30):
+    while True:
+        response = sagemaker.describe_inference_component(InferenceComponentName=name)
+        status = response['InferenceComponentStatus']
+        print(f"Inference component status: {status}")
+        if status == 'InService':
+            return
+        if status == 'Failed':
+            raise RuntimeError(f"Inference component {name} failed: {response.get('FailureReason')}")
+        time.sleep(delay)
+
+
+def create_sagemaker_endpoint(region, instance_type, role_arn, image_uri, endpoint_name,
+                              initial_instance_count: int = 1, scaling: ScalingConfig | None = None):
     sagemaker = boto3.client('sagemaker', region_name=region)
 
     env = get_env_for_sagemaker()
@@ -40,17 +63,31 @@ def create_sagemaker_endpoint(region, instance_type, role_arn, image_uri, endpoi
         ExecutionRoleArn=role_arn,
     )
 
-    create_endpoint_config_response = sagemaker.create_endpoint_config(
-        EndpointConfigName=endpoint_name + '-config',
-        ProductionVariants=[
-            {
-                'VariantName': 'default',
-                'ModelName': endpoint_name + '-model',
-                'InstanceType': instance_type,
-                'InitialInstanceCount': 1,
-            },
-        ],
-    )
+    # Only inference components can scale to zero: the endpoint keeps no instance
+    # for the model, and managed instance scaling adds instances as copies are added.
+    scale_to_zero = scaling is not None and scaling.min_capacity == 0
+    variant = {
+        'VariantName': 'default',
+        'InstanceType': instance_type,
+        'InitialInstanceCount': initial_instance_count,
+    }
+    if scale_to_zero:
+        variant['ManagedInstanceScaling'] = {
+            'Status': 'ENABLED',
+            'MinInstanceCount': 0,
+            'MaxInstanceCount': scaling.max_capacity,
+        }
+        variant['RoutingConfig'] = {'RoutingStrategy': 'LEAST_OUTSTANDING_REQUESTS'}
+        create_endpoint_config_response = sagemaker.create_endpoint_config(
+            EndpointConfigName=endpoint_name + '-config',
+            ExecutionRoleArn=role_arn,
+            ProductionVariants=[variant],
+        )
+    else:
+        create_endpoint_config_response = sagemaker.create_endpoint_config(
+            EndpointConfigName=endpoint_name + '-config',
+            ProductionVariants=[{**variant, 'ModelName': endpoint_name + '-model'}],
+        )
 
     create_endpoint_response = sagemaker.create_endpoint(
         EndpointName=endpoint_name,
@@ -58,6 +95,40 @@ def create_sagemaker_endpoint(region, instance_type, role_arn, image_uri, endpoi
     )
 
     print(f"Endpoint {endpoint_name} created. Check on the sagemaker console.")
+    if scaling is None:
+        return
+
+    # the variant must be in service before it can be registered for autoscaling
+    print("Waiting for the endpoint to be in service to configure the autoscaling...")
+    sagemaker.get_waiter('endpoint_in_service').wait(
+        EndpointName=endpoint_name, WaiterConfig={'Delay': 30, 'MaxAttempts': 120})
+
+    resource = ScalableResource(endpoint_name, 'default')
+    if scale_to_zero:
+        resource.inference_component_name = endpoint_name + '-ic'
+        sagemaker.create_inference_component(
+            InferenceComponentName=resource.inference_component_name,
+            EndpointName=endpoint_name,
+            VariantName='default',
+            Specification={
+                'ModelName': endpoint_name + '-model',
+                'ComputeResourceRequirements': {
+                    # one copy takes all the GPUs of an instance, like the plain endpoint
+                    'NumberOfAcceleratorDevicesRequired': get_instance_spec(instance_type).num_gpus,
+                    'MinMemoryRequiredInMb': 1024,
+                },
+            },
+            RuntimeConfig={'CopyCount': initial_instance_count},
+        )
+        wait_for_inference_component(sagemaker, resource.inference_component_name)
+        print(f"Inference component {resource.inference_component_name} created, pass it as "
+              f"InferenceComponentName when invoking the endpoint.")
+
+    autoscaling = boto3.client('application-autoscaling', region_name=region)
+    cloudwatch = boto3.client('cloudwatch', region_name=region)
+    policies = configure_autoscaling(autoscaling, cloudwatch, resource, scaling)
+    print(f"Autoscaling {resource.resource_id} between {scaling.min_capacity} and {scaling.max_capacity} "
+          f"with a target of {scaling.target_value:g} {scaling.metric}, policies: {', '.join(policies)}")
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
@@ -66,6 +137,8 @@ if __name__ == '__main__':
     parser.add_argument('--role-arn', required=True, help='The ARN of the IAM role for SageMaker to access resources')
     parser.add_argument('--image-uri', required=True, help='The URI of the Docker image in ECR')
     parser.add_argument('--endpoint-name', default='vllm-endpoint', help='The name of the endpoint to create')
+    parser.add_argument('--initial-instance-count', type=int, default=1, help='Instances to start with')
+    add_scaling_arguments(parser)
 
     args = parser.parse_args()
 
@@ -75,4 +148,6 @@ if __name__ == '__main__':
         role_arn=args.role_arn,
         image_uri=args.image_uri,
         endpoint_name=args.endpoint_name,
+        initial_instance_count=args.initial_instance_count,
+        scaling=scaling_config_from_args(args),
     )
@@ -1,9 +1,35 @@
 import argparse
 import sys
+import time
 
 import boto3  # type: ignore
 
 
+def inference_component_exists(client, name):
+    try:
+        client.describe_inference_component(InferenceComponentName=name)
+        return True
+    except client.exceptions.ClientError as e:
+        if e.response['Error']['Code'] == 'ValidationException':
+            return False
+        raise
+
+def remove_inference_components(endpoint_name, delay: int = 10):
+    """ The inference components of an endpoint (e.g. of --scale-to-zero) must be gone before it can be deleted. """
+    client = boto3.client('sagemaker')
+    try:
+        pages = client.get_paginator('list_inference_components').paginate(EndpointNameEquals=endpoint_name)
+        names = [component['InferenceComponentName'] for page in pages for component in page['InferenceComponents']]
+        for name in names:
+            client.delete_inference_component(InferenceComponentName=name)
+            print(f"Deleting inference component {name}...")
+        for name in names:
+            while inference_component_exists(client, name):
+                time.sleep(delay)
+            print(f"Inference component {name} deleted successfully.")
+    except client.exceptions.ClientError as e:
+        print(f"Error deleting the inference components of {endpoint_name}: {e}")
+
 def remove_sagemaker_endpoint(endpoint_name):
     client = boto3.client('sagemaker')
     try:
@@ -33,6 +59,7 @@ if __name__ == "__main__":
     parser.add_argument('--endpoint', type=str, help="Name of the SageMaker endpoint to remove.")
     args = parser.parse_args()
     if args.endpoint:
+        remove_inference_components(args.endpoint)
         remove_sagemaker_endpoint(args.endpoint)
         remove_sagemaker_model(args.endpoint + "-model")
         remove_sagemaker_endpoint_config(args.endpoint + "-config")
@@ -1,132 +1,195 @@
 import argparse
 import base64
-import json
+import os
 import sys
-from typing import Any
+from typing import Any, Callable, Iterable
 
 import boto3  # type: ignore
 import requests
+from botocore.config import Config  # type: ignore
 from botocore.eventstream import EventStream  # type: ignore
 from botocore.response import StreamingBody  # type: ignore
 
+# shared client helpers live in src/
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+from compression import ENCODINGS, compress, decompress, get_custom_attribute  # noqa: E402
+from image_prep import ImagePrepConfig, ImagePreparer, report  # noqa: E402
+from invocation_policy import HedgedInvoker, InvocationPolicy  # noqa: E402
+from json_codec import dumps  # noqa: E402
+from sse_decoder import SSEDecoder  # noqa: E402
 
-def append_chunk_try_decode(chunk: bytes, buffer: str) -> tuple[dict[str, Any], str]:
-    data = {}
-    data_str = chunk.strip(b'data: ').decode('utf-8')
-    try:
-        buffer += data_str
-        data = json.loads(buffer.strip())
-    except json.JSONDecodeError:
-        pass
-    else:
-        buffer = ''
-    return data, buffer
 
-def process_response(response: StreamingBody | EventStream):
+def process_response(
+    response: StreamingBody | EventStream | Iterable[bytes],
+    on_data: Callable[[dict[str, Any]], None] | None = None,
+    verbose: bool = True,
+):
     """
     Process a response from SageMaker and print the
     messages sent by the model.
+
+    `on_data` is called with every decoded response object as soon as it
+    arrives, which lets callers (e.g. the benchmark) timestamp the chunks.
     """
-    buffer = ''
+    def handle(data: dict[str, Any]):
+        if on_data is not None:
+            on_data(data)
+        if not verbose:
+            return
+        for choice in data.get('choices', []):
+            if 'message' in choice:
+                print(choice['message']['content'])
+            else:
+                if choice['delta'].get('content'):
+                    print(choice['delta']['content'], end="")
+                    sys.stdout.flush()
+
+    if isinstance(response, StreamingBody):
+        # iterating a StreamingBody splits it into lines and drops the line endings,
+        # which are needed to find the event boundaries
+        response = response.iter_chunks()
+
+    decoder = SSEDecoder()
     for chunk in response:
         if not chunk:
             continue
         elif isinstance(chunk, dict):
             chunk = chunk["PayloadPart"]["Bytes"]
-        
-        data, buffer = append_chunk_try_decode(chunk, buffer)
-
-        if data:
-            for choice in data['choices']:
-                if 'message' in choice:
-                    print(choice['message']['content'])
-                else:
-                    if 'content' in choice['delta']:
-                        print(choice['delta']['content'], end="")
-                        sys.stdout.flush()
-    print('')
-
-parser = argparse.ArgumentParser(description='Send a request to the SageMaker endpoint for inference.')
-parser.add_argument('--region', type=str, default='us-east-1', help='The region of the SageMaker endpoint')
-parser.add_argument('--endpoint-name', type=str, required=True, help='The SageMaker endpoint')
-parser.add_argument('--model', type=str, required=True, help='The model name')
-args = parser.parse_args()
-
-# Create SageMaker runtime client
-client = boto3.client("runtime.sagemaker", region_name=args.region)
-url = "https://cdn.britannica.com/61/93061-050-99147DCE/Statue-of-Liberty-Island-New-York-Bay.jpg"
-image_content = requests.get(url, timeout=30).content
-encoded_image = base64.b64encode(image_content).decode('utf-8')
-
-# The vLLM endpoint expects a JSON with the OpenAI API format.
-# https://platform.openai.com/docs/api-reference/introduction
-# with extra ones supported by vLLM, see vLLM Docs:
-# https://docs.vllm.ai/en/latest/serving/openai_compatible_server.html
-payload = {
-    # NOTE: The 'model' parameter is mandated by OpenAI API interface,
-    # but it doesn't mean we can choose the model on the fly, the model is set
-    # when creating the Sagemaker Endpoiont.
-    "model": args.model,
-    "messages": [
-        {
-            "role": "system",
-            "content": "You are a helpful assistant."
-        },
-		{
-            "role": "user",
-            "content": [
-                {
-                    "type": "text",
-                    "text": "Describe this image in one sentence."
-                },
-                {
-                    "type": "image_url",
-                    "image_url": {
-                        # can pass image urls directly, but we won't do it to actually check the image content
-                        "url": f"data:image/jpeg;base64,{encoded_image}"
-                    }
-                }
-            ]
-        }
-    ],
-    "max_tokens": 1024
-}
-
-# Demo: Non-streaming mode
-#
-# parameters are compatible with OpenAI API format: 
-
-#
-# NOTE: The streaming behavior is actually controlled by the 'stream=True' parameter
-# inside the vLLM, but since you use invoke_endpoint,
-# even if you pass 'stream=True', you still won't get the real streaming response.
-
-print("\n\n=========== Testing non-streaming API ===========")
-sys.stdout.flush()
-response = client.invoke_endpoint(
-    EndpointName=args.endpoint_name,
-    Body=json.dumps(payload),
-    ContentType="application/json",
-)
-process_response(response['Body'])
-
-# Demo: streaming mode
-#
-# parameters are compatible with OpenAI API format: 
-# https://platform.openai.com/docs/api-reference/introduction
-# with extra ones supported by vLLM, see vLLM Docs.
-# 
-# NOTE: The streaming behavior is actually controlled by the 'stream=True' parameter
-# inside the vLLM, but if you use invoke_endpoint, instead of invoke_endpoint_with_response_stream,
-# even if you pass 'stream=True', you still won't get the real streaming response.
-spayload = payload.copy()
-spayload["stream"] = True # stream must be True when using invoke_endpoint_with_response_stream"
-
-print("\n\n=========== Testing streaming API ===========")
-sys.stdout.flush()
-stream_response = client.invoke_endpoint_with_response_stream(
-    EndpointName=args.endpoint_name,
-    Body=json.dumps(spayload),
-    ContentType="application/json",
-)
-process_response(stream_response['Body'])
\ No newline at end of file
+        for data in decoder.feed(chunk):
+            handle(data)
+    for data in decoder.flush():
+        handle(data)
+    if verbose:
+        print('')
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Send a request to the SageMaker endpoint for inference.')
+    parser.add_argument('--region', type=str, default='us-east-1', help='The region of the SageMaker endpoint')
+    parser.add_argument('--endpoint-name', type=str, required=True, help='The SageMaker endpoint')
+    parser.add_argument('--inference-component', type=str, default=None, help='The inference component of endpoints created with --scale-to-zero')
+    parser.add_argument('--model', type=str, required=True, help='The model name')
+    parser.add_argument('--max-image-side', type=int, default=1344, help='Downscale the image to this size, 0 sends it as is')
+    parser.add_argument('--image-quality', type=int, default=85, help='JPEG quality of the downscaled image')
+    parser.add_argument('--compression', choices=ENCODINGS, default=None,
+                        help='Send the request body compressed, and receive the non-streaming response compressed')
+    parser.add_argument('--hedge', action='store_true',
+                        help='Hedge a slow non-streaming request and retry throttling, see src/invocation_policy.py')
+    args = parser.parse_args()
+
+    # Create SageMaker runtime client
+    # with --hedge the policy retries within its budget, botocore's own retries would multiply them
+    config = Config(retries={'total_max_attempts': 1}) if args.hedge else None
+    client = boto3.client("runtime.sagemaker", region_name=args.region, config=config)
+    url = "https://cdn.britannica.com/61/93061-050-99147DCE/Statue-of-Liberty-Island-New-York-Bay.jpg"
+    image_content = requests.get(url, timeout=30).content
+    if args.max_image_side:
+        # Large images bloat the request and cost vision tokens the model can't use
+        preparer = ImagePreparer(ImagePrepConfig(max_side=args.max_image_side, quality=args.image_quality))
+        prepared_images = preparer.prepare_many([image_content])
+        print(report(prepared_images))
+        image_part = prepared_images[0].message_part()
+    else:
+        encoded_image = base64.b64encode(image_content).decode('utf-8')
+        image_part = {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{encoded_image}"}}
+
+    # The vLLM endpoint expects a JSON with the OpenAI API format.
+    # https://platform.openai.com/docs/api-reference/introduction
+    # with extra ones supported by vLLM, see vLLM Docs:
+    # https://docs.vllm.ai/en/latest/serving/openai_compatible_server.html
+    payload = {
+        # NOTE: The 'model' parameter is mandated by OpenAI API interface,
+        # but it doesn't mean we can choose the model on the fly, the model is set
+        # when creating the Sagemaker Endpoiont.
+        "model": args.model,
+        "messages": [
+            {
+                "role": "system",
+                "content": "You are a helpful assistant."
+            },
+            {
+                "role": "user",
+                "content": [
+                    {
+                        "type": "text",
+                        "text": "Describe this image in one sentence."
+                    },
+                    # can pass image urls directly, but we won't do it to actually check the image content
+                    image_part,
+                ]
+            }
+        ],
+        "max_tokens": 1024
+    }
+
+    # Demo: Non-streaming mode
+    #
+    # parameters are compatible with OpenAI API format: 
+
+    #
+    # NOTE: The streaming behavior is actually controlled by the 'stream=True' parameter
+    # inside the vLLM, but since you use invoke_endpoint,
+    # even if you pass 'stream=True', you still won't get the real streaming response.
+
+    # endpoints created with --scale-to-zero serve the model through an inference component
+    component = {"InferenceComponentName": args.inference_component} if args.inference_component else {}
+
+    def encode(payload: dict[str, Any]) -> tuple[bytes, dict[str, str]]:
+        """ The request body and, with --compression, the custom attributes announcing it. """
+        # straight to bytes, without a str copy of the base64 image
+        body = dumps(payload)
+        if not args.compression:
+            return body, {}
+        compressed = compress(body, args.compression)
+        print(f"Request body: {len(body)} bytes, {len(compressed)} bytes with {args.compression}")
+        # SageMaker only passes the custom attributes on, not Content-Encoding
+        attributes = f"content_encoding={args.compression}"
+        if not payload.get("stream"):
+            attributes += f",accept_encoding={args.compression}"
+        return compressed, {"CustomAttributes": attributes}
+
+    print("\n\n=========== Testing non-streaming API ===========")
+    sys.stdout.flush()
+    body, attributes = encode(payload)
+
+    def invoke() -> tuple[bytes, str | None]:
+        """ The response body and its encoding, read inside the call so that a hedge also wins over a slow body. """
+        response = client.invoke_endpoint(
+            EndpointName=args.endpoint_name,
+            Body=body,
+            ContentType="application/json",
+            **component,
+            **attributes,
+        )
+        return response['Body'].read(), get_custom_attribute(response.get('CustomAttributes'), 'content_encoding')
+
+    if args.hedge:
+        with HedgedInvoker(InvocationPolicy()) as invoker:
+            response_body, response_encoding = invoker.invoke(invoke)
+        print(invoker.summary())
+    else:
+        response_body, response_encoding = invoke()
+    process_response([decompress(response_body, response_encoding) if response_encoding else response_body])
+
+    # Demo: streaming mode
+    #
+    # parameters are compatible with OpenAI API format: 
+    # https://platform.openai.com/docs/api-reference/introduction
+    # with extra ones supported by vLLM, see vLLM Docs.
+    # 
+    # NOTE: The streaming behavior is actually controlled by the 'stream=True' parameter
+    # inside the vLLM, but if you use invoke_endpoint, instead of invoke_endpoint_with_response_stream,
+    # even if you pass 'stream=True', you still won't get the real streaming response.
+    spayload = payload.copy()
+    spayload["stream"] = True # stream must be True when using invoke_endpoint_with_response_stream"
+
+    print("\n\n=========== Testing streaming API ===========")
+    sys.stdout.flush()
+    body, attributes = encode(spayload)
+    stream_response = client.invoke_endpoint_with_response_stream(
+        EndpointName=args.endpoint_name,
+        Body=body,
+        ContentType="application/json",
+        **component,
+        **attributes,
+    )
+    process_response(stream_response['Body'])
@@ -1,38 +1,149 @@
 import argparse
+import sys
+import time
 from datetime import datetime
-from time import sleep
 
 import boto3  # type: ignore
 
+# Statuses after which the endpoint won't change on its own
+FINAL_STATUSES = ('InService', 'Failed', 'UpdateRollbackFailed', 'OutOfService')
+
 
 def get_next_version_name(sagemaker, base_name, date, prefix):
     # "Determine whether it is a model or endpoint configuration based on the prefix"
+    version_prefix = f"{base_name}-{date}v"
+    # let the API filter by name, the account may have many more models and configs
     existing_names = []
     if prefix == 'model':
-        existing_names = [model['ModelName'] for model in sagemaker.list_models()['Models']]
+        for page in sagemaker.get_paginator('list_models').paginate(NameContains=version_prefix):
+            existing_names.extend(model['ModelName'] for model in page['Models'])
     elif prefix == 'config':
-        existing_names = [config['EndpointConfigName'] for config in sagemaker.list_endpoint_configs()['EndpointConfigs']]
-    
+        for page in sagemaker.get_paginator('list_endpoint_configs').paginate(NameContains=version_prefix):
+            existing_names.extend(config['EndpointConfigName'] for config in page['EndpointConfigs'])
+
     # Filter out the names that match the base name and date
     version_nums = []
     for name in existing_names:
-        if name.startswith(f"{base_name}-{date}v"):
-            version_num = name.split('v')[-1]
+        if name.startswith(version_prefix):
+            version_num = name[len(version_prefix):]
             if version_num.isdigit():
                 version_nums.append(int(version_num))
-    
+
     # Determine the next version number
     if version_nums:
         next_version = max(version_nums) + 1
     else:
         next_version = 1
-    
+
     return f"{base_name}-{date}v{next_version}"
 
-def main(args):
-    sagemaker = boto3.client('sagemaker', region_name=args.region)
+def put_rollback_alarms(cloudwatch, endpoint_name, variant_name, max_latency_ms, latency_statistic, max_error_percent):
+    """
+    Alarms on the model latency and the share of 5XX errors of the variant. Both
+    fleets report under the same variant, so a slower or failing new version
+    raises them while it takes traffic and the deployment is rolled back.
+    """
+    dimensions = [{'Name': 'EndpointName', 'Value': endpoint_name}, {'Name': 'VariantName', 'Value': variant_name}]
+    alarm_names = []
+
+    if max_latency_ms:
+        name = f"{endpoint_name}-rollback-model-latency"
+        cloudwatch.put_metric_alarm(
+            AlarmName=name,
+            AlarmDescription=f"{latency_statistic} ModelLatency above {max_latency_ms} ms",
+            Namespace='AWS/SageMaker',
+            MetricName='ModelLatency',
+            Dimensions=dimensions,
+            ExtendedStatistic=latency_statistic,
+            Period=60,
+            EvaluationPeriods=3,
+            DatapointsToAlarm=2,
+            Threshold=max_latency_ms * 1000,  # ModelLatency is in microseconds
+            ComparisonOperator='GreaterThanThreshold',
+            TreatMissingData='notBreaching',
+        )
+        alarm_names.append(name)
+
+    if max_error_percent:
+        name = f"{endpoint_name}-rollback-errors"
+
+        def metric(id, metric_name):
+            return {
+                'Id': id,
+                'MetricStat': {
+                    'Metric': {'Namespace': 'AWS/SageMaker', 'MetricName': metric_name, 'Dimensions': dimensions},
+                    'Period': 60,
+                    'Stat': 'Sum',
+                },
+                'ReturnData': False,
+            }
+
+        cloudwatch.put_metric_alarm(
+            AlarmName=name,
+            AlarmDescription=f"More than {max_error_percent}% of the invocations fail with 5XX errors",
+            Metrics=[
+                metric('errors', 'Invocation5XXErrors'),
+                metric('invocations', 'Invocations'),
+                {'Id': 'error_percent', 'Expression': 'IF(invocations > 0, 100 * errors / invocations, 0)',
+                 'Label': '5XX error percent', 'ReturnData': True},
+            ],
+            EvaluationPeriods=2,
+            DatapointsToAlarm=2,
+            Threshold=max_error_percent,
+            ComparisonOperator='GreaterThanThreshold',
+            TreatMissingData='notBreaching',
+        )
+        alarm_names.append(name)
+    return alarm_names
+
+def build_deployment_config(traffic_routing, canary_percent, linear_step_percent, wait_interval, termination_wait,
+                            alarm_names):
+    """ Blue/green deployment shifting the traffic all at once, canary first or in linear steps. """
+    routing = {'Type': traffic_routing.upper(), 'WaitIntervalInSeconds': wait_interval}
+    if traffic_routing == 'canary':
+        routing['CanarySize'] = {'Type': 'CAPACITY_PERCENT', 'Value': canary_percent}
+    elif traffic_routing == 'linear':
+        routing['LinearStepSize'] = {'Type': 'CAPACITY_PERCENT', 'Value': linear_step_percent}
+    config = {
+        'BlueGreenUpdatePolicy': {
+            'TrafficRoutingConfiguration': routing,
+            # keep the old fleet a while after the shift, so that a late alarm can still roll back quickly
+            'TerminationWaitInSeconds': termination_wait,
+        },
+    }
+    if alarm_names:
+        config['AutoRollbackConfiguration'] = {'Alarms': [{'AlarmName': name} for name in alarm_names]}
+    return config
+
+def wait_for_endpoint(sagemaker, endpoint_name, initial_delay=5, max_delay=60, timeout=3 * 3600, sleep=time.sleep):
+    """ Poll the endpoint status with exponential backoff until it settles, return the last description. """
+    delay = initial_delay
+    deadline = time.monotonic() + timeout
+    last_status = None
+    while True:
+        response = sagemaker.describe_endpoint(EndpointName=endpoint_name)
+        status = response['EndpointStatus']
+        if status != last_status:
+            print(f"Endpoint status: {status}")
+            last_status = status
+        if status in FINAL_STATUSES:
+            return response
+        if time.monotonic() + delay > deadline:
+            raise TimeoutError(f"Endpoint {endpoint_name} still {status} after {timeout} s")
+        sleep(delay)
+        delay = min(delay * 2, max_delay)
+
+def main(args, sagemaker=None, cloudwatch=None):
+    sagemaker = sagemaker or boto3.client('sagemaker', region_name=args.region)
+    cloudwatch = cloudwatch or boto3.client('cloudwatch', region_name=args.region)
     date = datetime.now().strftime('%Y%m%d')
 
+    # keep the variant name and the instance count, the autoscaling is registered for them
+    endpoint = sagemaker.describe_endpoint(EndpointName=args.endpoint_name)
+    current_variant = endpoint['ProductionVariants'][0]
+    variant_name = current_variant['VariantName']
+    instance_count = current_variant.get('CurrentInstanceCount') or 1
+
     # the new model name and endpoint config name
     model_name = get_next_version_name(sagemaker, args.endpoint_name, date, 'model')
     endpoint_config_name = get_next_version_name(sagemaker, args.endpoint_name, date, 'config')
@@ -60,31 +171,42 @@ def main(args):
         EndpointConfigName=endpoint_config_name,
         ProductionVariants=[
             {
-                'VariantName': 'variant-1',
+                'VariantName': variant_name,
                 'ModelName': model_name,
                 'InstanceType': args.instance_type,
-                'InitialInstanceCount': 1
+                'InitialInstanceCount': instance_count
             },
         ],
     )
     print(f"Using instance type: {args.instance_type}")
     print(f"Created endpoint config: {create_endpoint_config_response['EndpointConfigArn']}")
 
+    alarm_names = put_rollback_alarms(cloudwatch, args.endpoint_name, variant_name, args.max_latency_ms,
+                                      args.latency_statistic, args.max_error_percent)
+    deployment_config = build_deployment_config(args.traffic_routing, args.canary_percent, args.linear_step_percent,
+                                                args.wait_interval, args.termination_wait, alarm_names)
+    print(f"Traffic routing: {deployment_config['BlueGreenUpdatePolicy']['TrafficRoutingConfiguration']}")
+    print(f"Rollback alarms: {', '.join(alarm_names) or 'none'}")
+
     # Upate the endpoint!
     update_endpoint_response = sagemaker.update_endpoint(
         EndpointName=args.endpoint_name,
-        EndpointConfigName=endpoint_config_name
+        EndpointConfigName=endpoint_config_name,
+        DeploymentConfig=deployment_config,
     )
     print(f"Updating endpoint: {update_endpoint_response['EndpointArn']}")
 
     # 检查更新状态
-    while True:
-        response = sagemaker.describe_endpoint(EndpointName=args.endpoint_name)
-        status = response['EndpointStatus']
-        print(f"Endpoint status: {status}")
-        if status in ['InService', 'Failed']:
-            break
-        sleep(10)
+    response = wait_for_endpoint(sagemaker, args.endpoint_name)
+    if response['EndpointStatus'] != 'InService':
+        print(f"Update failed: {response.get('FailureReason')}")
+        return 1
+    if response['EndpointConfigName'] != endpoint_config_name:
+        # a rollback alarm fired, the endpoint is back on the previous config
+        print(f"Update rolled back, the endpoint still uses {response['EndpointConfigName']}")
+        return 1
+    print(f"Endpoint updated to {endpoint_config_name}")
+    return 0
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Update SageMaker endpoint.')
@@ -94,6 +216,19 @@ if __name__ == '__main__':
     parser.add_argument('--image', type=str, required=True, help='URI of the Docker image')
     parser.add_argument('--model_id', type=str, help='Huggingface ID for the new model')
     parser.add_argument('--instance_type', type=str, required=True, help='Type of instance to deploy the model')
+    parser.add_argument('--traffic_routing', choices=['all_at_once', 'canary', 'linear'], default='canary',
+                        help='How the traffic is shifted to the new version')
+    parser.add_argument('--canary_percent', type=int, default=10, help='Capacity taking the traffic first with canary')
+    parser.add_argument('--linear_step_percent', type=int, default=25, help='Capacity shifted per step with linear')
+    parser.add_argument('--wait_interval', type=int, default=600,
+                        help='Seconds to watch the alarms after each traffic shift')
+    parser.add_argument('--termination_wait', type=int, default=300,
+                        help='Seconds to keep the old fleet after the full shift')
+    parser.add_argument('--max_latency_ms', type=float, default=None,
+                        help='Roll back when the model latency statistic exceeds this')
+    parser.add_argument('--latency_statistic', type=str, default='p90', help='Percentile of the latency alarm')
+    parser.add_argument('--max_error_percent', type=float, default=5.0,
+                        help='Roll back when more invocations fail with 5XX errors, 0 disables the alarm')
 
     args = parser.parse_args()
-    main(args)
\ No newline at end of file
+    sys.exit(main(args))
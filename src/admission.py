@@ -0,0 +1,105 @@
+import asyncio
+import time
+from collections import deque
+
+from prometheus_client import Counter, Gauge, Histogram
+
+from compression import get_custom_attribute
+
+ACTIVE = Gauge("proxy_admission_active_requests", "Requests admitted and being processed")
+QUEUE_DEPTH = Gauge("proxy_admission_queue_depth", "Requests waiting for admission")
+QUEUE_WAIT = Histogram(
+    "proxy_admission_queue_wait_seconds", "Time admitted requests waited in the queue",
+    buckets=(0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30))
+REJECTED = Counter("proxy_admission_rejected_total", "Requests rejected by reason: queue_full or timeout", ["reason"])
+
+
+class Rejected(Exception):
+    def __init__(self, reason: str, message: str):
+        super().__init__(message)
+        self.reason = reason
+
+
+class AdmissionController:
+    """
+    Limits the number of requests processed concurrently. Requests above the
+    limit wait in a bounded FIFO queue and are rejected right away once the
+    queue is full, or when they waited longer than their deadline. Failing
+    fast is cheaper than letting the engine work on requests which will hit
+    the SageMaker invocation timeout anyway.
+    """
+
+    def __init__(self, max_concurrency: int, max_queue: int, queue_timeout: float):
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.active = 0
+        self._waiters: deque[asyncio.Future] = deque()
+
+    @property
+    def overloaded(self) -> bool:
+        return self.active >= self.max_concurrency and len(self._waiters) >= self.max_queue
+
+    async def acquire(self, timeout: float | None = None):
+        """ Wait for a slot, `timeout` overrides the default queue deadline. """
+        if self.active < self.max_concurrency and not self._waiters:
+            self._admit(0.0)
+            return
+        if len(self._waiters) >= self.max_queue:
+            REJECTED.labels("queue_full").inc()
+            raise Rejected("queue_full", "Too many requests waiting, try again later")
+
+        started = time.perf_counter()
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        QUEUE_DEPTH.set(len(self._waiters))
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter), timeout if timeout is not None else self.queue_timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            if waiter.done() and not waiter.cancelled():
+                # the slot was handed over just as the deadline expired, pass it on
+                self.release()
+            else:
+                waiter.cancel()
+                self._remove(waiter)
+            if isinstance(e, asyncio.CancelledError):
+                raise
+            REJECTED.labels("timeout").inc()
+            raise Rejected("timeout", "Request timed out waiting in the queue") from None
+        QUEUE_WAIT.observe(time.perf_counter() - started)
+
+    def release(self):
+        self.active -= 1
+        # hand the slot over to the longest waiting request
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                self._admit(None)
+                waiter.set_result(None)
+                break
+        QUEUE_DEPTH.set(len(self._waiters))
+        ACTIVE.set(self.active)
+
+    def _admit(self, waited: float | None):
+        self.active += 1
+        ACTIVE.set(self.active)
+        if waited is not None:
+            QUEUE_WAIT.observe(waited)
+
+    def _remove(self, waiter: asyncio.Future):
+        try:
+            self._waiters.remove(waiter)
+        except ValueError:
+            pass
+        QUEUE_DEPTH.set(len(self._waiters))
+
+
+def parse_queue_timeout(custom_attributes: str | None) -> float | None:
+    """ Read `queue_timeout=<seconds>` from the X-Amzn-SageMaker-Custom-Attributes header. """
+    value = get_custom_attribute(custom_attributes, "queue_timeout")
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        return None
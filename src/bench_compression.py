@@ -0,0 +1,102 @@
+import argparse
+import base64
+import io
+import json
+import random
+import time
+
+from compression import ENCODINGS, compress, decompress
+
+WORDS = ("the model returns a short answer to every question about the document in the context window "
+         "and cites the passages it used while the reviewer checks each claim against the source").split()
+
+
+def image_payload(side: int, seed: int = 0) -> dict:
+    """ A chat request with a base64 JPEG, as built by sagemaker/test_endpoint.py. """
+    from PIL import Image, ImageFilter
+
+    rng = random.Random(seed)
+    # smoothed noise compresses like a photo, pure noise would make JPEG (and everything after) pointless
+    image = Image.frombytes("RGB", (side, side), rng.randbytes(side * side * 3)).filter(ImageFilter.GaussianBlur(2))
+    buffer = io.BytesIO()
+    image.save(buffer, format="JPEG", quality=85)
+    encoded = base64.b64encode(buffer.getvalue()).decode("ascii")
+    return {"model": "bench", "max_tokens": 256, "messages": [{"role": "user", "content": [
+        {"type": "text", "text": "Describe this image in one sentence."},
+        {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{encoded}"}},
+    ]}]}
+
+
+def text(num_words: int, rng: random.Random) -> str:
+    return " ".join(rng.choice(WORDS) for _ in range(num_words))
+
+
+def long_context_payload(num_words: int, seed: int = 0) -> dict:
+    rng = random.Random(seed)
+    return {"model": "bench", "max_tokens": 512, "messages": [
+        {"role": "system", "content": "Answer from the document only."},
+        {"role": "user", "content": text(num_words, rng)},
+    ]}
+
+
+def completion_response(num_words: int, seed: int = 0) -> dict:
+    rng = random.Random(seed)
+    return {"id": "chatcmpl-bench", "object": "chat.completion", "created": 0, "model": "bench",
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": text(num_words, rng)},
+                         "finish_reason": "stop"}],
+            "usage": {"prompt_tokens": 1000, "completion_tokens": num_words, "total_tokens": 1000 + num_words}}
+
+
+def embeddings_response(num_inputs: int, dimensions: int, seed: int = 0) -> dict:
+    rng = random.Random(seed)
+    return {"object": "list", "model": "bench", "data": [
+        {"object": "embedding", "index": i, "embedding": [rng.uniform(-0.1, 0.1) for _ in range(dimensions)]}
+        for i in range(num_inputs)
+    ]}
+
+
+def measure(body: bytes, encoding: str, level: int, repeat: int) -> dict:
+    """ Best of `repeat` runs, in CPU time so that other processes don't count. """
+    compress_times, decompress_times = [], []
+    for _ in range(repeat):
+        started = time.process_time()
+        compressed = compress(body, encoding, level)
+        compress_times.append(time.process_time() - started)
+        started = time.process_time()
+        assert decompress(compressed, encoding) == body
+        decompress_times.append(time.process_time() - started)
+    mib = len(body) / 2**20
+    return {
+        "bytes": len(body),
+        "compressed": len(compressed),
+        "saved_percent": 100 * (1 - len(compressed) / len(body)),
+        "compress_ms_per_mib": min(compress_times) * 1000 / mib,
+        "decompress_ms_per_mib": min(decompress_times) * 1000 / mib,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Bytes saved and CPU cost of compressing typical bodies.')
+    parser.add_argument('--image-side', type=int, default=1344, help='Side of the JPEG in the image request')
+    parser.add_argument('--context-words', type=int, default=100000, help='Words of the long-context request')
+    parser.add_argument('--completion-words', type=int, default=4000, help='Words of the completion response')
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    bodies = {
+        "image request": image_payload(args.image_side),
+        "long-context request": long_context_payload(args.context_words),
+        "completion response": completion_response(args.completion_words),
+        "embeddings response": embeddings_response(32, 1024),
+    }
+    levels = {"gzip": (1, 5, 9), "zstd": (1, 3, 9)}
+    print(f"{'body':<22}{'encoding':<10}{'size':>10}{'compressed':>12}{'saved':>8}"
+          f"{'compress':>16}{'decompress':>16}")
+    for name, payload in bodies.items():
+        body = json.dumps(payload).encode("utf-8")
+        for encoding in ENCODINGS:
+            for level in levels[encoding]:
+                result = measure(body, encoding, level, args.repeat)
+                print(f"{name:<22}{f'{encoding}-{level}':<10}{result['bytes']:>10}{result['compressed']:>12}"
+                      f"{result['saved_percent']:>7.1f}%{result['compress_ms_per_mib']:>10.1f} ms/MiB"
+                      f"{result['decompress_ms_per_mib']:>10.1f} ms/MiB")
@@ -0,0 +1,82 @@
+import argparse
+import asyncio
+import statistics
+import time
+
+import httpx
+
+import fake_upstream
+from invocation_policy import AsyncHedgedInvoker, InvocationPolicy
+
+
+def percentile(values: list[float], q: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q / 100))]
+
+
+async def run(url: str, num_requests: int, concurrency: int,
+              invoker: AsyncHedgedInvoker | None) -> tuple[list[float], int]:
+    """ Latencies of the successful requests among `num_requests` sent by `concurrency` workers, and the errors. """
+    payload = {"model": "bench", "messages": [{"role": "user", "content": "hi"}], "max_tokens": 16}
+    latencies, errors = [], 0
+    remaining = num_requests
+
+    async with httpx.AsyncClient(timeout=60, limits=httpx.Limits(max_connections=concurrency * 2)) as http:
+        async def post() -> httpx.Response:
+            response = await http.post(url, json=payload)
+            response.raise_for_status()
+            return response
+
+        async def worker():
+            nonlocal remaining, errors
+            while remaining > 0:
+                remaining -= 1
+                started = time.monotonic()
+                try:
+                    await (invoker.invoke(post) if invoker else post())
+                except httpx.HTTPStatusError:
+                    errors += 1
+                    continue
+                latencies.append(time.monotonic() - started)
+
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return latencies, errors
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Tail latency with and without hedging, against a server with random slow responses.')
+    parser.add_argument('--port', type=int, default=8191)
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--token-delay', type=float, default=0.002, help='Seconds per token of the stand-in server')
+    parser.add_argument('--slow-fraction', type=float, default=0.03, help='Fraction of the requests delayed')
+    parser.add_argument('--slow-delay', type=float, default=1.0, help='Seconds a slow request is delayed')
+    parser.add_argument('--throttle-fraction', type=float, default=0.01, help='Fraction of the requests answered with 429')
+    parser.add_argument('--hedge-percentile', type=float, default=95)
+    parser.add_argument('--max-hedge-fraction', type=float, default=0.1)
+    args = parser.parse_args()
+
+    app = fake_upstream.app
+    app.state.token_delay = args.token_delay
+    app.state.slow_fraction = args.slow_fraction
+    app.state.slow_delay = args.slow_delay
+    fake_upstream.run_in_thread(app, args.port)
+    url = f"http://127.0.0.1:{args.port}/v1/chat/completions"
+
+    clients = {
+        "plain": None,
+        "retries": AsyncHedgedInvoker(InvocationPolicy(hedge=False)),
+        "hedged": AsyncHedgedInvoker(InvocationPolicy(hedge_percentile=args.hedge_percentile,
+                                                      max_hedge_fraction=args.max_hedge_fraction)),
+    }
+    app.state.throttle_fraction = args.throttle_fraction
+    print(f"{'client':<10}{'p50':>9}{'p95':>9}{'p99':>9}{'max':>9}{'mean':>9}{'errors':>8}{'load':>7}")
+    for name, invoker in clients.items():
+        app.state.requests = 0
+        latencies, errors = asyncio.run(run(url, args.requests, args.concurrency, invoker))
+        # requests the server received per request sent, the cost of the hedges and retries
+        load = app.state.requests / args.requests
+        print(f"{name:<10}" + "".join(f"{percentile(latencies, q) * 1000:>7.0f}ms" for q in (50, 95, 99, 100))
+              + f"{statistics.mean(latencies) * 1000:>7.0f}ms{errors:>8}{load:>7.2f}")
+        if invoker is not None:
+            print(f"{'':<10}{invoker.summary()}")
@@ -0,0 +1,100 @@
+import argparse
+import base64
+import ctypes
+import json
+import os
+import random
+import time
+
+import json_codec
+from example_serving import parse_payload, select_route
+
+
+def image_payload(size_mb: float, seed: int = 0) -> dict:
+    """ A chat request with a base64 image of about `size_mb` MB, like sagemaker/test_endpoint.py sends. """
+    image = random.Random(seed).randbytes(int(size_mb * 2**20 * 3 / 4))
+    return {"model": "bench", "max_tokens": 256, "messages": [
+        {"role": "system", "content": "You are a helpful assistant."},
+        {"role": "user", "content": [
+            {"type": "text", "text": "Describe this image in one sentence."},
+            {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{base64.b64encode(image).decode('ascii')}"}},
+        ]},
+    ], "stream": True}
+
+
+def memory_kib(field: str) -> int:
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith(field + ":"):
+                return int(line.split()[1])
+    raise KeyError(field)
+
+
+def peak_rss_growth(fn) -> float:
+    """
+    MiB of resident memory one run adds at its peak, measured in a forked child
+    whose peak starts at the current size. tracemalloc would also count the
+    buffers orjson reserves but mostly never touches. Linux with glibc only.
+    """
+    read_end, write_end = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_end)
+        # resets the peak (VmHWM) to the current resident size
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        before = memory_kib("VmRSS")
+        fn()
+        os.write(write_end, str(memory_kib("VmHWM") - before).encode())
+        os._exit(0)
+    os.close(write_end)
+    with os.fdopen(read_end) as f:
+        growth = int(f.read())
+    os.waitpid(pid, 0)
+    return growth / 1024
+
+
+def measure(fn, repeat: int) -> dict[str, float]:
+    """ Best CPU time of `repeat` runs, and the peak memory of one run. """
+    times = []
+    for _ in range(repeat):
+        started = time.process_time()
+        fn()
+        times.append(time.process_time() - started)
+    return {"cpu_ms": min(times) * 1000, "peak_mib": peak_rss_growth(fn)}
+
+
+def legacy_parse(body: bytes):
+    """ What /invocations did before: decode the whole body to route it. """
+    select_route(json.loads(body))
+
+
+def fast_parse(body: bytes):
+    select_route(parse_payload(body))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='CPU and memory of parsing and serializing large image requests.')
+    parser.add_argument('--size-mb', type=float, default=5)
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    # a fixed mmap threshold (M_MMAP_THRESHOLD) before anything large is allocated: large
+    # buffers then always get fresh pages and are unmapped when freed, instead of
+    # reusing heap memory freed by earlier runs, which would hide them from the RSS
+    ctypes.CDLL("libc.so.6").mallopt(-3, 128 * 1024)
+
+    payload = image_payload(args.size_mb)
+    body = json.dumps(payload).encode("utf-8")
+    print(f"request: {len(body) / 2**20:.1f} MiB, orjson {'installed' if json_codec.orjson else 'not installed'}")
+
+    cases = {
+        "proxy: json.loads": lambda: legacy_parse(body),
+        "proxy: json_codec.loads": lambda: select_route(json_codec.loads(body)),
+        "proxy: peek (fast path)": lambda: fast_parse(body),
+        "client: json.dumps().encode()": lambda: json.dumps(payload).encode("utf-8"),
+        "client: json_codec.dumps": lambda: json_codec.dumps(payload),
+    }
+    for name, fn in cases.items():
+        result = measure(fn, args.repeat)
+        print(f"{name:<32}{result['cpu_ms']:>8.2f} ms CPU{result['peak_mib']:>8.2f} MiB peak RSS")
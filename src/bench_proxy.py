@@ -0,0 +1,69 @@
+import argparse
+import json
+import os
+import statistics
+import time
+
+import httpx
+
+import fake_upstream
+
+
+def measure(client: httpx.Client, url: str, payload: dict, num_requests: int) -> dict[str, list[float]]:
+    """ Sequential requests, time to the first body chunk and to the end of the response. """
+    body = json.dumps(payload).encode()
+    first, total = [], []
+    for _ in range(num_requests):
+        started = time.perf_counter()
+        with client.stream("POST", url, content=body, headers={"Content-Type": "application/json"}) as response:
+            response.raise_for_status()
+            first_chunk = None
+            for _ in response.iter_raw():
+                if first_chunk is None:
+                    first_chunk = time.perf_counter()
+        total.append(time.perf_counter() - started)
+        first.append(first_chunk - started)
+    return {"first_byte": first, "total": total}
+
+
+def describe(values: list[float]) -> dict[str, float]:
+    values = sorted(values)
+    return {
+        "p50_ms": statistics.median(values) * 1000,
+        "p99_ms": values[min(int(len(values) * 0.99), len(values) - 1)] * 1000,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Measure the latency added by the /invocations proxy.')
+    parser.add_argument('--num-requests', type=int, default=500)
+    parser.add_argument('--num-tokens', type=int, default=64)
+    parser.add_argument('--upstream-port', type=int, default=18081)
+    parser.add_argument('--proxy-port', type=int, default=18080)
+    args = parser.parse_args()
+
+    fake_upstream.app.state.num_tokens = args.num_tokens
+    fake_upstream.run_in_thread(fake_upstream.app, args.upstream_port)
+
+    # the proxy reads its configuration on import
+    os.environ['SM_PROXY_UPSTREAM_URL'] = f"http://127.0.0.1:{args.upstream_port}"
+    import example_serving
+    fake_upstream.run_in_thread(example_serving.app, args.proxy_port)
+
+    targets = {
+        "direct": f"http://127.0.0.1:{args.upstream_port}/v1/chat/completions",
+        "proxy": f"http://127.0.0.1:{args.proxy_port}/invocations",
+    }
+    payload = {"model": "fake", "messages": [{"role": "user", "content": "Hello"}], "max_tokens": args.num_tokens}
+    report = {}
+    with httpx.Client() as client:
+        for stream in (False, True):
+            mode = "stream" if stream else "non_stream"
+            for name, url in targets.items():
+                # warm up the connection pools
+                measure(client, url, {**payload, "stream": stream}, 10)
+                timings = measure(client, url, {**payload, "stream": stream}, args.num_requests)
+                report[f"{mode}_{name}"] = {key: describe(values) for key, values in timings.items()}
+            report[f"{mode}_overhead_p50_ms"] = (
+                report[f"{mode}_proxy"]["total"]["p50_ms"] - report[f"{mode}_direct"]["total"]["p50_ms"])
+    print(json.dumps(report, indent=2))
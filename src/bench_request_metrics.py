@@ -0,0 +1,55 @@
+import argparse
+import asyncio
+import json
+import time
+
+from request_metrics import RequestMetricsMiddleware
+
+BODY = json.dumps({
+    "choices": [{"index": 0, "message": {"role": "assistant", "content": " tok" * 256}}],
+    "usage": {"prompt_tokens": 42, "completion_tokens": 256, "total_tokens": 298},
+}).encode()
+
+
+async def endpoint(scope, receive, send):
+    """ A minimal ASGI app answering like vLLM, the response is split in several messages. """
+    timing = scope.get("state", {}).get("timing")
+    if timing is not None:
+        timing.route = "/v1/chat/completions"
+        timing.body_parse = 0.0001
+        timing.upstream_start = time.perf_counter()
+    await send({"type": "http.response.start", "status": 200, "headers": [(b"content-type", b"application/json")]})
+    for i in range(0, len(BODY), 512):
+        await send({"type": "http.response.body", "body": BODY[i:i + 512], "more_body": True})
+    await send({"type": "http.response.body", "body": b"", "more_body": False})
+
+
+async def run(app, num_requests: int) -> float:
+    async def receive():
+        return {"type": "http.request", "body": b"{}", "more_body": False}
+
+    async def send(message):
+        pass
+
+    started = time.perf_counter()
+    for _ in range(num_requests):
+        scope = {"type": "http", "path": "/invocations", "method": "POST", "headers": []}
+        await app(scope, receive, send)
+    return (time.perf_counter() - started) / num_requests
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Per-request cost of the request metrics middleware.')
+    parser.add_argument('--num-requests', type=int, default=20000)
+    args = parser.parse_args()
+
+    variants = {
+        "baseline": endpoint,
+        "metrics": RequestMetricsMiddleware(endpoint),
+    }
+    results = {}
+    for name, app in variants.items():
+        asyncio.run(run(app, 1000))  # warm up
+        results[name] = asyncio.run(run(app, args.num_requests))
+        print(f"{name}: {results[name] * 1e6:.1f} us/request")
+    print(f"overhead: {(results['metrics'] - results['baseline']) * 1e6:.1f} us/request")
@@ -0,0 +1,96 @@
+import argparse
+import json
+import random
+import time
+
+from sse_decoder import SSEDecoder
+
+
+def make_stream(num_events: int, seed: int = 0) -> bytes:
+    """ Synthetic chat completion stream, as produced by vLLM. """
+    rng = random.Random(seed)
+    events = []
+    for i in range(num_events):
+        chunk = {
+            "id": "chatcmpl-bench",
+            "object": "chat.completion.chunk",
+            "created": 0,
+            "model": "bench",
+            "choices": [{"index": 0, "delta": {"content": " tok%d" % rng.randint(0, 50000)}, "finish_reason": None}],
+        }
+        events.append(b"data: " + json.dumps(chunk).encode("utf-8") + b"\n\n")
+    events.append(b"data: [DONE]\n\n")
+    return b"".join(events)
+
+
+def split_random(data: bytes, max_part: int, seed: int = 0) -> list[bytes]:
+    """ Split the stream the way SageMaker PayloadParts may arrive: at arbitrary positions. """
+    rng = random.Random(seed)
+    parts = []
+    pos = 0
+    while pos < len(data):
+        size = rng.randint(1, max_part)
+        parts.append(data[pos:pos + size])
+        pos += size
+    return parts
+
+
+def legacy_decode(parts: list[bytes]) -> int:
+    """ The previous approach: grow a string and re-parse it after every chunk. """
+    buffer = ''
+    count = 0
+    for chunk in parts:
+        buffer += chunk.decode('utf-8').replace('data: ', '')
+        stripped = buffer.strip()
+        if stripped == '[DONE]':
+            buffer = ''
+            continue
+        try:
+            json.loads(stripped)
+        except json.JSONDecodeError:
+            continue
+        buffer = ''
+        count += 1
+    return count
+
+
+def incremental_decode(parts: list[bytes]) -> int:
+    decoder = SSEDecoder()
+    count = 0
+    for part in parts:
+        for _ in decoder.feed(part):
+            count += 1
+    for _ in decoder.flush():
+        count += 1
+    return count
+
+
+def timeit(fn, parts) -> tuple[float, int]:
+    started = time.perf_counter()
+    count = fn(parts)
+    return time.perf_counter() - started, count
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Compare the SSE decoders on a synthetic stream.')
+    parser.add_argument('--num-events', type=int, default=20000)
+    parser.add_argument('--max-part', type=int, default=512, help='Max PayloadPart size in bytes')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    data = make_stream(args.num_events, args.seed)
+    parts = split_random(data, args.max_part, args.seed)
+    print(f"stream: {len(data) / 2**20:.1f} MiB, {args.num_events} events, {len(parts)} parts")
+
+    elapsed, count = timeit(incremental_decode, parts)
+    print(f"incremental: {elapsed * 1000:.1f} ms, {len(data) / 2**20 / elapsed:.1f} MiB/s, {count} events")
+    assert count == args.num_events
+
+    # A single large event split in small parts shows the quadratic behaviour of
+    # re-parsing a growing buffer. The legacy decoder can't separate several
+    # events in one part, so it's only run on this case.
+    big_event = b"data: " + json.dumps({"choices": [{"delta": {"content": "x" * len(data)}}]}).encode() + b"\n\n"
+    big_parts = split_random(big_event, args.max_part, args.seed)
+    for name, fn in [("incremental", incremental_decode), ("legacy", legacy_decode)]:
+        elapsed, count = timeit(fn, big_parts)
+        print(f"{name} (single {len(big_event) / 2**20:.1f} MiB event): {elapsed * 1000:.1f} ms, {count} events")
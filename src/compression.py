@@ -0,0 +1,124 @@
+import asyncio
+import zlib
+
+try:
+    import zstandard
+except ImportError:  # zstd is optional, gzip is always available
+    zstandard = None
+
+# SageMaker doesn't pass Content-Encoding and Accept-Encoding on to the container, nor
+# Content-Encoding back to the caller, only the custom attributes. Clients of the endpoint
+# set `content_encoding=<encoding>` and `accept_encoding=<encodings>` there instead, and
+# compressed responses carry `content_encoding=<encoding>` in the same response header.
+CUSTOM_ATTRIBUTES_HEADER = "X-Amzn-SageMaker-Custom-Attributes"
+
+# in order of preference, zstd compresses about as well as gzip at a fraction of the CPU
+ENCODINGS = ("zstd", "gzip") if zstandard is not None else ("gzip",)
+LEVELS = {"gzip": 5, "zstd": 3}
+# bodies above this size are (de)compressed in a thread, zlib and zstd release the GIL
+OFFLOAD_BYTES = 1 << 20
+
+
+class UnsupportedEncoding(ValueError):
+    pass
+
+
+class BodyTooLarge(ValueError):
+    pass
+
+
+def get_custom_attribute(custom_attributes: str | None, key: str) -> str | None:
+    """ Read `key=<value>` from a comma separated custom attributes header. """
+    if not custom_attributes:
+        return None
+    for attribute in custom_attributes.split(","):
+        name, _, value = attribute.strip().partition("=")
+        if name == key:
+            return value.strip()
+    return None
+
+
+def add_custom_attributes(headers: dict[str, str], **attributes: str) -> dict[str, str]:
+    """ `headers` with the attributes appended to its custom attributes. """
+    headers = dict(headers)
+    existing = next((key for key in headers if key.lower() == CUSTOM_ATTRIBUTES_HEADER.lower()), None)
+    values = [headers.pop(existing)] if existing else []
+    values.extend(f"{key}={value}" for key, value in attributes.items())
+    headers[CUSTOM_ATTRIBUTES_HEADER] = ",".join(values)
+    return headers
+
+
+def negotiate(accept_encoding: str | None, available: tuple[str, ...] = ENCODINGS) -> str | None:
+    """ The preferred encoding allowed by an Accept-Encoding value, honouring q=0. """
+    if not accept_encoding:
+        return None
+    weights = {}
+    for item in accept_encoding.split(","):
+        name, _, params = item.strip().partition(";")
+        weight = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                weight = float(params[2:])
+            except ValueError:
+                weight = 0.0
+        weights[name.strip().lower()] = weight
+    wildcard = weights.get("*", 0.0)
+    ranked = [(weights.get(encoding, wildcard), -i, encoding) for i, encoding in enumerate(available)]
+    weight, _, encoding = max(ranked)
+    return encoding if weight > 0 else None
+
+
+def compress(body: bytes, encoding: str, level: int | None = None) -> bytes:
+    level = LEVELS[encoding] if level is None else level
+    if encoding == "gzip":
+        compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        return compressor.compress(body) + compressor.flush()
+    if encoding == "zstd" and zstandard is not None:
+        return zstandard.ZstdCompressor(level=level).compress(body)
+    raise UnsupportedEncoding(f"Unsupported content encoding {encoding}, expected one of {', '.join(ENCODINGS)}")
+
+
+def decompress(body: bytes, encoding: str, max_bytes: int | None = None) -> bytes:
+    """ Raises `BodyTooLarge` past `max_bytes`, so that a small body can't expand without bounds. """
+    limit = max_bytes + 1 if max_bytes else 0
+    if encoding == "gzip":
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        try:
+            data = decompressor.decompress(body, limit)
+        except zlib.error as e:
+            raise ValueError(f"Invalid gzip body: {e}") from e
+        if not decompressor.eof and not (max_bytes and len(data) > max_bytes):
+            raise ValueError("Truncated gzip body")
+    elif encoding == "zstd" and zstandard is not None:
+        try:
+            with zstandard.ZstdDecompressor().stream_reader(body) as reader:
+                parts = []
+                size = 0
+                while chunk := reader.read(1 << 20):
+                    parts.append(chunk)
+                    size += len(chunk)
+                    if max_bytes and size > max_bytes:
+                        break
+            data = b"".join(parts)
+        except zstandard.ZstdError as e:
+            raise ValueError(f"Invalid zstd body: {e}") from e
+    elif encoding == "identity":
+        data = body
+    else:
+        raise UnsupportedEncoding(f"Unsupported content encoding {encoding}, expected one of {', '.join(ENCODINGS)}")
+    if max_bytes and len(data) > max_bytes:
+        raise BodyTooLarge(f"The decompressed body exceeds {max_bytes} bytes")
+    return data
+
+
+async def compress_async(body: bytes, encoding: str) -> bytes:
+    if len(body) >= OFFLOAD_BYTES:
+        return await asyncio.to_thread(compress, body, encoding)
+    return compress(body, encoding)
+
+
+async def decompress_async(body: bytes, encoding: str, max_bytes: int | None = None) -> bytes:
+    if len(body) >= OFFLOAD_BYTES:
+        return await asyncio.to_thread(decompress, body, encoding, max_bytes)
+    return decompress(body, encoding, max_bytes)
@@ -0,0 +1,137 @@
+import asyncio
+import json
+import time
+from typing import Any, Awaitable, Callable
+
+from prometheus_client import Histogram
+
+BATCH_SIZE = Histogram(
+    "proxy_embedding_batch_size", "Number of inputs sent to vLLM in one embedding request",
+    buckets=(1, 2, 4, 8, 16, 32, 64, 128, 256, 512))
+BATCH_WAIT = Histogram(
+    "proxy_embedding_batch_wait_seconds", "Time an embedding request waited for its batch to be sent",
+    buckets=(0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2))
+
+# (status code, JSON body) of the upstream response for one caller
+Result = tuple[int, dict[str, Any]]
+
+
+class _PendingBatch:
+    def __init__(self, payload: dict[str, Any]):
+        # everything but the inputs, the same for all requests of the batch
+        self.payload = payload
+        self.inputs: list[str] = []
+        # (future, number of inputs, submit time) per caller
+        self.callers: list[tuple[asyncio.Future, int, float]] = []
+        self.timer: asyncio.TimerHandle | None = None
+
+
+class EmbeddingBatcher:
+    """
+    Combines concurrent embedding requests into a single upstream request.
+
+    Requests with the same parameters (model, encoding format, ...) are
+    collected for at most `max_wait` seconds or until `max_batch_size`
+    inputs are pending, then sent as one `input` list. The embeddings are
+    split back into one response per caller.
+    """
+
+    def __init__(self, send: Callable[[dict[str, Any]], Awaitable[Result]],
+                 max_batch_size: int = 64, max_wait: float = 0.005):
+        self.send = send
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self._pending: dict[str, _PendingBatch] = {}
+        # keep references to the running requests, the event loop only holds weak ones
+        self._tasks: set[asyncio.Task] = set()
+
+    def accepts(self, payload: dict[str, Any]) -> bool:
+        """ Only text inputs smaller than a batch are worth batching. """
+        inputs = payload.get("input")
+        if isinstance(inputs, str):
+            return True
+        return (isinstance(inputs, list) and 0 < len(inputs) < self.max_batch_size
+                and all(isinstance(text, str) for text in inputs))
+
+    async def submit(self, payload: dict[str, Any]) -> Result:
+        inputs = payload["input"]
+        if isinstance(inputs, str):
+            inputs = [inputs]
+        params = {key: value for key, value in payload.items() if key != "input"}
+        key = json.dumps(params, sort_keys=True)
+
+        batch = self._pending.get(key)
+        if batch is not None and len(batch.inputs) + len(inputs) > self.max_batch_size:
+            self._flush(key)
+            batch = None
+        if batch is None:
+            batch = self._pending[key] = _PendingBatch(params)
+            batch.timer = asyncio.get_running_loop().call_later(self.max_wait, self._flush, key)
+
+        future = asyncio.get_running_loop().create_future()
+        batch.inputs.extend(inputs)
+        batch.callers.append((future, len(inputs), time.perf_counter()))
+        if len(batch.inputs) >= self.max_batch_size:
+            self._flush(key)
+        return await future
+
+    def _flush(self, key: str):
+        batch = self._pending.pop(key, None)
+        if batch is None:
+            return
+        if batch.timer is not None:
+            batch.timer.cancel()
+        now = time.perf_counter()
+        BATCH_SIZE.observe(len(batch.inputs))
+        for _, _, submitted in batch.callers:
+            BATCH_WAIT.observe(now - submitted)
+        task = asyncio.create_task(self._run(batch))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, batch: _PendingBatch):
+        try:
+            status_code, response = await self.send({**batch.payload, "input": batch.inputs})
+        except Exception as e:
+            for future, _, _ in batch.callers:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        data = response.get("data") if 200 <= status_code < 300 else None
+        if data is None and 400 <= status_code < 500 and len(batch.callers) > 1:
+            # likely the input of one caller (too long, ...), which must not fail the others
+            await self._run_separately(batch)
+            return
+        if data is None:
+            # server errors are returned to every caller
+            for future, _, _ in batch.callers:
+                if not future.done():
+                    future.set_result((status_code, response))
+            return
+
+        data = sorted(data, key=lambda item: item["index"])
+        usage = response.get("usage") or {}
+        start = 0
+        for future, count, _ in batch.callers:
+            items = [{**item, "index": i} for i, item in enumerate(data[start:start + count])]
+            start += count
+            # vLLM only reports the usage of the whole batch, split it by the share of inputs
+            share = {key: value * count // len(batch.inputs) for key, value in usage.items() if isinstance(value, int)}
+            if not future.done():
+                future.set_result((status_code, {**response, "data": items, "usage": share}))
+
+    async def _run_separately(self, batch: _PendingBatch):
+        """ Send the inputs of every caller of the batch in a request of their own. """
+        requests, start = [], 0
+        for _, count, _ in batch.callers:
+            requests.append(self.send({**batch.payload, "input": batch.inputs[start:start + count]}))
+            start += count
+        results = await asyncio.gather(*requests, return_exceptions=True)
+        for (future, _, _), result in zip(batch.callers, results):
+            if future.done():
+                continue
+            if isinstance(result, BaseException):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
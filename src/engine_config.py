@@ -0,0 +1,335 @@
+import argparse
+import json
+import math
+import os
+import re
+import shlex
+import sys
+from dataclasses import asdict, dataclass, field
+
+# Resolves the vLLM engine arguments (tensor parallel size, memory utilization,
+# context length, batch size, dtype) from the instance type and the model's
+# config.json. Explicitly set SM_VLLM_* variables always win, and are taken
+# into account for the rest, e.g. a fixed --tensor-parallel-size changes the
+# KV cache capacity per GPU.
+
+GiB = 2**30
+
+# [namespace/]name of a model on the Hugging Face Hub
+HUB_REPO_ID = re.compile(r"(?:\w[\w.-]*/)?\w[\w.-]*")
+
+
+@dataclass(frozen=True)
+class GPUSpec:
+    name: str
+    memory_gib: float
+    compute_capability: tuple[int, int]
+
+    @property
+    def supports_bfloat16(self) -> bool:
+        return self.compute_capability >= (8, 0)
+
+
+# Usable memory per GPU as reported by the driver, a bit below the marketing numbers.
+T4 = GPUSpec("T4", 15, (7, 5))
+V100 = GPUSpec("V100", 16, (7, 0))
+V100_32 = GPUSpec("V100", 32, (7, 0))
+A10G = GPUSpec("A10G", 22, (8, 6))
+L4 = GPUSpec("L4", 22, (8, 9))
+A100_40 = GPUSpec("A100", 40, (8, 0))
+A100_80 = GPUSpec("A100", 80, (8, 0))
+H100 = GPUSpec("H100", 80, (9, 0))
+H200 = GPUSpec("H200", 141, (9, 0))
+L40S = GPUSpec("L40S", 44, (8, 9))
+
+
+@dataclass(frozen=True)
+class InstanceSpec:
+    num_gpus: int
+    gpu: GPUSpec
+
+
+INSTANCE_TYPES = {
+    "ml.g5.xlarge": InstanceSpec(1, A10G),
+    "ml.g5.2xlarge": InstanceSpec(1, A10G),
+    "ml.g5.4xlarge": InstanceSpec(1, A10G),
+    "ml.g5.8xlarge": InstanceSpec(1, A10G),
+    "ml.g5.12xlarge": InstanceSpec(4, A10G),
+    "ml.g5.24xlarge": InstanceSpec(4, A10G),
+    "ml.g5.48xlarge": InstanceSpec(8, A10G),
+    "ml.g6.xlarge": InstanceSpec(1, L4),
+    "ml.g6.2xlarge": InstanceSpec(1, L4),
+    "ml.g6.4xlarge": InstanceSpec(1, L4),
+    "ml.g6.12xlarge": InstanceSpec(4, L4),
+    "ml.g6.24xlarge": InstanceSpec(4, L4),
+    "ml.g6.48xlarge": InstanceSpec(8, L4),
+    "ml.g6e.xlarge": InstanceSpec(1, L40S),
+    "ml.g6e.12xlarge": InstanceSpec(4, L40S),
+    "ml.g6e.48xlarge": InstanceSpec(8, L40S),
+    "ml.p4d.24xlarge": InstanceSpec(8, A100_40),
+    "ml.p4de.24xlarge": InstanceSpec(8, A100_80),
+    "ml.p5.48xlarge": InstanceSpec(8, H100),
+    "ml.p5e.48xlarge": InstanceSpec(8, H200),
+    "ml.g4dn.xlarge": InstanceSpec(1, T4),
+    "ml.g4dn.2xlarge": InstanceSpec(1, T4),
+    "ml.g4dn.4xlarge": InstanceSpec(1, T4),
+    "ml.g4dn.12xlarge": InstanceSpec(4, T4),
+    "ml.p3.2xlarge": InstanceSpec(1, V100),
+    "ml.p3.8xlarge": InstanceSpec(4, V100),
+    "ml.p3.16xlarge": InstanceSpec(8, V100),
+    "ml.p3dn.24xlarge": InstanceSpec(8, V100_32),
+}
+
+DTYPE_BYTES = {"float32": 4, "float": 4, "bfloat16": 2, "float16": 2, "half": 2, "fp8": 1, "float8": 1}
+# Per GPU memory taken by activations, CUDA graphs and the sampler on top of
+# the weights and the KV cache.
+ACTIVATION_OVERHEAD_GIB = 1.5
+# Tokens a typical request keeps in the KV cache, used to size the batch.
+EXPECTED_TOKENS_PER_SEQUENCE = 2048
+MAX_NUM_SEQS = 256
+
+
+def get_instance_spec(instance_type: str) -> InstanceSpec:
+    try:
+        return INSTANCE_TYPES[instance_type]
+    except KeyError:
+        raise ValueError(f"Instance type {instance_type} not found in the dictionary")
+
+
+@dataclass
+class ModelSpec:
+    num_layers: int
+    hidden_size: int
+    num_attention_heads: int
+    num_kv_heads: int
+    head_dim: int
+    max_position_embeddings: int
+    dtype: str = "bfloat16"
+    # bytes of the weights, from the safetensors index or estimated from the shapes
+    weight_bytes: int = 0
+
+
+def estimate_parameters(config: dict) -> int:
+    """ Parameter count of a decoder-only transformer with a gated MLP, from its shapes. """
+    hidden = config["hidden_size"]
+    heads = config["num_attention_heads"]
+    kv_heads = config.get("num_key_value_heads") or heads
+    head_dim = config.get("head_dim") or hidden // heads
+    intermediate = config.get("intermediate_size") or 4 * hidden
+    vocab = config.get("vocab_size", 32000)
+    experts = config.get("num_local_experts") or config.get("n_routed_experts") or config.get("num_experts") or 1
+    if experts > 1:
+        intermediate = config.get("moe_intermediate_size") or intermediate
+
+    attention = hidden * head_dim * (2 * heads + 2 * kv_heads)
+    mlp = 3 * hidden * intermediate * experts
+    embeddings = vocab * hidden * (1 if config.get("tie_word_embeddings") else 2)
+    return config["num_hidden_layers"] * (attention + mlp) + embeddings
+
+
+def weight_bytes_per_parameter(config: dict, dtype: str) -> float:
+    quantization = config.get("quantization_config") or {}
+    if quantization.get("bits"):
+        return quantization["bits"] / 8
+    if quantization.get("quant_method") == "fp8":
+        return 1
+    return DTYPE_BYTES.get(dtype, 2)
+
+
+def load_model_config(model: str) -> tuple[dict, int | None]:
+    """
+    Read config.json of a local model directory (or the file itself), or
+    fetch it from the Hugging Face Hub. Returns the config and the size of
+    the weights from model.safetensors.index.json when there is one.
+    Raises ValueError when `model` is none of these.
+    """
+    if os.path.isfile(model):
+        directory, config_path = os.path.dirname(model), model
+    elif os.path.isdir(model):
+        directory, config_path = model, os.path.join(model, "config.json")
+    elif not HUB_REPO_ID.fullmatch(model) or ".." in model:
+        raise ValueError(f"{model} is neither a model directory, a config.json nor a Hugging Face model id")
+    else:
+        from huggingface_hub import hf_hub_download
+
+        config_path = hf_hub_download(model, "config.json", token=os.getenv("HF_TOKEN"))
+        directory = None
+    with open(config_path) as f:
+        config = json.load(f)
+
+    weight_bytes = None
+    index_path = os.path.join(directory, "model.safetensors.index.json") if directory is not None else None
+    if index_path is not None and os.path.exists(index_path):
+        with open(index_path) as f:
+            weight_bytes = json.load(f).get("metadata", {}).get("total_size")
+    return config, weight_bytes
+
+
+def parse_model_spec(config: dict, weight_bytes: int | None = None) -> ModelSpec:
+    # multimodal models keep the language model shapes in text_config
+    text_config = {**config, **config.get("text_config", {})}
+    heads = text_config["num_attention_heads"]
+    hidden = text_config["hidden_size"]
+    dtype = str(text_config.get("torch_dtype") or config.get("torch_dtype") or "bfloat16").removeprefix("torch.")
+    if weight_bytes is None:
+        weight_bytes = int(estimate_parameters(text_config) * weight_bytes_per_parameter(config, dtype))
+    return ModelSpec(
+        num_layers=text_config["num_hidden_layers"],
+        hidden_size=hidden,
+        num_attention_heads=heads,
+        num_kv_heads=text_config.get("num_key_value_heads") or heads,
+        head_dim=text_config.get("head_dim") or hidden // heads,
+        max_position_embeddings=text_config.get("max_position_embeddings", 4096),
+        dtype=dtype,
+        weight_bytes=weight_bytes,
+    )
+
+
+@dataclass
+class EngineConfig:
+    instance_type: str
+    # vLLM arguments, without the SM_VLLM_ overrides
+    args: dict[str, str]
+    min_tensor_parallel_size: int
+    weight_gib_per_gpu: float
+    kv_cache_gib_per_gpu: float
+    kv_cache_bytes_per_token: int
+    kv_cache_tokens: int
+    notes: list[str] = field(default_factory=list)
+
+    def to_env(self) -> dict[str, str]:
+        return {"SM_VLLM_" + name.upper().replace("-", "_"): value for name, value in self.args.items()}
+
+
+def default_memory_utilization(gpu: GPUSpec) -> float:
+    # the CUDA context and the NCCL buffers are a larger share of small GPUs
+    if gpu.memory_gib < 20:
+        return 0.85
+    if gpu.memory_gib >= 80:
+        return 0.92
+    return 0.90
+
+
+def kv_bytes_per_token(model: ModelSpec, tensor_parallel_size: int, kv_dtype_bytes: int) -> int:
+    """ Per GPU, the KV heads are split across the tensor parallel ranks, or replicated if there are fewer. """
+    kv_heads = math.ceil(model.num_kv_heads / tensor_parallel_size)
+    return 2 * model.num_layers * kv_heads * model.head_dim * kv_dtype_bytes
+
+
+def resolve(instance_type: str, model: ModelSpec, overrides: dict[str, str] | None = None) -> EngineConfig:
+    """
+    Recommend the engine arguments for `model` on `instance_type`. `overrides`
+    are SM_VLLM_* variables, they are kept as they are and used as inputs.
+    """
+    overrides = overrides or {}
+    instance = get_instance_spec(instance_type)
+    gpu = instance.gpu
+    notes = []
+
+    def override(name: str) -> str | None:
+        return overrides.get("SM_VLLM_" + name.upper().replace("-", "_"))
+
+    dtype = override("dtype") or model.dtype
+    if override("dtype") is None and dtype == "bfloat16" and not gpu.supports_bfloat16:
+        dtype = "float16"
+        notes.append(f"{gpu.name} has no bfloat16 support, using float16")
+    kv_cache_dtype = override("kv-cache-dtype") or "auto"
+    kv_dtype_bytes = 1 if kv_cache_dtype.startswith("fp8") else DTYPE_BYTES.get(dtype, 2)
+    memory_utilization = float(override("gpu-memory-utilization") or default_memory_utilization(gpu))
+    usable_bytes = gpu.memory_gib * GiB * memory_utilization - ACTIVATION_OVERHEAD_GIB * GiB
+
+    # the smallest tensor parallel size leaving room for at least one full context
+    candidates = [tp for tp in (1, 2, 4, 8) if tp <= instance.num_gpus and model.num_attention_heads % tp == 0]
+    min_context = min(model.max_position_embeddings, 4096)
+    min_tp = None
+    for tp in candidates:
+        kv_room = usable_bytes - model.weight_bytes / tp
+        if kv_room >= min_context * kv_bytes_per_token(model, tp, kv_dtype_bytes):
+            min_tp = tp
+            break
+    if min_tp is None:
+        raise ValueError(f"The model ({model.weight_bytes / GiB:.1f} GiB of weights) doesn't fit on {instance_type}")
+
+    if override("tensor-parallel-size"):
+        tensor_parallel_size = int(override("tensor-parallel-size"))
+        if tensor_parallel_size < min_tp:
+            notes.append(f"tensor parallel size {tensor_parallel_size} is below the estimated minimum of {min_tp}")
+    else:
+        # a single engine uses all the GPUs, more KV cache and faster decoding
+        tensor_parallel_size = max(tp for tp in candidates if tp >= min_tp)
+
+    weight_bytes_per_gpu = model.weight_bytes / tensor_parallel_size
+    kv_cache_bytes = max(0.0, usable_bytes - weight_bytes_per_gpu)
+    per_token = kv_bytes_per_token(model, tensor_parallel_size, kv_dtype_bytes)
+    kv_cache_tokens = int(kv_cache_bytes // per_token)
+    if kv_cache_tokens < 1:
+        raise ValueError(f"The model ({model.weight_bytes / GiB:.1f} GiB of weights) doesn't fit on {instance_type} "
+                         f"with tensor parallel size {tensor_parallel_size}, the estimated minimum is {min_tp}")
+
+    max_model_len = int(override("max-model-len") or min(model.max_position_embeddings, kv_cache_tokens))
+    if max_model_len > kv_cache_tokens:
+        notes.append(f"max model length {max_model_len} exceeds the KV cache capacity of {kv_cache_tokens} tokens")
+    max_num_seqs = int(override("max-num-seqs") or max(
+        1, min(MAX_NUM_SEQS, kv_cache_tokens // max(1, min(max_model_len, EXPECTED_TOKENS_PER_SEQUENCE)))))
+
+    args = {
+        "tensor-parallel-size": str(tensor_parallel_size),
+        "gpu-memory-utilization": f"{memory_utilization:.2f}",
+        "max-model-len": str(max_model_len),
+        "max-num-seqs": str(max_num_seqs),
+        "dtype": dtype,
+    }
+    return EngineConfig(
+        instance_type=instance_type,
+        args={name: value for name, value in args.items() if override(name) is None},
+        min_tensor_parallel_size=min_tp,
+        weight_gib_per_gpu=round(weight_bytes_per_gpu / GiB, 2),
+        kv_cache_gib_per_gpu=round(kv_cache_bytes / GiB, 2),
+        kv_cache_bytes_per_token=per_token,
+        kv_cache_tokens=kv_cache_tokens,
+        notes=notes,
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Recommend vLLM engine arguments for an instance type and a model.')
+    parser.add_argument('--instance-type', default=os.getenv('INSTANCE_TYPE'))
+    parser.add_argument('--model', default=os.getenv('SM_VLLM_MODEL'),
+                        help='Model directory, config.json or Hugging Face model id')
+    parser.add_argument('--export', action='store_true',
+                        help='Print shell export statements for the SM_VLLM_ variables which are not set yet')
+    parser.add_argument('--num-gpus', action='store_true', help='Print the number of GPUs of the instance type')
+    parser.add_argument('--replicas', action='store_true',
+                        help='Print the number of engine replicas the model fits on, one per tensor parallel group')
+    parser.add_argument('--check', action='store_true',
+                        help='Exit with an error if the model does not fit with SM_VLLM_TENSOR_PARALLEL_SIZE')
+    args = parser.parse_args()
+    if args.num_gpus:
+        if not args.instance_type:
+            sys.exit("--instance-type (INSTANCE_TYPE) must be provided")
+        print(get_instance_spec(args.instance_type).num_gpus)
+        sys.exit()
+    if not args.instance_type or not args.model:
+        sys.exit("--instance-type (INSTANCE_TYPE) and --model (SM_VLLM_MODEL) must be provided")
+
+    try:
+        model_config, weight_bytes = load_model_config(args.model)
+        overrides = {key: value for key, value in os.environ.items() if key.startswith("SM_VLLM_")}
+        engine_config = resolve(args.instance_type, parse_model_spec(model_config, weight_bytes), overrides)
+    except ValueError as e:
+        sys.exit(f"[engine-config] {e}")
+    if args.check:
+        tensor_parallel_size = int(overrides.get("SM_VLLM_TENSOR_PARALLEL_SIZE")
+                                   or engine_config.args["tensor-parallel-size"])
+        if tensor_parallel_size < engine_config.min_tensor_parallel_size:
+            sys.exit(f"[engine-config] The model needs a tensor parallel size of at least "
+                     f"{engine_config.min_tensor_parallel_size} on {args.instance_type}, not {tensor_parallel_size}")
+    elif args.replicas:
+        print(get_instance_spec(args.instance_type).num_gpus // engine_config.min_tensor_parallel_size)
+    elif args.export:
+        for note in engine_config.notes:
+            print(f"[engine-config] {note}", file=sys.stderr)
+        for key, value in engine_config.to_env().items():
+            print(f"export {key}={shlex.quote(value)}")
+    else:
+        print(json.dumps(asdict(engine_config), indent=2))
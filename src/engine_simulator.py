@@ -0,0 +1,519 @@
+import argparse
+import asyncio
+import json
+import math
+import os
+import random
+import statistics
+import sys
+import time
+import uuid
+from collections import deque
+from dataclasses import asdict, dataclass, field, fields, replace
+from typing import AsyncIterator
+
+from prometheus_client import Gauge
+
+from engine_config import (A10G, A100_40, A100_80, DTYPE_BYTES, H100, H200, L4, L40S, T4, V100, V100_32,
+                           get_instance_spec, load_model_config, parse_model_spec, resolve)
+from json_codec import dumps
+
+# A simulated vLLM engine answering OpenAI-format requests with believable
+# latencies, to exercise the proxy, streaming clients, load tests and the
+# autoscaling math without a GPU. Every step of the engine decodes one token of
+# each running sequence and prefills up to max_num_batched_tokens of the new
+# ones (chunked prefill). A step costs one read of the weights and of the KV
+# cache in use, plus the compute of the tokens in the batch, so the time per
+# output token grows with the concurrency. Requests wait when the batch is full
+# or their tokens don't fit in the KV cache. The costs are derived from the
+# instance type's GPUs and the model's shapes, see `simulator_config`.
+
+RUNNING = Gauge("proxy_sim_running_requests", "Requests in the batch of the simulated engine")
+WAITING = Gauge("proxy_sim_waiting_requests", "Requests waiting for the batch or for KV cache of the simulated engine")
+KV_CACHE_USAGE = Gauge("proxy_sim_kv_cache_usage", "Fraction of the simulated KV cache reserved by the running requests")
+
+
+@dataclass(frozen=True)
+class GPUPerformance:
+    memory_bandwidth_gbs: float
+    # dense float16/bfloat16 tensor core throughput
+    tflops: float
+
+
+GPU_PERFORMANCE = {
+    T4: GPUPerformance(320, 65),
+    V100: GPUPerformance(900, 125),
+    V100_32: GPUPerformance(900, 125),
+    A10G: GPUPerformance(600, 70),
+    L4: GPUPerformance(300, 121),
+    A100_40: GPUPerformance(1555, 312),
+    A100_80: GPUPerformance(2039, 312),
+    H100: GPUPerformance(3350, 989),
+    H200: GPUPerformance(4800, 989),
+    L40S: GPUPerformance(864, 362),
+}
+# Share of the peak numbers an engine reaches: decoding is bound by the memory
+# bandwidth, prefill by the tensor cores.
+BANDWIDTH_EFFICIENCY = 0.7
+COMPUTE_EFFICIENCY = 0.5
+# Scheduling, sampling and kernel launches of every step, more with tensor parallelism.
+STEP_OVERHEAD_MS = 3.0
+ALL_REDUCE_MS = 1.0
+# vLLM's default token budget of a step for the OpenAI server, smaller on GPUs below 70 GiB
+MAX_NUM_BATCHED_TOKENS = 2048
+LARGE_GPU_MAX_NUM_BATCHED_TOKENS = 8192
+
+# The language model of Qwen/Qwen2.5-VL-3B-Instruct, the default model of the repo.
+REFERENCE_MODEL_CONFIG = {
+    "num_hidden_layers": 36,
+    "hidden_size": 2048,
+    "num_attention_heads": 16,
+    "num_key_value_heads": 2,
+    "intermediate_size": 11008,
+    "vocab_size": 151936,
+    "max_position_embeddings": 128000,
+    "tie_word_embeddings": True,
+    "torch_dtype": "bfloat16",
+}
+
+# Prompt lengths are estimated from the characters, the simulator has no tokenizer.
+CHARS_PER_TOKEN = 4
+# Role and separators added by the chat template to every message, and the assistant prompt.
+MESSAGE_TOKENS = 4
+GENERATION_PROMPT_TOKENS = 3
+# An image at the default max_pixels of Qwen2.5-VL (1024 * 28 * 28)
+IMAGE_TOKENS = 1024
+WORDS = ("the", "model", "of", "a", "simulated", "engine", "returns", "these", "words", "and", "tokens", "to",
+         "test", "streaming", "clients", "with", "believable", "latency", "under", "load", "in", "one", "batch")
+
+
+@dataclass(frozen=True)
+class SimulatorConfig:
+    prefill_tokens_per_s: float = 5000.0
+    # time of a step with an empty batch: reading the weights
+    step_ms: float = 19.0
+    # compute added to a step by every sequence decoded in it
+    step_ms_per_sequence: float = 0.2
+    # time to read one token of the KV cache in use
+    step_ms_per_kv_token: float = 0.0001
+    max_num_batched_tokens: int = 2048
+    max_num_seqs: int = 256
+    kv_cache_tokens: int = 300000
+    max_model_len: int = 32768
+    # mean length of the completions stopping before max_tokens, exponentially distributed
+    mean_output_tokens: int = 256
+    embedding_dim: int = 1024
+    # the sleeps are multiplied by this, e.g. 0.1 runs ten times faster than the instance would
+    time_scale: float = 1.0
+    served_model_name: str = "simulated"
+
+
+def simulator_config(instance_type: str, model_config: dict | None = None, weight_bytes: int | None = None,
+                     overrides: dict[str, str] | None = None) -> SimulatorConfig:
+    """
+    The costs of a single engine using all the GPUs of `instance_type`, for the model
+    of `model_config` (by default REFERENCE_MODEL_CONFIG). `overrides` are
+    SM_PROXY_SIM_<FIELD> variables, e.g. SM_PROXY_SIM_STEP_MS.
+    """
+    gpu = get_instance_spec(instance_type).gpu
+    model = parse_model_spec(model_config or REFERENCE_MODEL_CONFIG, weight_bytes)
+    engine = resolve(instance_type, model)
+    tensor_parallel_size = int(engine.args["tensor-parallel-size"])
+    performance = GPU_PERFORMANCE[gpu]
+    bandwidth = performance.memory_bandwidth_gbs * 1e9 * tensor_parallel_size * BANDWIDTH_EFFICIENCY
+    flops = performance.tflops * 1e12 * tensor_parallel_size * COMPUTE_EFFICIENCY
+    flops_per_token = 2 * model.weight_bytes / DTYPE_BYTES.get(engine.args["dtype"], 2)
+    overhead_ms = STEP_OVERHEAD_MS + (ALL_REDUCE_MS if tensor_parallel_size > 1 else 0.0)
+
+    config = SimulatorConfig(
+        prefill_tokens_per_s=round(flops / flops_per_token),
+        step_ms=round(1000 * model.weight_bytes / bandwidth + overhead_ms, 3),
+        step_ms_per_sequence=round(1000 * flops_per_token / flops, 4),
+        step_ms_per_kv_token=1000 * engine.kv_cache_bytes_per_token * tensor_parallel_size / bandwidth,
+        max_num_batched_tokens=LARGE_GPU_MAX_NUM_BATCHED_TOKENS if gpu.memory_gib >= 70 else MAX_NUM_BATCHED_TOKENS,
+        max_num_seqs=int(engine.args["max-num-seqs"]),
+        kv_cache_tokens=engine.kv_cache_tokens,
+        max_model_len=int(engine.args["max-model-len"]),
+    )
+    values = {}
+    for config_field in fields(SimulatorConfig):
+        value = (overrides or {}).get("SM_PROXY_SIM_" + config_field.name.upper())
+        if value is not None:
+            values[config_field.name] = type(getattr(config, config_field.name))(value)
+    return replace(config, **values)
+
+
+def load_simulator_config(instance_type: str, model: str | None = None,
+                          overrides: dict[str, str] | None = None) -> SimulatorConfig:
+    """ As `simulator_config`, `model` is a model directory, config.json or Hugging Face model id. """
+    if model is None:
+        return simulator_config(instance_type, overrides=overrides)
+    model_config, weight_bytes = load_model_config(model)
+    return simulator_config(instance_type, model_config, weight_bytes, overrides)
+
+
+def text_tokens(text: str) -> int:
+    return math.ceil(len(text) / CHARS_PER_TOKEN)
+
+
+def content_tokens(content) -> int:
+    """ Tokens of a chat message content, a string or a list of parts. """
+    if isinstance(content, str):
+        return text_tokens(content)
+    tokens = 0
+    for part in content or ():
+        if not isinstance(part, dict):
+            continue
+        if part.get("type") == "text":
+            tokens += text_tokens(part.get("text") or "")
+        elif part.get("type") in ("image_url", "image", "image_pil"):
+            tokens += IMAGE_TOKENS
+    return tokens
+
+
+def input_tokens(value) -> int:
+    """ Tokens of a prompt or an embedding input: text, token ids, or lists of them. """
+    if isinstance(value, str):
+        return text_tokens(value)
+    if isinstance(value, list):
+        if all(isinstance(item, int) for item in value):
+            return len(value)
+        return sum(input_tokens(item) for item in value)
+    raise ValueError("The prompt must be a string, a list of strings or a list of token ids")
+
+
+def count_prompt_tokens(route: str, payload: dict) -> int:
+    if route == "/v1/chat/completions":
+        messages = payload["messages"]
+        if not isinstance(messages, list):
+            raise ValueError("'messages' must be a list")
+        return GENERATION_PROMPT_TOKENS + sum(
+            MESSAGE_TOKENS + content_tokens(message.get("content")) for message in messages if isinstance(message, dict))
+    if route == "/v1/embeddings":
+        return input_tokens(payload["input"])
+    return input_tokens(payload["prompt"])
+
+
+@dataclass(eq=False)
+class Sequence:
+    prompt_tokens: int
+    completion_tokens: int
+    submitted: float = field(default_factory=time.perf_counter)
+    prefilled: int = 0
+    generated: int = 0
+    first_token: float | None = None
+    finished: asyncio.Future | None = None
+    # set for every new token, for the streams
+    progress: asyncio.Event = field(default_factory=asyncio.Event)
+
+    @property
+    def kv_tokens(self) -> int:
+        """ The KV cache the sequence holds once complete, reserved when it joins the batch. """
+        return self.prompt_tokens + self.completion_tokens
+
+
+class EngineSimulator:
+    """
+    The scheduling loop of a continuous batching engine. Requests join the batch
+    first come first served while there are free sequence slots and KV cache for
+    their prompt and completion, so a large request at the head of the queue
+    holds back the ones behind it, as with vLLM's FCFS policy.
+    """
+
+    def __init__(self, config: SimulatorConfig):
+        self.config = config
+        self.waiting: deque[Sequence] = deque()
+        self.running: list[Sequence] = []
+        self.kv_tokens_used = 0
+        self._wakeup = asyncio.Event()
+        self._task: asyncio.Task | None = None
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def aclose(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+
+    def submit(self, prompt_tokens: int, completion_tokens: int) -> Sequence:
+        if prompt_tokens + completion_tokens > self.config.kv_cache_tokens:
+            raise ValueError(f"The request needs {prompt_tokens + completion_tokens} tokens of KV cache, "
+                             f"more than the {self.config.kv_cache_tokens} of the engine")
+        sequence = Sequence(prompt_tokens, completion_tokens, finished=asyncio.get_running_loop().create_future())
+        self.waiting.append(sequence)
+        WAITING.set(len(self.waiting))
+        self._wakeup.set()
+        return sequence
+
+    def abort(self, sequence: Sequence):
+        """ Free the slot and the KV cache of a request whose client is gone, a no-op once it's finished. """
+        if sequence in self.waiting:
+            self.waiting.remove(sequence)
+            WAITING.set(len(self.waiting))
+        elif sequence in self.running:
+            self._finish(sequence)
+
+    def step_seconds(self, num_decoding: int, prefill_tokens: int, context_tokens: int) -> float:
+        config = self.config
+        return (config.step_ms + config.step_ms_per_sequence * num_decoding
+                + config.step_ms_per_kv_token * context_tokens) / 1000 + prefill_tokens / config.prefill_tokens_per_s
+
+    def _admit(self):
+        config = self.config
+        while (self.waiting and len(self.running) < config.max_num_seqs
+               and self.kv_tokens_used + self.waiting[0].kv_tokens <= config.kv_cache_tokens):
+            sequence = self.waiting.popleft()
+            self.running.append(sequence)
+            self.kv_tokens_used += sequence.kv_tokens
+        WAITING.set(len(self.waiting))
+        RUNNING.set(len(self.running))
+        KV_CACHE_USAGE.set(self.kv_tokens_used / config.kv_cache_tokens)
+
+    def _finish(self, sequence: Sequence):
+        self.running.remove(sequence)
+        self.kv_tokens_used -= sequence.kv_tokens
+        RUNNING.set(len(self.running))
+        KV_CACHE_USAGE.set(self.kv_tokens_used / self.config.kv_cache_tokens)
+        if not sequence.finished.done():
+            sequence.finished.set_result(None)
+        sequence.progress.set()
+
+    async def _run(self):
+        while True:
+            if not self.running and not self.waiting:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+            self._admit()
+            decoding = [sequence for sequence in self.running if sequence.prefilled == sequence.prompt_tokens]
+            budget = self.config.max_num_batched_tokens - len(decoding)
+            prefilling, prefill_tokens = [], 0
+            for sequence in self.running:
+                if budget <= 0:
+                    break
+                if sequence.prefilled < sequence.prompt_tokens:
+                    chunk = min(budget, sequence.prompt_tokens - sequence.prefilled)
+                    prefilling.append((sequence, chunk))
+                    prefill_tokens += chunk
+                    budget -= chunk
+            context_tokens = sum(sequence.prefilled + sequence.generated for sequence in self.running)
+            await asyncio.sleep(self.step_seconds(len(decoding), prefill_tokens, context_tokens)
+                                * self.config.time_scale)
+
+            now = time.perf_counter()
+            # requests aborted during the step are no longer running
+            completed = [(sequence, 0) for sequence in decoding if sequence in self.running]
+            for sequence, chunk in prefilling:
+                if sequence in self.running:
+                    sequence.prefilled += chunk
+                    if sequence.prefilled == sequence.prompt_tokens:
+                        # the last chunk of the prompt samples the first token
+                        completed.append((sequence, 0))
+            for sequence, _ in completed:
+                if sequence.generated < sequence.completion_tokens:
+                    sequence.generated += 1
+                    if sequence.first_token is None:
+                        sequence.first_token = now
+                    sequence.progress.set()
+                if sequence.generated >= sequence.completion_tokens:
+                    self._finish(sequence)
+
+
+@dataclass
+class Plan:
+    """ What a request will get: its tokens and why the completion stops. """
+    prompt_tokens: int
+    completion_tokens: int
+    finish_reason: str | None
+
+
+def plan_request(config: SimulatorConfig, route: str, payload: dict) -> Plan:
+    """ Raises ValueError for the requests vLLM rejects with a 400. """
+    prompt_tokens = count_prompt_tokens(route, payload)
+    if route == "/v1/embeddings":
+        if prompt_tokens > config.max_model_len:
+            raise ValueError(f"This model's maximum context length is {config.max_model_len} tokens. However, "
+                             f"you requested {prompt_tokens} tokens in the input for embedding generation.")
+        return Plan(prompt_tokens, 0, None)
+
+    max_tokens = payload.get("max_completion_tokens") or payload.get("max_tokens")
+    if max_tokens is None:
+        max_tokens = config.max_model_len - prompt_tokens
+    if not isinstance(max_tokens, int) or max_tokens < 1:
+        raise ValueError("max_tokens must be at least 1")
+    if prompt_tokens + max_tokens > config.max_model_len:
+        raise ValueError(
+            f"This model's maximum context length is {config.max_model_len} tokens. However, you requested "
+            f"{prompt_tokens + max_tokens} tokens ({prompt_tokens} in the messages, {max_tokens} in the "
+            f"completion). Please reduce the length of the messages or completion.")
+    if payload.get("ignore_eos"):
+        return Plan(prompt_tokens, max_tokens, "length")
+    # a seeded request gets the same completion every time
+    rng = random.Random(payload["seed"]) if payload.get("seed") is not None else random
+    length = max(payload.get("min_tokens") or 1, math.ceil(rng.expovariate(1 / config.mean_output_tokens)))
+    if length >= max_tokens:
+        return Plan(prompt_tokens, max_tokens, "length")
+    return Plan(prompt_tokens, length, "stop")
+
+
+def token_text(index: int) -> str:
+    return " " + WORDS[index % len(WORDS)]
+
+
+def usage(plan: Plan, completion_tokens: int | None = None) -> dict:
+    completion_tokens = plan.completion_tokens if completion_tokens is None else completion_tokens
+    return {"prompt_tokens": plan.prompt_tokens, "completion_tokens": completion_tokens,
+            "total_tokens": plan.prompt_tokens + completion_tokens}
+
+
+def embedding(text: str, dim: int) -> list[float]:
+    """ A unit vector, the same for the same input. """
+    rng = random.Random(text)
+    vector = [rng.gauss(0.0, 1.0) for _ in range(dim)]
+    norm = math.sqrt(sum(value * value for value in vector))
+    return [value / norm for value in vector]
+
+
+class SimulatedCompletion:
+    """ One request to the simulator, queued with `submit`, then answered in one piece with `response` or as a stream with `events`. """
+
+    def __init__(self, simulator: EngineSimulator, route: str, payload: dict):
+        self.simulator = simulator
+        self.route = route
+        self.payload = payload
+        self.plan = plan_request(simulator.config, route, payload)
+        self.model = payload.get("model") or simulator.config.served_model_name
+        self.created = int(time.time())
+        chat = route == "/v1/chat/completions"
+        self.id = ("chatcmpl-" if chat else "cmpl-") + uuid.uuid4().hex
+        self.chat = chat
+
+    def submit(self) -> Sequence:
+        """ Queue the request on the engine, raising ValueError if it can never fit into its KV cache. """
+        return self.simulator.submit(self.plan.prompt_tokens, self.plan.completion_tokens)
+
+    async def response(self, sequence: Sequence) -> dict:
+        try:
+            await asyncio.shield(sequence.finished)
+        finally:
+            self.simulator.abort(sequence)
+        if self.route == "/v1/embeddings":
+            inputs = self.payload["input"]
+            if isinstance(inputs, str) or (inputs and isinstance(inputs[0], int)):
+                inputs = [inputs]
+            return {"id": "embd-" + uuid.uuid4().hex, "object": "list", "created": self.created, "model": self.model,
+                    "data": [{"object": "embedding", "index": i, "embedding": embedding(str(text), self.simulator.config.embedding_dim)}
+                             for i, text in enumerate(inputs)],
+                    "usage": usage(self.plan)}
+        text = "".join(token_text(i) for i in range(self.plan.completion_tokens))
+        if self.chat:
+            choice = {"index": 0, "message": {"role": "assistant", "content": text}, "logprobs": None,
+                      "finish_reason": self.plan.finish_reason}
+        else:
+            choice = {"index": 0, "text": text, "logprobs": None, "finish_reason": self.plan.finish_reason}
+        return {"id": self.id, "object": "chat.completion" if self.chat else "text_completion",
+                "created": self.created, "model": self.model, "choices": [choice], "usage": usage(self.plan)}
+
+    def _chunk(self, text: str | None, finish_reason: str | None = None, role: bool = False) -> bytes:
+        if self.chat:
+            delta = {"role": "assistant", "content": ""} if role else ({"content": text} if text is not None else {})
+            choice = {"index": 0, "delta": delta, "logprobs": None, "finish_reason": finish_reason}
+        else:
+            choice = {"index": 0, "text": text or "", "logprobs": None, "finish_reason": finish_reason}
+        chunk = {"id": self.id, "object": "chat.completion.chunk" if self.chat else "text_completion",
+                 "created": self.created, "model": self.model, "choices": [choice]}
+        return b"data: " + dumps(chunk) + b"\n\n"
+
+    async def events(self, sequence: Sequence) -> AsyncIterator[bytes]:
+        """ Server-sent events in the format of vLLM, one per token as the engine produces them. """
+        stream_options = self.payload.get("stream_options") or {}
+        try:
+            if self.chat:
+                yield self._chunk(None, role=True)
+            sent = 0
+            while sent < self.plan.completion_tokens:
+                await sequence.progress.wait()
+                sequence.progress.clear()
+                for index in range(sent, sequence.generated):
+                    final = index == self.plan.completion_tokens - 1
+                    yield self._chunk(token_text(index), self.plan.finish_reason if final else None)
+                sent = sequence.generated
+            if stream_options.get("include_usage"):
+                chunk = {"id": self.id, "object": "chat.completion.chunk" if self.chat else "text_completion",
+                         "created": self.created, "model": self.model, "choices": [], "usage": usage(self.plan)}
+                yield b"data: " + dumps(chunk) + b"\n\n"
+            yield b"data: [DONE]\n\n"
+        finally:
+            self.simulator.abort(sequence)
+
+
+def percentile(values: list[float], q: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q / 100))]
+
+
+async def measure(config: SimulatorConfig, concurrency: int, num_requests: int, prompt_tokens: int,
+                  output_tokens: int) -> dict[str, float]:
+    """ Closed loop load on a simulator: `concurrency` clients sending requests one after the other. """
+    simulator = EngineSimulator(config)
+    simulator.start()
+    ttft, tpot, remaining = [], [], num_requests
+    started = time.perf_counter()
+
+    async def client():
+        nonlocal remaining
+        while remaining > 0:
+            remaining -= 1
+            sequence = simulator.submit(prompt_tokens, output_tokens)
+            await sequence.finished
+            ended = time.perf_counter()
+            ttft.append(sequence.first_token - sequence.submitted)
+            if output_tokens > 1:
+                tpot.append((ended - sequence.first_token) / (output_tokens - 1))
+
+    await asyncio.gather(*(client() for _ in range(concurrency)))
+    elapsed = (time.perf_counter() - started) / config.time_scale
+    await simulator.aclose()
+    # in the time of the simulated instance
+    scale = 1000 / config.time_scale
+    return {
+        "ttft_p50_ms": statistics.median(ttft) * scale,
+        "ttft_p99_ms": percentile(ttft, 99) * scale,
+        "tpot_p50_ms": statistics.median(tpot) * scale if tpot else 0.0,
+        "output_tokens_per_s": num_requests * output_tokens / elapsed,
+        "requests_per_s": num_requests / elapsed,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Latency curve of the simulated engine on an instance type.')
+    parser.add_argument('--instance-type', default=os.getenv('INSTANCE_TYPE'))
+    parser.add_argument('--model', default=os.getenv('SM_PROXY_SIM_MODEL'),
+                        help='Model directory, config.json or Hugging Face model id, by default a model shaped like Qwen2.5-VL-3B')
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 4, 16, 64, 256])
+    parser.add_argument('--requests', type=int, default=4, help='Requests per client at each concurrency')
+    parser.add_argument('--prompt-tokens', type=int, default=1024)
+    parser.add_argument('--output-tokens', type=int, default=128)
+    parser.add_argument('--time-scale', type=float, default=0.1, help='Run this many times as fast as the instance would')
+    parser.add_argument('--config', action='store_true', help='Print the simulator configuration only')
+    args = parser.parse_args()
+    if not args.instance_type:
+        sys.exit("--instance-type (INSTANCE_TYPE) must be provided")
+
+    overrides = {key: value for key, value in os.environ.items() if key.startswith("SM_PROXY_SIM_")}
+    try:
+        sim_config = replace(load_simulator_config(args.instance_type, args.model, overrides), time_scale=args.time_scale)
+    except ValueError as e:
+        sys.exit(f"[engine-simulator] {e}")
+    print(json.dumps(asdict(sim_config), indent=2))
+    if args.config:
+        sys.exit()
+    print(f"{'concurrency':>11}{'ttft p50':>11}{'ttft p99':>11}{'tpot p50':>11}{'tokens/s':>10}{'req/s':>8}")
+    for concurrency in args.concurrency:
+        result = asyncio.run(measure(sim_config, concurrency, concurrency * args.requests,
+                                     args.prompt_tokens, args.output_tokens))
+        print(f"{concurrency:>11}" + "".join(f"{result[key]:>9.0f}ms" for key in ("ttft_p50_ms", "ttft_p99_ms", "tpot_p50_ms"))
+              + f"{result['output_tokens_per_s']:>10.0f}{result['requests_per_s']:>8.1f}")
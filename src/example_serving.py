@@ -1,30 +1,91 @@
+import asyncio
 import os
 import sys
+import time
+from contextlib import asynccontextmanager
 
+import httpx
 import uvicorn
 from fastapi import FastAPI, Request, status
-from fastapi.responses import JSONResponse
-from pydantic import ValidationError
-
-instance_to_gpus = {
-    "ml.g5.4xlarge": 1,
-    "ml.g6.4xlarge": 1,
-    "ml.g5.12xlarge": 4,
-    "ml.g6.12xlarge": 4,
-    "ml.g5.48xlarge": 8,
-    "ml.g6.48xlarge": 8,
-    "ml.p4d.24xlarge": 8,
-    "ml.p4de.24xlarge": 8,
-    "ml.p5.48xlarge": 8,
-    "ml.g4dn.xlarge": 1,
-    "ml.g4dn.2xlarge": 1,
-    "ml.g4dn.4xlarge": 1,
-    "ml.g4dn.12xlarge": 4,
-    "ml.p3.2xlarge": 1,
-    "ml.p3.8xlarge": 4,
-    "ml.p3.16xlarge": 8,
-    "ml.p3dn.24xlarge": 8,
-}
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest, start_http_server
+
+from admission import AdmissionController, Rejected, parse_queue_timeout
+from compression import (CUSTOM_ATTRIBUTES_HEADER, BodyTooLarge, UnsupportedEncoding, compress_async,
+                         decompress_async, get_custom_attribute, negotiate)
+from embedding_batcher import EmbeddingBatcher
+from engine_config import INSTANCE_TYPES
+from engine_simulator import EngineSimulator, SimulatedCompletion, load_simulator_config
+from image_fetcher import ImageCache, ImageFetcher, ImageFetchError
+from json_codec import dumps, loads, peek
+from replica_pool import ReplicaPool
+from request_metrics import TAIL_BYTES, RequestMetricsMiddleware, parse_usage, record_compression
+from response_cache import ResponseCache
+from streaming import call_on_close
+from warmup import parse_warmup_prompts, warm_up
+
+instance_to_gpus = {instance_type: spec.num_gpus for instance_type, spec in INSTANCE_TYPES.items()}
+
+# The vLLM server the requests are forwarded to, e.g. http://127.0.0.1:8081, or a comma
+# separated list of replicas. Without it /invocations is answered by a simulated engine.
+UPSTREAM_URL = os.getenv('SM_PROXY_UPSTREAM_URL')
+UPSTREAM_POOL_SIZE = int(os.getenv('SM_PROXY_UPSTREAM_POOL_SIZE', 512))
+UPSTREAM_TIMEOUT = float(os.getenv('SM_PROXY_UPSTREAM_TIMEOUT', 600))
+# With several replicas, send requests whose prompts start with the same characters (up to this
+# many) to the same replica so that its prefix cache hits, 0 disables it. The preferred replica
+# is skipped when it has SM_PROXY_AFFINITY_MAX_IMBALANCE more requests than the least busy one.
+PREFIX_AFFINITY_CHARS = int(os.getenv('SM_PROXY_PREFIX_AFFINITY_CHARS', 0))
+AFFINITY_MAX_IMBALANCE = int(os.getenv('SM_PROXY_AFFINITY_MAX_IMBALANCE', 4))
+HEALTH_CHECK_INTERVAL_S = float(os.getenv('SM_PROXY_HEALTH_CHECK_INTERVAL_S', 5))
+# Combine concurrent embedding requests into batches of up to this many inputs, 0 disables batching.
+EMBEDDING_BATCH_SIZE = int(os.getenv('SM_PROXY_EMBEDDING_BATCH_SIZE', 0))
+EMBEDDING_BATCH_WAIT_MS = float(os.getenv('SM_PROXY_EMBEDDING_BATCH_WAIT_MS', 5))
+# Cache the responses to deterministic requests (temperature 0, embeddings), 0 disables the cache.
+CACHE_MAX_BYTES = int(os.getenv('SM_PROXY_CACHE_MAX_BYTES', 0))
+CACHE_TTL_S = float(os.getenv('SM_PROXY_CACHE_TTL_S', 600))
+# Requests forwarded to vLLM at the same time, 0 disables the limit. The others wait in a
+# queue of SM_PROXY_MAX_QUEUE requests for at most SM_PROXY_QUEUE_TIMEOUT_S seconds.
+MAX_CONCURRENCY = int(os.getenv('SM_PROXY_MAX_CONCURRENCY', 0))
+MAX_QUEUE = int(os.getenv('SM_PROXY_MAX_QUEUE', 256))
+QUEUE_TIMEOUT_S = float(os.getenv('SM_PROXY_QUEUE_TIMEOUT_S', 30))
+# Fail /ping while the queue is full, so that the instance is taken out of rotation.
+PING_REPORTS_OVERLOAD = os.getenv('SM_PROXY_PING_REPORTS_OVERLOAD', 'false') == 'true'
+# Serve the Prometheus metrics on this port, 0 disables it. SageMaker only routes /ping and
+# /invocations, the side port is for a scraper running next to the server.
+METRICS_PORT = int(os.getenv('SM_PROXY_METRICS_PORT', 9090))
+# Also print the per-request metrics to stdout in CloudWatch Embedded Metric Format.
+EMF_ENABLED = os.getenv('SM_PROXY_EMF_ENABLED', 'false') == 'true'
+# JSON list of requests sent to vLLM once it's healthy, /ping fails until they are answered.
+# Strings are sent as a chat message, objects as they are, e.g. '["Hello", {"prompt": "Hi", "max_tokens": 8}]'.
+WARMUP_PROMPTS = os.getenv('SM_PROXY_WARMUP_PROMPTS')
+WARMUP_TIMEOUT_S = float(os.getenv('SM_PROXY_WARMUP_TIMEOUT_S', 1800))
+# gzip or zstd request bodies are accepted, up to this size once decompressed.
+MAX_REQUEST_BYTES = int(os.getenv('SM_PROXY_MAX_REQUEST_BYTES', 256 * 2**20))
+# Compress non-streaming responses of at least this many bytes for clients accepting it, 0 disables it.
+COMPRESSION_MIN_BYTES = int(os.getenv('SM_PROXY_COMPRESSION_MIN_BYTES', 1024))
+# Download the remote images of chat requests in the proxy, concurrently and cached, and forward
+# them as data URLs (or with SM_PROXY_IMAGE_REFERENCE=file as file:// URLs of the disk cache, which
+# needs vLLM's --allowed-local-media-path set to SM_PROXY_IMAGE_CACHE_DIR).
+IMAGE_PREFETCH = os.getenv('SM_PROXY_IMAGE_PREFETCH', 'false') == 'true'
+IMAGE_REFERENCE = os.getenv('SM_PROXY_IMAGE_REFERENCE', 'data')
+IMAGE_CACHE_DIR = os.getenv('SM_PROXY_IMAGE_CACHE_DIR', '/tmp/image-cache')
+IMAGE_CACHE_MEMORY_BYTES = int(os.getenv('SM_PROXY_IMAGE_CACHE_MEMORY_BYTES', 256 * 2**20))
+# 0 keeps the images in memory only
+IMAGE_CACHE_DISK_BYTES = int(os.getenv('SM_PROXY_IMAGE_CACHE_DISK_BYTES', 4 * 2**30))
+IMAGE_FETCH_PER_HOST = int(os.getenv('SM_PROXY_IMAGE_FETCH_PER_HOST', 8))
+IMAGE_FETCH_TIMEOUT_S = float(os.getenv('SM_PROXY_IMAGE_FETCH_TIMEOUT_S', 10))
+IMAGE_MAX_BYTES = int(os.getenv('SM_PROXY_IMAGE_MAX_BYTES', 20 * 2**20))
+# the same URL is downloaded again after this long, in case its content changed
+IMAGE_URL_TTL_S = float(os.getenv('SM_PROXY_IMAGE_URL_TTL_S', 3600))
+# The model whose latency the simulated engine has on INSTANCE_TYPE: a model directory, config.json
+# or Hugging Face model id, by default one shaped like Qwen2.5-VL-3B. SM_PROXY_SIM_<FIELD> variables
+# override the fields of engine_simulator.SimulatorConfig, e.g. SM_PROXY_SIM_TIME_SCALE=0.1.
+SIM_MODEL = os.getenv('SM_PROXY_SIM_MODEL')
+# the instance type simulated when INSTANCE_TYPE is unset or unknown
+SIM_DEFAULT_INSTANCE_TYPE = 'ml.g5.xlarge'
+
+# decoded by the fast path, see `parse_payload`
+PEEK_FIELDS = ("model", "stream")
 
 def get_num_gpus(instance_type):
     try:
@@ -32,38 +93,373 @@ def get_num_gpus(instance_type):
     except KeyError:
         raise ValueError(f"Instance type {instance_type} not found in the dictionary")
 
-def create_chat_completion_stub(request, payload):
-    # Stub function to replace vllm call
-    return {"message": "This is a stub response"}
+async def simulate(simulator: EngineSimulator, route: str, payload: dict) -> Response:
+    """ The response of the simulated engine, streamed token by token if requested. """
+    try:
+        completion = SimulatedCompletion(simulator, route, payload)
+        # before the headers are sent, so that a request that can never run is a 400 rather than a broken stream
+        sequence = completion.submit()
+    except (ValueError, KeyError, TypeError) as e:
+        # the error format of vLLM
+        return JSONResponse(content={"object": "error", "message": str(e), "type": "BadRequestError",
+                                     "param": None, "code": 400}, status_code=400)
+    if payload.get("stream") is True and route != "/v1/embeddings":
+        return StreamingResponse(completion.events(sequence), media_type="text/event-stream")
+    return JSONResponse(content=await completion.response(sequence))
+
+def select_route(payload: dict) -> str:
+    """ Pick the vLLM API from the shape of the OpenAI-format payload. """
+    if "messages" in payload:
+        return "/v1/chat/completions"
+    if "input" in payload:
+        return "/v1/embeddings"
+    if "prompt" in payload:
+        return "/v1/completions"
+    raise ValueError("Expected one of 'messages', 'prompt' or 'input' in the request")
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # One client per replica for the lifetime of the server keeps the connections to vLLM alive.
+    app.state.replicas = None
+    app.state.embedding_batcher = None
+    app.state.response_cache = ResponseCache(CACHE_MAX_BYTES, CACHE_TTL_S) if CACHE_MAX_BYTES > 0 else None
+    app.state.admission = None
+    app.state.ready = True
+    app.state.warmup = None
+    app.state.image_fetcher = None
+    app.state.simulator = None
+    if IMAGE_PREFETCH:
+        app.state.image_fetcher = ImageFetcher(
+            ImageCache(IMAGE_CACHE_DIR, IMAGE_CACHE_MEMORY_BYTES, IMAGE_CACHE_DISK_BYTES),
+            per_host=IMAGE_FETCH_PER_HOST, timeout=IMAGE_FETCH_TIMEOUT_S, max_bytes=IMAGE_MAX_BYTES,
+            url_ttl=IMAGE_URL_TTL_S, reference=IMAGE_REFERENCE)
+    if MAX_CONCURRENCY > 0:
+        app.state.admission = AdmissionController(MAX_CONCURRENCY, MAX_QUEUE, QUEUE_TIMEOUT_S)
+    if UPSTREAM_URL:
+        replicas = app.state.replicas = ReplicaPool(
+            [url.strip() for url in UPSTREAM_URL.split(",") if url.strip()],
+            pool_size=UPSTREAM_POOL_SIZE,
+            timeout=UPSTREAM_TIMEOUT,
+            prefix_affinity_chars=PREFIX_AFFINITY_CHARS,
+            max_imbalance=AFFINITY_MAX_IMBALANCE,
+            health_check_interval=HEALTH_CHECK_INTERVAL_S,
+        )
+        replicas.start()
+
+        async def send_embeddings(payload: dict) -> tuple[int, dict]:
+            replica = replicas.acquire()
+            try:
+                response = await replica.client.post("/v1/embeddings", json=payload)
+            except httpx.TransportError:
+                replicas.release(replica, failed=True)
+                raise
+            replicas.release(replica)
+            try:
+                return response.status_code, response.json()
+            except ValueError:
+                return response.status_code, {"error": response.text}
+
+        if EMBEDDING_BATCH_SIZE > 0:
+            app.state.embedding_batcher = EmbeddingBatcher(
+                send_embeddings, max_batch_size=EMBEDDING_BATCH_SIZE, max_wait=EMBEDDING_BATCH_WAIT_MS / 1000)
+
+        try:
+            warmup_payloads = parse_warmup_prompts(
+                WARMUP_PROMPTS, os.getenv('SM_VLLM_SERVED_MODEL_NAME') or os.getenv('SM_VLLM_MODEL'), select_route)
+        except ValueError as e:
+            sys.exit(f"Invalid SM_PROXY_WARMUP_PROMPTS: {e}")
+        if warmup_payloads:
+            app.state.ready = False
+            app.state.warmup = asyncio.create_task(run_warmup(app, warmup_payloads))
+    else:
+        overrides = {key: value for key, value in os.environ.items() if key.startswith("SM_PROXY_SIM_")}
+        instance_type = os.getenv('INSTANCE_TYPE')
+        if instance_type not in INSTANCE_TYPES:
+            print(f"No engine simulation for INSTANCE_TYPE {instance_type}, simulating {SIM_DEFAULT_INSTANCE_TYPE}",
+                  file=sys.stderr)
+            instance_type = SIM_DEFAULT_INSTANCE_TYPE
+        try:
+            sim_config = load_simulator_config(instance_type, SIM_MODEL, overrides)
+        except ValueError as e:
+            sys.exit(f"Invalid engine simulator configuration: {e}")
+        app.state.simulator = EngineSimulator(sim_config)
+        app.state.simulator.start()
+    yield
+    if app.state.warmup is not None:
+        app.state.warmup.cancel()
+    if app.state.replicas is not None:
+        await app.state.replicas.aclose()
+    if app.state.image_fetcher is not None:
+        await app.state.image_fetcher.aclose()
+    if app.state.simulator is not None:
+        await app.state.simulator.aclose()
+
+async def run_warmup(app: FastAPI, payloads: list[dict]):
+    try:
+        # every replica has its own caches and CUDA graphs to warm up
+        seconds = await asyncio.gather(*(
+            warm_up(replica.client, payloads, select_route, WARMUP_TIMEOUT_S) for replica in app.state.replicas.replicas))
+        print(f"Sent {len(payloads)} warmup requests in {max(seconds):.1f} s")
+    except Exception as e:
+        print(f"Warmup failed: {e!r}", file=sys.stderr)
+    finally:
+        # report ready anyway, /ping keeps checking the health of vLLM
+        app.state.ready = True
+
+async def forward(upstream: httpx.AsyncClient, route: str, body: bytes) -> Response:
+    """
+    Send the request body to vLLM as is. Server-sent events are passed through
+    chunk by chunk as they arrive, other responses are returned in one piece.
+    """
+    upstream_request = upstream.build_request(
+        "POST", route, content=body, headers={"Content-Type": "application/json"})
+    upstream_response = await upstream.send(upstream_request, stream=True)
+    media_type = upstream_response.headers.get("content-type", "application/json")
+    if media_type.startswith("text/event-stream"):
+        response = StreamingResponse(
+            upstream_response.aiter_raw(),
+            status_code=upstream_response.status_code,
+            media_type=media_type,
+        )
+        return call_on_close(response, upstream_response.aclose)
+    try:
+        content = await upstream_response.aread()
+    finally:
+        await upstream_response.aclose()
+    return Response(content=content, status_code=upstream_response.status_code, media_type=media_type)
+
+async def forward_to_replica(replicas: ReplicaPool, route: str, body: bytes, payload: dict) -> Response:
+    """
+    Forward the request to a replica picked by the pool. A replica refusing the
+    connection is taken out of rotation and the next one is tried, the request
+    never reached it.
+    """
+    for attempt in range(len(replicas.replicas)):
+        replica = replicas.acquire(payload)
+        try:
+            response = await forward(replica.client, route, body)
+        except httpx.ConnectError:
+            replicas.release(replica, failed=True)
+            if attempt == len(replicas.replicas) - 1:
+                raise
+            continue
+        except BaseException:
+            replicas.release(replica)
+            raise
+        if isinstance(response, StreamingResponse):
+            # hold the replica until the stream is over
+            response = call_on_close(response, lambda: replicas.release(replica))
+        else:
+            replicas.release(replica)
+        return response
 
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
+app.add_middleware(RequestMetricsMiddleware, emf=EMF_ENABLED)
 
 @app.get("/ping")
-def ping():
+async def ping(request: Request):
+    if not request.app.state.ready:
+        return JSONResponse(content={"error": "Warming up"}, status_code=status.HTTP_503_SERVICE_UNAVAILABLE)
+    admission = request.app.state.admission
+    if PING_REPORTS_OVERLOAD and admission is not None and admission.overloaded:
+        return JSONResponse(content={"error": "Overloaded"}, status_code=status.HTTP_503_SERVICE_UNAVAILABLE)
+    replicas = request.app.state.replicas
+    # not healthy until vLLM has loaded the model, with several replicas one is enough
+    if replicas is not None and not await replicas.check_health():
+        return JSONResponse(content={}, status_code=status.HTTP_503_SERVICE_UNAVAILABLE)
     return JSONResponse(content={}, status_code=status.HTTP_200_OK)
 
+@app.get("/metrics")
+def metrics():
+    return Response(content=generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
+async def read_body(request: Request) -> bytes:
+    """
+    The request body, decompressed as given by Content-Encoding or, through
+    SageMaker, by `content_encoding` in the custom attributes.
+    """
+    body = await request.body()
+    custom_attributes = request.headers.get(CUSTOM_ATTRIBUTES_HEADER)
+    encoding = request.headers.get("content-encoding") or get_custom_attribute(custom_attributes, "content_encoding")
+    if encoding is None or encoding.lower() == "identity":
+        return body
+    started = time.perf_counter()
+    decompressed = await decompress_async(body, encoding.lower(), MAX_REQUEST_BYTES)
+    record_compression("request", encoding.lower(), len(decompressed), len(body), time.perf_counter() - started)
+    return decompressed
+
+async def compress_response(request: Request, response: Response) -> Response:
+    """
+    Compress complete responses the client accepts compressed, by Accept-Encoding
+    or `accept_encoding` in the custom attributes. Streams are passed through as
+    they are, compressing them would hold back the tokens.
+    """
+    if COMPRESSION_MIN_BYTES <= 0 or isinstance(response, StreamingResponse):
+        return response
+    if len(response.body) < COMPRESSION_MIN_BYTES or "content-encoding" in response.headers:
+        return response
+    custom_attributes = request.headers.get(CUSTOM_ATTRIBUTES_HEADER)
+    attribute = get_custom_attribute(custom_attributes, "accept_encoding")
+    # the custom attributes list the encodings with spaces, commas separate the attributes
+    encoding = negotiate(attribute.replace(" ", ",")) if attribute else negotiate(request.headers.get("accept-encoding"))
+    if encoding is None:
+        return response
+    timing = getattr(request.state, "timing", None)
+    if timing is not None:
+        timing.prompt_tokens, timing.completion_tokens = parse_usage(response.body[-TAIL_BYTES:])
+        timing.uncompressed_bytes = len(response.body)
+    headers = {key: value for key, value in response.headers.items() if key != "content-length"}
+    if attribute:
+        headers[CUSTOM_ATTRIBUTES_HEADER] = f"content_encoding={encoding}"
+    else:
+        headers["Content-Encoding"] = encoding
+        headers["Vary"] = "Accept-Encoding"
+    started = time.perf_counter()
+    compressed = await compress_async(response.body, encoding)
+    record_compression("response", encoding, len(response.body), len(compressed), time.perf_counter() - started)
+    return Response(content=compressed, status_code=response.status_code, headers=headers,
+                    media_type=response.media_type)
+
+def parse_payload(body: bytes, full: bool = False) -> dict:
+    """
+    The request fields the proxy routes on. Unless `full`, only the top-level keys
+    are scanned and the PEEK_FIELDS decoded, the other values are left as
+    `RawValue`s: the body is forwarded as is, so a multi-MB image never has to
+    become Python objects.
+    """
+    payload = None if full else peek(body, PEEK_FIELDS)
+    if payload is None:
+        payload = loads(body)
+        if not isinstance(payload, dict):
+            raise ValueError("The request must be a JSON object")
+    return payload
+
+def needs_full_payload(app: FastAPI, route: str) -> bool:
+    """ The features reading the prompt or the parameters, rather than just the route. """
+    replicas = app.state.replicas
+    return (app.state.response_cache is not None
+            or app.state.simulator is not None
+            or (app.state.embedding_batcher is not None and route == "/v1/embeddings")
+            or (replicas is not None and replicas.prefix_affinity_chars > 0 and len(replicas.replicas) > 1))
+
 @app.post("/invocations")
 async def invocations(request: Request):
+    return await compress_response(request, await handle_invocation(request))
+
+async def handle_invocation(request: Request) -> Response:
+    # set by RequestMetricsMiddleware
+    timing = getattr(request.state, "timing", None)
     try:
-        payload = await request.json()
-        # Simulate request validation
-        if "message" not in payload:
-            raise ValidationError("Invalid request format")
-    except ValidationError as e:
+        body = await read_body(request)
+    except UnsupportedEncoding as e:
+        return JSONResponse(content={"error": "Unsupported content encoding", "details": str(e)},
+                            status_code=status.HTTP_415_UNSUPPORTED_MEDIA_TYPE)
+    except BodyTooLarge as e:
+        return JSONResponse(content={"error": "Request too large", "details": str(e)},
+                            status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
+    except ValueError as e:
+        return JSONResponse(content={"error": "Invalid request body", "details": str(e)}, status_code=400)
+    fetcher = request.app.state.image_fetcher
+    try:
+        payload = parse_payload(body)
+        route = select_route(payload)
+        prefetch_images = (fetcher is not None and route == "/v1/chat/completions"
+                           and fetcher.has_remote_images(body))
+        if prefetch_images or needs_full_payload(request.app, route):
+            payload = parse_payload(body, full=True)
+    except ValueError as e:
+        # json.JSONDecodeError is a ValueError too
         return JSONResponse(content={"error": "Invalid request format", "details": str(e)}, status_code=400)
+    if timing is not None:
+        timing.body_parse = time.perf_counter() - timing.start
+        timing.route = route
+        timing.request_bytes = len(body)
+
+    # blobs of file:// image URLs, kept on disk until vLLM has read them
+    pinned_images: list[str] = []
+    if prefetch_images:
+        try:
+            rewritten, pinned_images = await fetcher.rewrite(payload)
+            if rewritten:
+                body = dumps(payload)
+        except ImageFetchError as e:
+            return JSONResponse(content={"error": "Image fetch failed", "details": str(e)}, status_code=400)
+
+    replicas = request.app.state.replicas
+
+    async def send_upstream() -> Response:
+        if replicas is None:
+            return await simulate(request.app.state.simulator, route, payload)
+        try:
+            batcher = request.app.state.embedding_batcher
+            if batcher is not None and route == "/v1/embeddings" and batcher.accepts(payload):
+                status_code, content = await batcher.submit(payload)
+                return JSONResponse(content=content, status_code=status_code)
+            return await forward_to_replica(replicas, route, body, payload)
+        except httpx.HTTPError as e:
+            return JSONResponse(content={"error": "Upstream request failed", "details": str(e)}, status_code=502)
 
-    response = create_chat_completion_stub(request, payload)
-    return JSONResponse(content=response)
+    async def call_upstream() -> Response:
+        admission = request.app.state.admission
+        if admission is None:
+            if timing is not None:
+                timing.upstream_start = time.perf_counter()
+            return await send_upstream()
+        queued = time.perf_counter()
+        try:
+            await admission.acquire(parse_queue_timeout(request.headers.get(CUSTOM_ATTRIBUTES_HEADER)))
+            if timing is not None:
+                timing.upstream_start = time.perf_counter()
+                timing.queue = timing.upstream_start - queued
+        except Rejected as e:
+            # SageMaker returns this to the caller as a ModelError (status 424) with OriginalStatusCode
+            # 429, which the AWS SDKs don't retry: clients check OriginalStatusCode, see is_retryable
+            return JSONResponse(content={"error": "Too many requests", "details": str(e)},
+                                status_code=status.HTTP_429_TOO_MANY_REQUESTS, headers={"Retry-After": "1"})
+        try:
+            response = await send_upstream()
+        except BaseException:
+            admission.release()
+            raise
+        if isinstance(response, StreamingResponse):
+            # hold the admission slot until the stream is over
+            response = call_on_close(response, admission.release)
+        else:
+            admission.release()
+        return response
+
+    cache = request.app.state.response_cache
+    cache_key = cache.key_for(route, payload) if cache is not None else None
+    try:
+        if cache_key is not None:
+            response = await cache.handle(cache_key, payload, call_upstream)
+        else:
+            response = await call_upstream()
+    except BaseException:
+        if pinned_images:
+            fetcher.unpin(pinned_images)
+        raise
+    if pinned_images:
+        if isinstance(response, StreamingResponse):
+            response = call_on_close(response, lambda: fetcher.unpin(pinned_images))
+        else:
+            fetcher.unpin(pinned_images)
+    return response
 
 def start_api_server():
     host = os.getenv('API_HOST', '0.0.0.0')
     port = int(os.getenv('API_PORT', 8000))
     instance_type = os.getenv('INSTANCE_TYPE')
-    if instance_type is None:
-        sys.exit("INSTANCE_TYPE must be provided")
-
-    num_gpus = get_num_gpus(instance_type)
-    print(f"Starting server with {num_gpus} GPUs")
+    if UPSTREAM_URL:
+        if instance_type is None:
+            sys.exit("INSTANCE_TYPE must be provided")
+        num_gpus = get_num_gpus(instance_type)
+        print(f"Starting server with {num_gpus} GPUs")
+    else:
+        # the simulated engine falls back to SIM_DEFAULT_INSTANCE_TYPE, see `lifespan`
+        print("Starting server with a simulated engine")
+    if METRICS_PORT:
+        start_http_server(METRICS_PORT)
 
     uvicorn.run(app, host=host, port=port, log_level="info")
 
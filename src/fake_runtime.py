@@ -0,0 +1,172 @@
+import argparse
+import hmac
+import random
+import re
+import struct
+import zlib
+from contextlib import asynccontextmanager
+
+import httpx
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+from botocore.auth import SigV4Auth  # type: ignore
+from botocore.awsrequest import AWSRequest  # type: ignore
+from botocore.credentials import Credentials  # type: ignore
+from starlette.background import BackgroundTask
+
+from compression import CUSTOM_ATTRIBUTES_HEADER
+from sigv4_client import INFERENCE_COMPONENT_HEADER
+
+# A stand-in for the SageMaker runtime API in front of a container, for testing
+# clients (the gateway, sigv4_client) without an endpoint. Requests are forwarded
+# to the container's /invocations; streams come back as PayloadPart events of the
+# `application/vnd.amazon.eventstream` format, split at arbitrary positions like
+# SageMaker does. Signatures are recomputed with botocore for the test credentials
+# below and must match, so run the clients with those as AWS_ACCESS_KEY_ID and
+# AWS_SECRET_ACCESS_KEY.
+
+# the example credentials of the AWS SigV4 test suite
+TEST_ACCESS_KEY_ID = "AKIDEXAMPLE"
+TEST_SECRET_ACCESS_KEY = "wJalrXUtnFEMI/K7MDENG+bPxRfiCYEXAMPLEKEY"
+AUTHORIZATION = re.compile(r"AWS4-HMAC-SHA256 Credential=(?P<access_key>[^/]+)/(?P<date>\d{8})/(?P<region>[^/]+)/"
+                           r"(?P<service>[^/]+)/aws4_request, SignedHeaders=(?P<signed_headers>[^,]+), "
+                           r"Signature=(?P<signature>[0-9a-f]{64})")
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    app.state.container = httpx.AsyncClient(base_url=app.state.container_url, timeout=600,
+                                            limits=httpx.Limits(max_connections=1000, max_keepalive_connections=1000))
+    yield
+    await app.state.container.aclose()
+
+
+app = FastAPI(lifespan=lifespan)
+app.state.container_url = "http://127.0.0.1:8080"
+# PayloadParts are split to at most this many bytes, at random positions
+app.state.max_part_bytes = 64
+# fraction of the requests rejected with ThrottlingException, as when exceeding the endpoint's quota
+app.state.throttle_fraction = 0.0
+app.state.credentials = Credentials(TEST_ACCESS_KEY_ID, TEST_SECRET_ACCESS_KEY)
+
+
+def encode_event(headers: dict[str, str], payload: bytes) -> bytes:
+    """ One message of the AWS event stream encoding, with string headers only. """
+    encoded_headers = b""
+    for name, value in headers.items():
+        name, value = name.encode("utf-8"), value.encode("utf-8")
+        # header value type 7 is a string
+        encoded_headers += struct.pack("!B", len(name)) + name + b"\x07" + struct.pack("!H", len(value)) + value
+    prelude = struct.pack("!II", 12 + len(encoded_headers) + len(payload) + 4, len(encoded_headers))
+    message = prelude + struct.pack("!I", zlib.crc32(prelude)) + encoded_headers + payload
+    return message + struct.pack("!I", zlib.crc32(message))
+
+
+def payload_part(data: bytes) -> bytes:
+    return encode_event({":event-type": "PayloadPart", ":content-type": "application/octet-stream",
+                         ":message-type": "event"}, data)
+
+
+def runtime_error(status_code: int, error_type: str, message: str, **extra) -> JSONResponse:
+    return JSONResponse(status_code=status_code, headers={"x-amzn-ErrorType": f"{error_type}:"},
+                        content={"message": message, **extra})
+
+
+def model_error(status_code: int, content: bytes) -> JSONResponse:
+    """ What SageMaker returns when the container answers with an error status. """
+    message = content.decode("utf-8", "replace")
+    return runtime_error(
+        424, "ModelError",
+        f"Received client error ({status_code}) from primary with message \"{message}\".",
+        ErrorCode="CLIENT_ERROR_FROM_MODEL", OriginalStatusCode=status_code, OriginalMessage=message)
+
+
+def expected_signature(request: Request, body: bytes, credentials: Credentials, region: str, service: str,
+                       signed_headers: list[str]) -> str:
+    """ The signature botocore computes for the signed headers of `request` at the time of its X-Amz-Date. """
+    headers = {name: request.headers[name] for name in signed_headers if name in request.headers}
+    aws_request = AWSRequest(method=request.method, url=str(request.url), data=body, headers=headers)
+    aws_request.context["timestamp"] = request.headers.get("x-amz-date", "")
+    auth = SigV4Auth(credentials, service, region)
+    return auth.signature(auth.string_to_sign(aws_request, auth.canonical_request(aws_request)), aws_request)
+
+
+async def check_request(request: Request) -> JSONResponse | None:
+    authorization = AUTHORIZATION.fullmatch(request.headers.get("authorization", ""))
+    if authorization is None:
+        return runtime_error(403, "MissingAuthenticationTokenException", "Missing Authentication Token")
+    credentials = request.app.state.credentials
+    if authorization["access_key"] != credentials.access_key:
+        return runtime_error(403, "UnrecognizedClientException", "The security token included in the request is invalid.")
+    signature = expected_signature(request, await request.body(), credentials, authorization["region"],
+                                   authorization["service"], authorization["signed_headers"].split(";"))
+    if authorization["service"] != "sagemaker" or not hmac.compare_digest(signature, authorization["signature"]):
+        return runtime_error(403, "InvalidSignatureException",
+                             "The request signature we calculated does not match the signature you provided.")
+    if random.random() < request.app.state.throttle_fraction:
+        return runtime_error(400, "ThrottlingException", "Rate exceeded")
+    return None
+
+
+def container_headers(request: Request) -> dict[str, str]:
+    headers = {"Content-Type": request.headers.get("content-type", "application/json")}
+    for name in (CUSTOM_ATTRIBUTES_HEADER, INFERENCE_COMPONENT_HEADER):
+        if name in request.headers:
+            headers[name] = request.headers[name]
+    return headers
+
+
+@app.post("/endpoints/{endpoint_name}/invocations")
+async def invocations(endpoint_name: str, request: Request):
+    if (error := await check_request(request)) is not None:
+        return error
+    response = await request.app.state.container.post(
+        "/invocations", content=await request.body(), headers=container_headers(request))
+    if response.is_error:
+        return model_error(response.status_code, response.content)
+    headers = {}
+    if CUSTOM_ATTRIBUTES_HEADER in response.headers:
+        headers[CUSTOM_ATTRIBUTES_HEADER] = response.headers[CUSTOM_ATTRIBUTES_HEADER]
+    return Response(content=response.content, headers=headers,
+                    media_type=response.headers.get("content-type", "application/json"))
+
+
+@app.post("/endpoints/{endpoint_name}/invocations-response-stream")
+async def invocations_response_stream(endpoint_name: str, request: Request):
+    if (error := await check_request(request)) is not None:
+        return error
+    container = request.app.state.container
+    response = await container.send(container.build_request(
+        "POST", "/invocations", content=await request.body(), headers=container_headers(request)), stream=True)
+    if response.is_error:
+        content = await response.aread()
+        await response.aclose()
+        return model_error(response.status_code, content)
+
+    async def events():
+        max_part_bytes = request.app.state.max_part_bytes
+        async for chunk in response.aiter_raw():
+            while chunk:
+                size = random.randint(1, max_part_bytes)
+                yield payload_part(chunk[:size])
+                chunk = chunk[size:]
+
+    return StreamingResponse(events(), media_type="application/vnd.amazon.eventstream",
+                             background=BackgroundTask(response.aclose))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Stand-in for the SageMaker runtime API in front of a container.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8090)
+    parser.add_argument('--container-url', default='http://127.0.0.1:8080', help='The container serving /invocations')
+    parser.add_argument('--max-part-bytes', type=int, default=64, help='Max size of a streamed PayloadPart')
+    parser.add_argument('--throttle-fraction', type=float, default=0.0,
+                        help='Fraction of the requests rejected with ThrottlingException')
+    args = parser.parse_args()
+    app.state.container_url = args.container_url
+    app.state.max_part_bytes = args.max_part_bytes
+    app.state.throttle_fraction = args.throttle_fraction
+    # longer than the clients' keep-alive, or they race the server closing idle connections
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning", timeout_keep_alive=60)
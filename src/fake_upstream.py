@@ -0,0 +1,144 @@
+import argparse
+import asyncio
+import json
+import random
+import threading
+import time
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+from starlette.requests import ClientDisconnect
+
+# A minimal stand-in for the vLLM OpenAI-compatible server, used by the
+# benchmarks to exercise the serving layer without a GPU. It can also replace
+# the engine in the serve script (SM_ENGINE_COMMAND), vLLM arguments other than
+# --host and --port are ignored.
+
+app = FastAPI()
+# seconds between two streamed tokens
+app.state.token_delay = 0.0
+app.state.num_tokens = 16
+app.state.requests = 0
+# fraction of the requests delayed by `slow_delay` seconds before the first token,
+# like a replica stuck behind a long prefill or a garbage collection
+app.state.slow_fraction = 0.0
+app.state.slow_delay = 1.0
+# fraction of the requests answered with 429
+app.state.throttle_fraction = 0.0
+
+
+def usage(prompt_tokens: int, completion_tokens: int) -> dict:
+    return {
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "total_tokens": prompt_tokens + completion_tokens,
+    }
+
+
+async def injected_fault() -> JSONResponse | None:
+    """ The throttling error or slow start injected into a request, if any. """
+    if random.random() < app.state.throttle_fraction:
+        return JSONResponse(status_code=429, headers={"Retry-After": "0"},
+                            content={"error": {"message": "Too many requests", "type": "throttled"}})
+    if random.random() < app.state.slow_fraction:
+        await asyncio.sleep(app.state.slow_delay)
+    return None
+
+
+async def read_payload(request: Request) -> dict | None:
+    """ None when the client is gone before sending the body, e.g. a cancelled hedge. """
+    try:
+        return await request.json()
+    except ClientDisconnect:
+        return None
+
+
+@app.get("/health")
+async def health():
+    return JSONResponse(content={})
+
+
+@app.post("/v1/chat/completions")
+@app.post("/v1/completions")
+async def completions(request: Request):
+    payload = await read_payload(request)
+    request.app.state.requests += 1
+    if payload is None:
+        return Response(status_code=499)
+    if (fault := await injected_fault()) is not None:
+        return fault
+    chat = request.url.path.endswith("/chat/completions")
+    num_tokens = min(payload.get("max_tokens") or app.state.num_tokens, app.state.num_tokens)
+
+    def choice(text: str, final: bool) -> dict:
+        if not chat:
+            return {"index": 0, "text": text, "finish_reason": "length" if final else None}
+        if final:
+            return {"index": 0, "message": {"role": "assistant", "content": text}, "finish_reason": "length"}
+        return {"index": 0, "delta": {"content": text}, "finish_reason": None}
+
+    if not payload.get("stream"):
+        await asyncio.sleep(app.state.token_delay * num_tokens)
+        return JSONResponse(content={
+            "id": "fake", "object": "chat.completion" if chat else "text_completion",
+            "created": int(time.time()), "model": payload.get("model", "fake"),
+            "choices": [choice(" tok" * num_tokens, final=True)],
+            "usage": usage(8, num_tokens),
+        })
+
+    async def events():
+        for i in range(num_tokens):
+            await asyncio.sleep(app.state.token_delay)
+            chunk = {"id": "fake", "object": "chat.completion.chunk", "choices": [choice(" tok", final=False)]}
+            yield b"data: " + json.dumps(chunk).encode() + b"\n\n"
+        if (payload.get("stream_options") or {}).get("include_usage"):
+            chunk = {"id": "fake", "object": "chat.completion.chunk", "choices": [], "usage": usage(8, num_tokens)}
+            yield b"data: " + json.dumps(chunk).encode() + b"\n\n"
+        yield b"data: [DONE]\n\n"
+
+    return StreamingResponse(events(), media_type="text/event-stream")
+
+
+@app.post("/v1/embeddings")
+async def embeddings(request: Request):
+    payload = await read_payload(request)
+    request.app.state.requests += 1
+    if payload is None:
+        return Response(status_code=499)
+    if (fault := await injected_fault()) is not None:
+        return fault
+    inputs = payload["input"]
+    if isinstance(inputs, str):
+        inputs = [inputs]
+    data = [{"object": "embedding", "index": i, "embedding": [float(len(text)), 0.0, 1.0]}
+            for i, text in enumerate(inputs)]
+    return JSONResponse(content={"object": "list", "data": data, "model": payload.get("model", "fake"),
+                                 "usage": usage(len(inputs), 0)})
+
+
+def run_in_thread(asgi_app, port: int, host: str = "127.0.0.1") -> uvicorn.Server:
+    """ Start `asgi_app` in a daemon thread and wait until it accepts connections. """
+    server = uvicorn.Server(uvicorn.Config(asgi_app, host=host, port=port, log_level="warning"))
+    threading.Thread(target=server.run, daemon=True).start()
+    while not server.started:
+        time.sleep(0.01)
+    return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Stand-in for the vLLM OpenAI-compatible server.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument('--token-delay', type=float, default=0.0)
+    parser.add_argument('--num-tokens', type=int, default=16)
+    parser.add_argument('--slow-fraction', type=float, default=0.0, help='Fraction of the requests delayed')
+    parser.add_argument('--slow-delay', type=float, default=1.0, help='Seconds a slow request is delayed')
+    parser.add_argument('--throttle-fraction', type=float, default=0.0, help='Fraction of the requests answered with 429')
+    args, _ = parser.parse_known_args()
+    app.state.token_delay = args.token_delay
+    app.state.num_tokens = args.num_tokens
+    app.state.slow_fraction = args.slow_fraction
+    app.state.slow_delay = args.slow_delay
+    app.state.throttle_fraction = args.throttle_fraction
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
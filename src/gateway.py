@@ -0,0 +1,197 @@
+import argparse
+import asyncio
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Callable
+
+import httpx
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+
+from compression import ENCODINGS
+from invocation_policy import InvocationPolicy
+from json_codec import dumps, loads, peek
+from sigv4_client import INFERENCE_COMPONENT_HEADER, AsyncSageMakerRuntimeClient
+from sse_decoder import SSEFramer
+
+# An OpenAI-compatible server on localhost in front of a SageMaker endpoint, so
+# that OpenAI SDKs and tools can use the endpoint with
+# `base_url="http://127.0.0.1:8088/v1"`. Requests are signed and sent over one
+# pool of connections to the SageMaker runtime; streams are re-framed from
+# PayloadParts, which split events at arbitrary positions, into whole SSE events.
+
+# The field the proxy in the container routes on, see `select_route` in example_serving.py
+ROUTE_FIELDS = {"chat/completions": "messages", "completions": "prompt", "embeddings": "input"}
+# SageMaker runtime errors as the statuses OpenAI clients know how to handle, e.g. retry
+ERROR_STATUSES = {"ThrottlingException": 429, "ServiceUnavailable": 503, "ModelNotReadyException": 503,
+                  "ValidationError": 400, "AccessDeniedException": 403}
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    app.state.client = AsyncSageMakerRuntimeClient(
+        region=app.state.region, profile_name=app.state.profile, endpoint_url=app.state.runtime_url,
+        pool_size=app.state.pool_size, compression=app.state.compression, policy=app.state.policy)
+    # requests beyond the pool wait here: httpx rescans its whole queue of waiting requests
+    # on every read of every connection, which costs more than the streams themselves
+    app.state.slots = asyncio.Semaphore(app.state.pool_size)
+    yield
+    await app.state.client.aclose()
+
+
+app = FastAPI(lifespan=lifespan)
+app.state.endpoint_name = None
+app.state.inference_component = None
+app.state.region = None
+app.state.profile = None
+# the SageMaker runtime URL, e.g. that of src/fake_runtime.py, by default the one of the region
+app.state.runtime_url = None
+# models listed by /v1/models, the endpoint serves a single model whatever the request says
+app.state.models = []
+app.state.pool_size = 100
+app.state.compression = None
+app.state.policy = None
+
+
+def error_response(status_code: int, message: str, error_type: str, code: str | None = None) -> JSONResponse:
+    """ An error in the format of the OpenAI API. """
+    return JSONResponse(status_code=status_code,
+                        content={"error": {"message": message, "type": error_type, "param": None, "code": code}})
+
+
+def upstream_error(response: httpx.Response) -> Response:
+    """
+    The OpenAI error for a failed invocation. Errors of the container (ModelError)
+    are returned with the container's status and body.
+    """
+    try:
+        content = loads(response.content)
+    except ValueError:
+        content = {"message": response.text}
+    error_type = response.headers.get("x-amzn-ErrorType", "").split(":")[0]
+    if error_type == "ModelError" and "OriginalStatusCode" in content:
+        message = content.get("OriginalMessage") or ""
+        try:
+            original = loads(message)
+        except ValueError:
+            original = None
+        if isinstance(original, dict) and isinstance(original.get("error"), dict):
+            return JSONResponse(status_code=content["OriginalStatusCode"], content=original)
+        if isinstance(original, dict):
+            # the proxy's errors: {"error": "...", "details": "..."}
+            message = ": ".join(str(original[key]) for key in ("error", "details") if key in original) or message
+        return error_response(content["OriginalStatusCode"], message, "model_error")
+    status_code = ERROR_STATUSES.get(error_type, response.status_code)
+    return error_response(status_code, content.get("message") or content.get("Message") or response.text,
+                          error_type or "sagemaker_error", error_type or None)
+
+
+def parse_request(body: bytes, route: str) -> dict:
+    """ The top-level fields of the request, the body is forwarded as it is. """
+    payload = peek(body, ("stream",))
+    if payload is None:
+        payload = loads(body)
+        if not isinstance(payload, dict):
+            raise ValueError("The request must be a JSON object")
+    if ROUTE_FIELDS[route] not in payload:
+        raise ValueError(f"'{ROUTE_FIELDS[route]}' is a required property")
+    return payload
+
+
+async def reframed(first: bytes, parts: AsyncIterator[bytes], release: Callable[[], None]) -> AsyncIterator[bytes]:
+    """ Whole SSE events from the PayloadParts, an error event if the stream fails midway. """
+    framer = SSEFramer()
+    try:
+        if events := framer.feed(first):
+            yield events
+        async for part in parts:
+            if events := framer.feed(part):
+                yield events
+        if rest := framer.flush():
+            yield rest
+    except (httpx.HTTPError, RuntimeError) as e:
+        # the status is already sent, report the error the way OpenAI streams do
+        yield b"data: " + dumps({"error": {"message": str(e), "type": "stream_error", "param": None,
+                                           "code": None}}) + b"\n\n"
+    finally:
+        # also when the client disconnects: the connection to SageMaker is closed
+        await parts.aclose()
+        release()
+
+
+@app.get("/health")
+async def health():
+    return JSONResponse(content={})
+
+
+@app.get("/v1/models")
+async def models(request: Request):
+    return JSONResponse(content={"object": "list", "data": [
+        {"id": model, "object": "model", "created": 0, "owned_by": "sagemaker"} for model in request.app.state.models
+    ]})
+
+
+@app.post("/v1/chat/completions")
+@app.post("/v1/completions")
+@app.post("/v1/embeddings")
+async def invoke(request: Request):
+    state = request.app.state
+    route = request.url.path.removeprefix("/v1/")
+    body = await request.body()
+    try:
+        payload = parse_request(body, route)
+    except ValueError as e:
+        return error_response(400, str(e), "invalid_request_error")
+    headers = {INFERENCE_COMPONENT_HEADER: state.inference_component} if state.inference_component else {}
+
+    if payload.get("stream") is not True:
+        try:
+            async with state.slots:
+                response = await state.client.invoke(state.endpoint_name, body, headers=headers)
+        except httpx.HTTPStatusError as e:
+            return upstream_error(e.response)
+        except httpx.TransportError as e:
+            return error_response(502, f"SageMaker runtime unreachable: {e!r}", "api_connection_error")
+        return Response(content=response.content, media_type=response.headers.get("content-type", "application/json"))
+
+    await state.slots.acquire()
+    parts = state.client.invoke_stream(state.endpoint_name, body, headers=headers)
+    try:
+        # the first part tells whether the endpoint accepted the request, errors get their status
+        first = await anext(parts, b"")
+    except BaseException as e:
+        state.slots.release()
+        if isinstance(e, httpx.HTTPStatusError):
+            return upstream_error(e.response)
+        if isinstance(e, httpx.TransportError):
+            return error_response(502, f"SageMaker runtime unreachable: {e!r}", "api_connection_error")
+        if isinstance(e, RuntimeError):
+            return error_response(502, str(e), "stream_error")
+        raise
+    return StreamingResponse(reframed(first, parts, state.slots.release), media_type="text/event-stream")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='OpenAI-compatible server in front of a SageMaker endpoint.')
+    parser.add_argument('--endpoint-name', required=True, help='The SageMaker endpoint')
+    parser.add_argument('--inference-component', default=None, help='The inference component of endpoints created with --scale-to-zero')
+    parser.add_argument('--region', default=None, help='The region of the endpoint, by default that of the AWS profile')
+    parser.add_argument('--profile', default=None, help='The AWS profile, by default the standard credential chain')
+    parser.add_argument('--runtime-url', default=None, help='The SageMaker runtime URL, e.g. of src/fake_runtime.py')
+    parser.add_argument('--model', action='append', default=[], help='Model listed by /v1/models, can be repeated')
+    parser.add_argument('--pool-size', type=int, default=100, help='Connections to the SageMaker runtime, streams hold one each')
+    parser.add_argument('--compression', choices=ENCODINGS, default=None, help='Compress the request bodies')
+    parser.add_argument('--hedge', action='store_true', help='Hedge slow non-streaming requests and retry throttling')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8088)
+    args = parser.parse_args()
+    app.state.endpoint_name = args.endpoint_name
+    app.state.inference_component = args.inference_component
+    app.state.region = args.region
+    app.state.profile = args.profile
+    app.state.runtime_url = args.runtime_url
+    app.state.models = args.model
+    app.state.pool_size = args.pool_size
+    app.state.compression = args.compression
+    app.state.policy = InvocationPolicy() if args.hedge else None
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
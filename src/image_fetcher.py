@@ -0,0 +1,394 @@
+import asyncio
+import base64
+import hashlib
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+from typing import Any
+
+import httpx
+from prometheus_client import Counter, Gauge, Histogram
+
+from request_metrics import LATENCY_BUCKETS
+
+IMAGE_REQUESTS = Counter(
+    "proxy_image_requests_total",
+    "Remote images by result: memory or disk (cache hits), coalesced with an in-flight fetch, fetched or error",
+    ["result"])
+IMAGE_FETCH_SECONDS = Histogram("proxy_image_fetch_seconds", "Time to download a remote image", buckets=LATENCY_BUCKETS)
+IMAGE_FETCH_BYTES = Counter("proxy_image_fetch_bytes_total", "Bytes of the downloaded images")
+IMAGE_PREFETCH_SECONDS = Histogram(
+    "proxy_image_prefetch_seconds", "Time to resolve all the remote images of a request", buckets=LATENCY_BUCKETS)
+IMAGE_CACHE_BYTES = Gauge("proxy_image_cache_bytes", "Size of the cached images", ["tier"])
+
+# Cheap test on the raw body before decoding it: is there a remote URL at all?
+REMOTE_URL = re.compile(rb'"(?:url|image_url)"\s*:\s*"https?://')
+# File signatures, for servers answering with a generic Content-Type
+SIGNATURES = ((b"\xff\xd8\xff", "image/jpeg"), (b"\x89PNG\r\n\x1a\n", "image/png"), (b"GIF8", "image/gif"),
+              (b"BM", "image/bmp"))
+
+
+class ImageFetchError(Exception):
+    pass
+
+
+@dataclass(frozen=True)
+class CachedImage:
+    digest: str
+    mime_type: str
+    size: int
+
+
+def sniff_mime_type(data: bytes, content_type: str | None) -> str:
+    content_type = (content_type or "").split(";")[0].strip().lower()
+    if content_type.startswith("image/"):
+        return content_type
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "image/webp"
+    for signature, mime_type in SIGNATURES:
+        if data.startswith(signature):
+            return mime_type
+    raise ImageFetchError(f"Not an image: {content_type or 'no content type'}")
+
+
+class ImageCache:
+    """
+    Images by the SHA-256 of their content, in memory and on local disk, each tier
+    an LRU bounded by its total size. The same image behind several URLs is stored
+    once. Blobs evicted from memory stay on disk. The disk tier is rebuilt from the
+    directory on start, oldest files first, so that it stays within its size across
+    restarts. Pinned blobs, whose file:// URLs vLLM is yet to read, are not evicted
+    from disk until unpinned. Thread-safe; the methods block on disk I/O, the
+    fetcher calls them in a thread.
+    """
+
+    def __init__(self, directory: str | None, memory_bytes: int, disk_bytes: int):
+        self.directory = directory if directory and disk_bytes > 0 else None
+        self.memory_bytes = memory_bytes
+        self.disk_bytes = disk_bytes
+        self.memory_size = 0
+        self.disk_size = 0
+        self._memory: OrderedDict[str, bytes] = OrderedDict()
+        # digest -> file size
+        self._disk: OrderedDict[str, int] = OrderedDict()
+        # digest -> number of pins
+        self._pinned: dict[str, int] = {}
+        self._lock = threading.Lock()
+        if self.directory is not None:
+            os.makedirs(self.directory, exist_ok=True)
+            self._load_directory()
+
+    def _load_directory(self):
+        files = []
+        for entry in os.scandir(self.directory):
+            if not entry.is_file():
+                continue
+            if entry.name.endswith(".tmp"):
+                # left by a crash while writing
+                os.remove(entry.path)
+                continue
+            stat = entry.stat()
+            files.append((stat.st_mtime, entry.name, stat.st_size))
+        with self._lock:
+            for _, digest, size in sorted(files):
+                self._disk[digest] = size
+                self.disk_size += size
+            self._evict_disk()
+
+    def path(self, digest: str) -> str | None:
+        """ The file of the blob, None without the disk tier. """
+        return os.path.join(self.directory, digest) if self.directory is not None else None
+
+    def on_disk(self, digest: str) -> bool:
+        with self._lock:
+            if digest not in self._disk:
+                return False
+            self._disk.move_to_end(digest)
+            return True
+
+    def pin(self, digest: str) -> bool:
+        """ Keep the file of the blob until `unpin`, False if it isn't on disk. """
+        with self._lock:
+            if digest not in self._disk:
+                return False
+            self._disk.move_to_end(digest)
+            self._pinned[digest] = self._pinned.get(digest, 0) + 1
+            return True
+
+    def unpin(self, digests: list[str]):
+        if not digests:
+            return
+        with self._lock:
+            for digest in digests:
+                self._pinned[digest] -= 1
+                if not self._pinned[digest]:
+                    del self._pinned[digest]
+            self._evict_disk()
+
+    def get(self, digest: str) -> tuple[bytes, str] | None:
+        """ The content and the tier it came from, memory or disk. """
+        with self._lock:
+            data = self._memory.get(digest)
+            if data is not None:
+                self._memory.move_to_end(digest)
+                return data, "memory"
+            if digest not in self._disk:
+                return None
+        try:
+            with open(self.path(digest), "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            # evicted meanwhile
+            return None
+        with self._lock:
+            if digest in self._disk:
+                self._disk.move_to_end(digest)
+            self._put_memory(digest, data)
+        return data, "disk"
+
+    def put(self, data: bytes) -> str:
+        digest = hashlib.sha256(data).hexdigest()
+        with self._lock:
+            self._put_memory(digest, data)
+            if digest in self._disk:
+                self._disk.move_to_end(digest)
+                return digest
+        if self.directory is None or len(data) > self.disk_bytes:
+            return digest
+        # written next to the final name and renamed, a crash never leaves a partial blob
+        path = self.path(digest)
+        temporary = f"{path}.{threading.get_ident()}.tmp"
+        with open(temporary, "wb") as f:
+            f.write(data)
+        os.replace(temporary, path)
+        with self._lock:
+            if digest not in self._disk:
+                self._disk[digest] = len(data)
+                self.disk_size += len(data)
+                self._evict_disk()
+        return digest
+
+    def _put_memory(self, digest: str, data: bytes):
+        if len(data) > self.memory_bytes:
+            return
+        if digest not in self._memory:
+            self._memory[digest] = data
+            self.memory_size += len(data)
+        self._memory.move_to_end(digest)
+        while self.memory_size > self.memory_bytes:
+            _, evicted = self._memory.popitem(last=False)
+            self.memory_size -= len(evicted)
+        IMAGE_CACHE_BYTES.labels("memory").set(self.memory_size)
+
+    def _evict_disk(self):
+        if self.disk_size > self.disk_bytes:
+            for digest in list(self._disk):
+                if self.disk_size <= self.disk_bytes:
+                    break
+                if digest in self._pinned:
+                    continue
+                self.disk_size -= self._disk.pop(digest)
+                try:
+                    os.remove(self.path(digest))
+                except FileNotFoundError:
+                    pass
+        IMAGE_CACHE_BYTES.labels("disk").set(self.disk_size)
+
+
+class ImageFetcher:
+    """
+    Resolves the remote `image_url`s of chat requests before they are forwarded,
+    so that vLLM doesn't download them one after another inside the request. The
+    images of a request are fetched concurrently over one pool of connections,
+    with at most `per_host` downloads per host at a time; concurrent requests for
+    the same URL share one download.
+
+    URLs map to the content for `url_ttl` seconds, then they are fetched again;
+    the content itself is kept until evicted. The URLs are replaced by data URLs,
+    or with `reference="file"` by file:// URLs of the disk tier, which vLLM reads
+    when started with `--allowed-local-media-path` set to the cache directory.
+    """
+
+    def __init__(self, cache: ImageCache, per_host: int = 8, max_connections: int = 64, timeout: float = 10,
+                 max_bytes: int = 20 * 2**20, url_ttl: float = 3600, max_urls: int = 100_000,
+                 reference: str = "data"):
+        if reference not in ("data", "file"):
+            raise ValueError(f"Unknown image reference {reference}, expected data or file")
+        if reference == "file" and cache.directory is None:
+            raise ValueError("File references need the disk tier of the image cache")
+        self.cache = cache
+        self.per_host = per_host
+        self.max_bytes = max_bytes
+        self.url_ttl = url_ttl
+        self.max_urls = max_urls
+        self.reference = reference
+        self.http = httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections),
+            timeout=timeout, follow_redirects=True)
+        # url -> (expiration time, image)
+        self._urls: OrderedDict[str, tuple[float, CachedImage]] = OrderedDict()
+        # the download slots of the hosts with downloads, and how many downloads use them
+        self._hosts: dict[str, asyncio.Semaphore] = {}
+        self._host_users: dict[str, int] = {}
+        self._inflight: dict[str, asyncio.Future] = {}
+
+    @staticmethod
+    def has_remote_images(body: bytes) -> bool:
+        return REMOTE_URL.search(body) is not None
+
+    async def rewrite(self, payload: dict[str, Any]) -> tuple[int, list[str]]:
+        """
+        Replace the remote image URLs of the chat request in place. Returns how
+        many were replaced, and the blobs pinned for the file:// URLs, to `unpin`
+        once vLLM has read them.
+        """
+        parts = []
+        for message in payload.get("messages") or []:
+            content = message.get("content") if isinstance(message, dict) else None
+            if not isinstance(content, list):
+                continue
+            for part in content:
+                if isinstance(part, dict) and part.get("type") == "image_url":
+                    url = _image_url(part)
+                    if url is not None and url.startswith(("http://", "https://")):
+                        parts.append((part, url))
+        if not parts:
+            return 0, []
+        started = time.perf_counter()
+        urls = list(dict.fromkeys(url for _, url in parts))
+        results = await asyncio.gather(*(self.resolve(url) for url in urls), return_exceptions=True)
+        pinned = [result[1] for result in results if isinstance(result, tuple) and result[1] is not None]
+        for result in results:
+            if isinstance(result, BaseException):
+                self.unpin(pinned)
+                raise result
+        resolved = {url: result[0] for url, result in zip(urls, results)}
+        for part, url in parts:
+            image_url = part["image_url"]
+            if isinstance(image_url, dict):
+                part["image_url"] = {**image_url, "url": resolved[url]}
+            else:
+                part["image_url"] = resolved[url]
+        IMAGE_PREFETCH_SECONDS.observe(time.perf_counter() - started)
+        return len(parts), pinned
+
+    def unpin(self, digests: list[str]):
+        """ Let the blobs pinned by `rewrite` be evicted again. """
+        self.cache.unpin(digests)
+
+    async def resolve(self, url: str) -> tuple[str, str | None]:
+        """ The data URL or the file:// URL standing in for `url`, and the blob pinned for the file:// URL. """
+        image, data = await self.get(url)
+        if self.reference == "file":
+            if self.cache.pin(image.digest):
+                return "file://" + self.cache.path(image.digest), image.digest
+            if data is None:
+                # evicted since, from memory or fetched again
+                image, data = await self.get(url)
+        if data is None:
+            data = await self._read(image)
+        return f"data:{image.mime_type};base64,{base64.b64encode(data).decode('ascii')}", None
+
+    async def get(self, url: str) -> tuple[CachedImage, bytes | None]:
+        """ The image and its content, None when only its file is needed. """
+        entry = self._urls.get(url)
+        if entry is not None and entry[0] > time.monotonic():
+            image = entry[1]
+            if self.reference == "file" and self.cache.on_disk(image.digest):
+                IMAGE_REQUESTS.labels("disk").inc()
+                return image, None
+            cached = await asyncio.to_thread(self.cache.get, image.digest)
+            if cached is not None:
+                IMAGE_REQUESTS.labels(cached[1]).inc()
+                return image, cached[0]
+
+        inflight = self._inflight.get(url)
+        if inflight is not None:
+            IMAGE_REQUESTS.labels("coalesced").inc()
+            result = await asyncio.shield(inflight)
+            # None when the request which started the fetch was cancelled
+            return result if result is not None else await self.get(url)
+        future = self._inflight[url] = asyncio.get_running_loop().create_future()
+        try:
+            result = await self._fetch(url)
+        except ImageFetchError as e:
+            IMAGE_REQUESTS.labels("error").inc()
+            future.set_exception(e)
+            # retrieved here, so that a fetch nobody else waited for doesn't log a warning
+            future.exception()
+            raise
+        except BaseException:
+            future.set_result(None)
+            raise
+        finally:
+            del self._inflight[url]
+        IMAGE_REQUESTS.labels("fetched").inc()
+        future.set_result(result)
+        return result
+
+    @asynccontextmanager
+    async def _host_slot(self, host: str):
+        """ One of the `per_host` download slots of `host`, dropped once no download uses them. """
+        slots = self._hosts.get(host)
+        if slots is None:
+            slots = self._hosts[host] = asyncio.Semaphore(self.per_host)
+        self._host_users[host] = self._host_users.get(host, 0) + 1
+        try:
+            async with slots:
+                yield
+        finally:
+            self._host_users[host] -= 1
+            if not self._host_users[host]:
+                del self._host_users[host]
+                del self._hosts[host]
+
+    async def _fetch(self, url: str) -> tuple[CachedImage, bytes]:
+        async with self._host_slot(httpx.URL(url).host):
+            started = time.perf_counter()
+            try:
+                async with self.http.stream("GET", url) as response:
+                    response.raise_for_status()
+                    try:
+                        content_length = int(response.headers.get("content-length") or 0)
+                    except ValueError as e:
+                        raise ImageFetchError(f"Invalid Content-Length from {url}") from e
+                    if content_length > self.max_bytes:
+                        raise ImageFetchError(f"Image larger than {self.max_bytes} bytes: {url}")
+                    data = bytearray()
+                    async for chunk in response.aiter_bytes():
+                        data += chunk
+                        if len(data) > self.max_bytes:
+                            raise ImageFetchError(f"Image larger than {self.max_bytes} bytes: {url}")
+            except httpx.HTTPError as e:
+                raise ImageFetchError(f"Failed to fetch {url}: {e!r}") from e
+            IMAGE_FETCH_SECONDS.observe(time.perf_counter() - started)
+        data = bytes(data)
+        IMAGE_FETCH_BYTES.inc(len(data))
+        mime_type = sniff_mime_type(data, response.headers.get("content-type"))
+        digest = await asyncio.to_thread(self.cache.put, data)
+        image = CachedImage(digest, mime_type, len(data))
+        self._urls[url] = (time.monotonic() + self.url_ttl, image)
+        self._urls.move_to_end(url)
+        while len(self._urls) > self.max_urls:
+            self._urls.popitem(last=False)
+        return image, data
+
+    async def _read(self, image: CachedImage) -> bytes:
+        cached = await asyncio.to_thread(self.cache.get, image.digest)
+        if cached is None:
+            raise ImageFetchError(f"Image {image.digest} evicted from the cache")
+        return cached[0]
+
+    async def aclose(self):
+        await self.http.aclose()
+
+
+def _image_url(part: dict) -> str | None:
+    image_url = part.get("image_url")
+    if isinstance(image_url, dict):
+        image_url = image_url.get("url")
+    return image_url if isinstance(image_url, str) else None
@@ -0,0 +1,140 @@
+import base64
+import hashlib
+import io
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+
+from PIL import Image, ImageOps
+
+
+@dataclass(frozen=True)
+class ImagePrepConfig:
+    # Longest side of the prepared image in pixels.
+    max_side: int = 1344
+    # Total pixel budget, e.g. the max_pixels of the model's image processor.
+    max_pixels: int | None = 1024 * 28 * 28
+    # The sides are rounded to multiples of the vision patch grid, an image of
+    # 1000 pixels costs the same tokens as one of 1008. Qwen2-VL and Qwen2.5-VL
+    # use 14 pixel patches merged 2x2, so 28.
+    patch_size: int = 28
+    quality: int = 85
+    format: str = "JPEG"
+
+
+@dataclass
+class PreparedImage:
+    data_url: str
+    width: int
+    height: int
+    original_bytes: int
+    prepared_bytes: int
+    seconds: float
+    cached: bool = False
+
+    @property
+    def bytes_saved(self) -> int:
+        return self.original_bytes - self.prepared_bytes
+
+    def message_part(self) -> dict:
+        """ The `image_url` part of an OpenAI chat message. """
+        return {"type": "image_url", "image_url": {"url": self.data_url}}
+
+
+def target_size(width: int, height: int, config: ImagePrepConfig) -> tuple[int, int]:
+    """
+    The largest size within the limits of `config`, aligned to the patch grid.
+    Images within the limits keep their size, the image processor aligns them.
+    """
+    scale = min(1.0, config.max_side / max(width, height))
+    if config.max_pixels:
+        scale = min(scale, (config.max_pixels / (width * height)) ** 0.5)
+    if scale >= 1.0:
+        return width, height
+    patch = config.patch_size
+
+    def align(side: float) -> int:
+        # rounding down keeps the image within the limits
+        return max(patch, int(side // patch) * patch)
+
+    return align(width * scale), align(height * scale)
+
+
+def _encode(image: Image.Image, config: ImagePrepConfig) -> bytes:
+    if config.format.upper() == "JPEG" and image.mode != "RGB":
+        image = image.convert("RGB")
+    output = io.BytesIO()
+    image.save(output, format=config.format, quality=config.quality, optimize=True)
+    return output.getvalue()
+
+
+class ImagePreparer:
+    """
+    Downscales and re-encodes images for VLM requests, so the payloads stay
+    well below the SageMaker limit and no vision tokens are spent on pixels
+    the model's image processor would drop anyway.
+
+    Results are cached by the hash of the image content, the same image
+    is only processed once.
+    """
+
+    def __init__(self, config: ImagePrepConfig = ImagePrepConfig(), max_workers: int = 4, cache_size: int = 256):
+        self.config = config
+        self.max_workers = max_workers
+        self.cache_size = cache_size
+        self._cache: OrderedDict[str, PreparedImage] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def prepare(self, data: bytes) -> PreparedImage:
+        key = hashlib.sha256(data).hexdigest()
+        with self._lock:
+            cached = self._cache.get(key)
+            if cached is not None:
+                self._cache.move_to_end(key)
+                return PreparedImage(**{**cached.__dict__, "seconds": 0.0, "cached": True})
+
+        started = time.perf_counter()
+        image = Image.open(io.BytesIO(data))
+        source_format = image.format
+        # apply the EXIF rotation, it's lost when re-encoding
+        image = ImageOps.exif_transpose(image)
+        width, height = target_size(image.width, image.height, self.config)
+        resized = (width, height) != image.size
+        if resized:
+            image = image.resize((width, height), Image.Resampling.BICUBIC)
+        encoded = _encode(image, self.config)
+        mime_format = self.config.format
+        if len(encoded) >= len(data) and not resized and source_format:
+            # re-encoding didn't help, keep the original bytes
+            encoded, mime_format = data, source_format
+        prepared = PreparedImage(
+            data_url=f"data:image/{mime_format.lower()};base64,{base64.b64encode(encoded).decode('ascii')}",
+            width=width,
+            height=height,
+            original_bytes=len(data),
+            prepared_bytes=len(encoded),
+            seconds=time.perf_counter() - started,
+        )
+
+        with self._lock:
+            self._cache[key] = prepared
+            if len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return prepared
+
+    def prepare_many(self, images: list[bytes]) -> list[PreparedImage]:
+        """ Prepare several images in parallel, Pillow releases the GIL while resizing and encoding. """
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            return list(pool.map(self.prepare, images))
+
+
+def report(images: list[PreparedImage]) -> str:
+    lines = []
+    for i, image in enumerate(images):
+        lines.append(
+            f"image {i}: {image.width}x{image.height}, {image.original_bytes / 1024:.0f} KiB -> "
+            f"{image.prepared_bytes / 1024:.0f} KiB ({image.bytes_saved / 1024:.0f} KiB saved), "
+            f"{image.seconds * 1000:.1f} ms{' (cached)' if image.cached else ''}")
+    return "\n".join(lines)
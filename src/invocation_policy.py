@@ -0,0 +1,323 @@
+import asyncio
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from dataclasses import asdict, dataclass
+from typing import Awaitable, Callable, TypeVar
+
+import httpx
+import requests
+from botocore.exceptions import ClientError, ConnectionError as BotocoreConnectionError  # type: ignore
+
+from json_codec import loads
+
+T = TypeVar("T")
+
+# Statuses worth retrying: throttling, the engine still loading, the proxy queue full.
+RETRYABLE_STATUSES = {429, 500, 502, 503, 504}
+# The SageMaker runtime reports throttling with status 400 and the error type in a header
+RETRYABLE_ERROR_TYPES = ("ThrottlingException", "ServiceUnavailable", "ModelNotReadyException", "InternalFailure")
+# Errors of the container come back as ModelError (status 424) with the container's status
+# in OriginalStatusCode, e.g. 429 when the proxy's admission queue is full.
+MODEL_ERROR = "ModelError"
+
+
+@dataclass
+class InvocationPolicy:
+    """
+    Hedging: when a request takes longer than the `hedge_percentile` of the
+    recent latencies, the same request is sent again and the first response
+    wins, the other request is cancelled. The delay is `initial_hedge_delay`
+    until `min_samples` latencies are known. Hedges are capped at
+    `max_hedge_fraction` of the requests, each one costs a second generation.
+
+    Retries: throttling, 5XX and connection errors are retried up to
+    `max_attempts` with exponential backoff and full jitter, while the retry
+    budget lasts: `retry_budget_ratio` retries per request, so that a failing
+    endpoint doesn't get its traffic multiplied.
+    """
+    hedge: bool = True
+    hedge_percentile: float = 95
+    initial_hedge_delay: float = 2.0
+    min_hedge_delay: float = 0.05
+    max_hedge_delay: float = 60.0
+    max_hedge_fraction: float = 0.1
+    max_attempts: int = 3
+    backoff_base: float = 0.1
+    backoff_cap: float = 5.0
+    retry_budget_ratio: float = 0.2
+    # requests above the ratios allowed at once, e.g. the first requests of a client
+    budget_burst: int = 5
+    window: int = 1000
+    min_samples: int = 20
+
+
+@dataclass
+class InvocationStats:
+    requests: int = 0
+    hedges: int = 0
+    hedge_wins: int = 0
+    hedges_denied: int = 0
+    retries: int = 0
+    retries_denied: int = 0
+
+
+class LatencyTracker:
+    """ The latencies of the last `window` successful requests. """
+
+    def __init__(self, window: int):
+        self._latencies: deque[float] = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._latencies)
+
+    def record(self, latency: float):
+        with self._lock:
+            self._latencies.append(latency)
+
+    def percentile(self, q: float) -> float | None:
+        with self._lock:
+            values = sorted(self._latencies)
+        if not values:
+            return None
+        return values[min(len(values) - 1, int(len(values) * q / 100))]
+
+
+class Budget:
+    """ Every request earns `ratio` of a token, an extra request (retry or hedge) spends one. """
+
+    def __init__(self, ratio: float, burst: int):
+        self.ratio = ratio
+        self.burst = burst
+        self.tokens = float(burst)
+        self._lock = threading.Lock()
+
+    def deposit(self):
+        with self._lock:
+            self.tokens = min(self.burst, self.tokens + self.ratio)
+
+    def withdraw(self) -> bool:
+        with self._lock:
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+            return True
+
+
+def original_status_code(response: httpx.Response | requests.Response) -> int | None:
+    """ The container's status of a ModelError response of the SageMaker runtime. """
+    try:
+        content = loads(response.content)
+    except (ValueError, httpx.ResponseNotRead):
+        return None
+    return content.get("OriginalStatusCode") if isinstance(content, dict) else None
+
+
+def is_retryable(error: BaseException) -> bool:
+    """ Throttling, 5XX and connection errors of httpx, requests and boto3, also when the container returned them. """
+    if isinstance(error, (httpx.TransportError, requests.ConnectionError, requests.Timeout, BotocoreConnectionError)):
+        return True
+    if isinstance(error, ClientError):
+        status = error.response.get("ResponseMetadata", {}).get("HTTPStatusCode")
+        code = error.response.get("Error", {}).get("Code", "")
+        if code == MODEL_ERROR:
+            return error.response.get("OriginalStatusCode") in RETRYABLE_STATUSES
+        return status in RETRYABLE_STATUSES or code.startswith(RETRYABLE_ERROR_TYPES)
+    response = getattr(error, "response", None)
+    if isinstance(error, (httpx.HTTPStatusError, requests.HTTPError)) and response is not None:
+        if response.status_code in RETRYABLE_STATUSES:
+            return True
+        error_type = response.headers.get("x-amzn-ErrorType", "")
+        if error_type.startswith(MODEL_ERROR):
+            return original_status_code(response) in RETRYABLE_STATUSES
+        return error_type.startswith(RETRYABLE_ERROR_TYPES)
+    return False
+
+
+def retry_delay(attempt: int, base: float, cap: float, error: BaseException | None = None) -> float:
+    """ Exponential backoff with full jitter, at least the Retry-After of the response. """
+    delay = random.uniform(0, min(cap, base * 2 ** attempt))
+    response = getattr(error, "response", None)
+    if isinstance(response, (httpx.Response, requests.Response)):
+        try:
+            delay = max(delay, float(response.headers.get("Retry-After", 0)))
+        except ValueError:
+            pass
+    return delay
+
+
+class _Invoker:
+    def __init__(self, policy: InvocationPolicy | None = None):
+        self.policy = policy or InvocationPolicy()
+        self.latencies = LatencyTracker(self.policy.window)
+        self.retry_budget = Budget(self.policy.retry_budget_ratio, self.policy.budget_burst)
+        self.hedge_budget = Budget(self.policy.max_hedge_fraction, self.policy.budget_burst)
+        self.stats = InvocationStats()
+        # the counters are updated from the threads of HedgedInvoker
+        self._stats_lock = threading.Lock()
+
+    def hedge_delay(self) -> float | None:
+        """ Seconds to wait for the first response before hedging, None without hedging. """
+        if not self.policy.hedge:
+            return None
+        if len(self.latencies) < self.policy.min_samples:
+            return self.policy.initial_hedge_delay
+        delay = self.latencies.percentile(self.policy.hedge_percentile)
+        return min(self.policy.max_hedge_delay, max(self.policy.min_hedge_delay, delay))
+
+    def _count(self, name: str):
+        with self._stats_lock:
+            setattr(self.stats, name, getattr(self.stats, name) + 1)
+
+    def _start_request(self):
+        self._count("requests")
+        self.retry_budget.deposit()
+        self.hedge_budget.deposit()
+
+    def _may_hedge(self) -> bool:
+        if self.hedge_budget.withdraw():
+            self._count("hedges")
+            return True
+        self._count("hedges_denied")
+        return False
+
+    def _may_retry(self, error: BaseException, attempt: int) -> bool:
+        if not is_retryable(error) or attempt + 1 >= self.policy.max_attempts:
+            return False
+        if not self.retry_budget.withdraw():
+            self._count("retries_denied")
+            return False
+        self._count("retries")
+        return True
+
+    def _record(self, started: float, winner_is_hedge: bool = False):
+        """ The latency is that of the caller, from the primary request, also when the hedge wins. """
+        self.latencies.record(time.monotonic() - started)
+        if winner_is_hedge:
+            self._count("hedge_wins")
+
+    def summary(self) -> dict:
+        with self._stats_lock:
+            stats = asdict(self.stats)
+        return {**stats, "hedge_delay_s": self.hedge_delay()}
+
+
+class AsyncHedgedInvoker(_Invoker):
+    """
+    Runs `call` under the policy, e.g.
+    `await invoker.invoke(lambda: client.invoke(endpoint_name, payload))`.
+    The losing request is cancelled, which closes its connection.
+    """
+
+    async def invoke(self, call: Callable[[], Awaitable[T]]) -> T:
+        self._start_request()
+        attempt = 0
+        while True:
+            try:
+                return await self._hedged(call)
+            except Exception as e:
+                if not self._may_retry(e, attempt):
+                    raise
+                await asyncio.sleep(retry_delay(attempt, self.policy.backoff_base, self.policy.backoff_cap, e))
+                attempt += 1
+
+    async def _hedged(self, call: Callable[[], Awaitable[T]]) -> T:
+        started = time.monotonic()
+        primary = asyncio.create_task(call())
+        tasks = {primary}
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=self.hedge_delay())
+            if done or not self._may_hedge():
+                result = await primary
+                self._record(started)
+                return result
+            hedge = asyncio.create_task(call())
+            tasks.add(hedge)
+            pending = set(tasks)
+            error = None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        self._record(started, winner_is_hedge=task is hedge)
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            # the loser, or both when the caller is cancelled
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+
+
+class HedgedInvoker(_Invoker):
+    """
+    Thread-based variant of `AsyncHedgedInvoker` for blocking clients (requests,
+    boto3). A call that already started can't be interrupted: the losing request
+    is abandoned, and its response closed once it arrives.
+    """
+
+    def __init__(self, policy: InvocationPolicy | None = None, max_workers: int = 32):
+        super().__init__(policy)
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="hedged-invoker")
+
+    def invoke(self, call: Callable[[], T]) -> T:
+        self._start_request()
+        attempt = 0
+        while True:
+            try:
+                return self._hedged(call)
+            except Exception as e:
+                if not self._may_retry(e, attempt):
+                    raise
+                time.sleep(retry_delay(attempt, self.policy.backoff_base, self.policy.backoff_cap, e))
+                attempt += 1
+
+    def _hedged(self, call: Callable[[], T]) -> T:
+        started = time.monotonic()
+        primary = self._executor.submit(call)
+        futures = {primary}
+        try:
+            done, _ = wait(futures, timeout=self.hedge_delay())
+            if done or not self._may_hedge():
+                result = primary.result()
+                self._record(started)
+                return result
+            hedge = self._executor.submit(call)
+            futures.add(hedge)
+            pending = set(futures)
+            error = None
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    if future.exception() is None:
+                        self._record(started, winner_is_hedge=future is hedge)
+                        return future.result()
+                    error = future.exception()
+            raise error
+        finally:
+            for future in futures:
+                if not future.done() and not future.cancel():
+                    future.add_done_callback(_close_result)
+
+    def close(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def _close_result(future: Future):
+    """ Release the connection of an abandoned request. """
+    if future.cancelled() or future.exception() is not None:
+        return
+    result = future.result()
+    close = getattr(result, "close", None)
+    if callable(close):
+        close()
@@ -0,0 +1,139 @@
+import json
+import re
+from typing import Any
+
+try:
+    import orjson
+except ImportError:  # orjson is optional, the standard library does the same only slower
+    orjson = None
+
+# a JSON object's structure outside of strings, the rest of a value is skipped over
+STRUCTURAL = re.compile(rb'["\[\]{}]')
+SCALAR_END = re.compile(rb'[\s,}\]]')
+WHITESPACE = frozenset(b" \t\r\n")
+
+
+def dumps(obj: Any, sort_keys: bool = False) -> bytes:
+    """ Compact UTF-8 JSON, straight to bytes with orjson instead of a str and an encoded copy. """
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_SORT_KEYS if sort_keys else None)
+    return json.dumps(obj, separators=(",", ":"), ensure_ascii=False, sort_keys=sort_keys).encode("utf-8")
+
+
+def loads(data: bytes | bytearray | memoryview | str) -> Any:
+    """ Raises a `json.JSONDecodeError` (a `ValueError`) with both backends. """
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(bytes(data) if isinstance(data, memoryview) else data)
+
+
+class RawValue:
+    """ A value left undecoded by `peek`, a view on the body until `decode` is called. """
+    __slots__ = ("_body", "_start", "_end")
+
+    def __init__(self, body: bytes, start: int, end: int):
+        self._body = body
+        self._start = start
+        self._end = end
+
+    def __len__(self) -> int:
+        return self._end - self._start
+
+    def __repr__(self) -> str:
+        return f"RawValue({len(self)} bytes)"
+
+    def decode(self) -> Any:
+        return loads(memoryview(self._body)[self._start:self._end])
+
+
+def peek(body: bytes, fields: tuple[str, ...], max_value_bytes: int = 4096, max_keys: int = 256) -> dict | None:
+    """
+    The top-level keys of a JSON object, without decoding the whole body. The
+    values of `fields` up to `max_value_bytes` are decoded, the others are
+    `RawValue`s. Strings are skipped with `bytes.find` and nested values with a
+    regex for the structural characters, so a multi-MB base64 image costs a few
+    scans at C speed and no allocations.
+
+    Returns None when the body isn't a JSON object, is malformed at the top
+    level, or has more than `max_keys` keys; callers fall back to a full parse,
+    which reports the error. Nested values are not validated.
+    """
+    try:
+        return _peek(body, fields, max_value_bytes, max_keys)
+    except (IndexError, ValueError):
+        return None
+
+
+def _peek(body: bytes, fields: tuple[str, ...], max_value_bytes: int, max_keys: int) -> dict | None:
+    pos = _skip_whitespace(body, 0)
+    if body[pos] != ord("{"):
+        return None
+    result = {}
+    pos = _skip_whitespace(body, pos + 1)
+    if body[pos] == ord("}"):
+        return result if _skip_whitespace(body, pos + 1) == len(body) else None
+    while len(result) < max_keys:
+        if body[pos] != ord('"'):
+            return None
+        key_end = _string_end(body, pos)
+        key = body[pos + 1:key_end - 1]
+        key = loads(body[pos:key_end]) if b"\\" in key else key.decode("utf-8")
+        pos = _skip_whitespace(body, key_end)
+        if body[pos] != ord(":"):
+            return None
+        start = _skip_whitespace(body, pos + 1)
+        end = _value_end(body, start)
+        if key in fields and end - start <= max_value_bytes:
+            result[key] = loads(body[start:end])
+        else:
+            result[key] = RawValue(body, start, end)
+        pos = _skip_whitespace(body, end)
+        if body[pos] == ord("}"):
+            return result if _skip_whitespace(body, pos + 1) == len(body) else None
+        if body[pos] != ord(","):
+            return None
+        pos = _skip_whitespace(body, pos + 1)
+    return None
+
+
+def _skip_whitespace(body: bytes, pos: int) -> int:
+    while pos < len(body) and body[pos] in WHITESPACE:
+        pos += 1
+    return pos
+
+
+def _string_end(body: bytes, pos: int) -> int:
+    """ The position after the closing quote of the string opening at `pos`. """
+    while True:
+        end = body.find(b'"', pos + 1)
+        if end < 0:
+            raise ValueError("Unterminated string")
+        backslashes = 0
+        while body[end - 1 - backslashes] == ord("\\"):
+            backslashes += 1
+        if backslashes % 2 == 0:
+            return end + 1
+        pos = end
+
+
+def _value_end(body: bytes, pos: int) -> int:
+    first = body[pos]
+    if first == ord('"'):
+        return _string_end(body, pos)
+    if first not in b"[{":
+        match = SCALAR_END.search(body, pos)
+        return match.start() if match else len(body)
+    depth = 0
+    while True:
+        match = STRUCTURAL.search(body, pos)
+        if match is None:
+            raise ValueError("Unterminated value")
+        pos = match.start()
+        char = body[pos]
+        if char == ord('"'):
+            pos = _string_end(body, pos)
+            continue
+        depth += 1 if char in b"[{" else -1
+        pos += 1
+        if depth == 0:
+            return pos
@@ -0,0 +1,296 @@
+import argparse
+import base64
+import fnmatch
+import hashlib
+import json
+import os
+import shutil
+import sys
+import threading
+import time
+from concurrent.futures import FIRST_EXCEPTION, ThreadPoolExecutor, wait
+from dataclasses import dataclass
+from urllib.parse import urljoin, urlparse
+
+import boto3  # type: ignore
+import requests
+from botocore.config import Config  # type: ignore
+
+# Downloads the model files into a local cache before vLLM starts, splitting
+# every file into ranged chunks which are fetched in parallel. Prints the local
+# directory, which the serve script passes to vLLM as --model.
+#
+# Supported sources:
+#   s3://bucket/prefix          (SM_PREFETCH_S3_ENDPOINT_URL for S3-compatible servers)
+#   hf://org/model[@revision]   (HF_TOKEN for gated models)
+#   http(s)://host/path/        (with a manifest.json listing the files, see HTTPSource)
+#   file:///dir or /dir
+
+MARKER_DIR = ".prefetch"
+# The S3 additional checksums which cover the whole object, as hashlib algorithms
+S3_CHECKSUMS = {"ChecksumSHA256": "sha256", "ChecksumSHA1": "sha1"}
+
+
+def log(message: str):
+    # stdout is reserved for the model directory
+    print(f"[prefetch] {message}", file=sys.stderr, flush=True)
+
+
+@dataclass
+class RemoteFile:
+    path: str
+    size: int
+    # (algorithm, hex digest) to verify the download with, if the source provides one
+    checksum: tuple[str, str] | None = None
+
+
+class S3Source:
+    def __init__(self, uri: str, endpoint_url: str | None = None, max_pool_connections: int = 64):
+        parsed = urlparse(uri)
+        self.bucket = parsed.netloc
+        self.prefix = parsed.path.lstrip("/")
+        if self.prefix and not self.prefix.endswith("/"):
+            self.prefix += "/"
+        self.client = boto3.client("s3", endpoint_url=endpoint_url,
+                                   config=Config(max_pool_connections=max_pool_connections))
+
+    def list_files(self) -> list[RemoteFile]:
+        keys = []
+        paginator = self.client.get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=self.prefix):
+            for item in page.get("Contents", []):
+                path = item["Key"][len(self.prefix):]
+                if path and not path.endswith("/"):
+                    keys.append((path, item["Size"]))
+        # the listing doesn't tell the encryption nor the additional checksums of the objects
+        with ThreadPoolExecutor(max_workers=16) as pool:
+            checksums = list(pool.map(self.checksum_of, (path for path, _ in keys)))
+        return [RemoteFile(path, size, checksum) for (path, size), checksum in zip(keys, checksums)]
+
+    def checksum_of(self, path: str) -> tuple[str, str] | None:
+        head = self.client.head_object(Bucket=self.bucket, Key=self.prefix + path, ChecksumMode="ENABLED")
+        for name, algorithm in S3_CHECKSUMS.items():
+            value = head.get(name)
+            # checksums of multipart uploads are checksums of the parts' checksums, "<base64>-<parts>"
+            if value and "-" not in value:
+                return algorithm, base64.b64decode(value).hex()
+        etag = head.get("ETag", "").strip('"')
+        # the ETag of objects uploaded in one part is their MD5, multipart ETags contain a dash, but
+        # not with SSE-KMS or SSE-C encryption
+        encrypted = head.get("ServerSideEncryption", "").startswith("aws:kms") or "SSECustomerAlgorithm" in head
+        return ("md5", etag) if etag and "-" not in etag and not encrypted else None
+
+    def read_range(self, file: RemoteFile, start: int, end: int) -> bytes:
+        response = self.client.get_object(Bucket=self.bucket, Key=self.prefix + file.path, Range=f"bytes={start}-{end - 1}")
+        return response["Body"].read()
+
+
+class HTTPSource:
+    """
+    Files served over HTTP(S) with range request support. The base URL must
+    provide a `manifest.json`: [{"path": "model.safetensors", "size": 123, "sha256": "..."}, ...]
+    """
+
+    def __init__(self, uri: str, headers: dict[str, str] | None = None, pool_size: int = 64):
+        self.base_url = uri if uri.endswith("/") else uri + "/"
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.session.headers.update(headers or {})
+
+    def list_files(self) -> list[RemoteFile]:
+        response = self.session.get(urljoin(self.base_url, "manifest.json"), timeout=60)
+        response.raise_for_status()
+        return [RemoteFile(item["path"], item["size"], ("sha256", item["sha256"]) if item.get("sha256") else None)
+                for item in response.json()]
+
+    def url_of(self, file: RemoteFile) -> str:
+        return urljoin(self.base_url, file.path)
+
+    def read_range(self, file: RemoteFile, start: int, end: int) -> bytes:
+        response = self.session.get(self.url_of(file), headers={"Range": f"bytes={start}-{end - 1}"}, timeout=300)
+        response.raise_for_status()
+        if response.status_code != 206 and (start, end) != (0, file.size):
+            raise RuntimeError(f"{self.url_of(file)} doesn't support range requests")
+        return response.content
+
+
+class HuggingFaceSource(HTTPSource):
+    def __init__(self, uri: str, pool_size: int = 64):
+        repo = uri[len("hf://"):]
+        self.repo_id, _, revision = repo.partition("@")
+        self.revision = revision or "main"
+        token = os.getenv("HF_TOKEN")
+        super().__init__(f"https://huggingface.co/{self.repo_id}/resolve/{self.revision}/",
+                         headers={"Authorization": f"Bearer {token}"} if token else None, pool_size=pool_size)
+
+    def list_files(self) -> list[RemoteFile]:
+        from huggingface_hub import HfApi
+
+        info = HfApi().model_info(self.repo_id, revision=self.revision, files_metadata=True, token=os.getenv("HF_TOKEN"))
+        files = []
+        for sibling in info.siblings:
+            # only the files stored in LFS (the weights) have a SHA-256
+            checksum = ("sha256", sibling.lfs.sha256) if sibling.lfs else None
+            files.append(RemoteFile(sibling.rfilename, sibling.size or 0, checksum))
+        return files
+
+
+class LocalSource:
+    def __init__(self, uri: str):
+        self.root = urlparse(uri).path if uri.startswith("file://") else uri
+
+    def list_files(self) -> list[RemoteFile]:
+        files = []
+        for directory, _, names in os.walk(self.root):
+            for name in names:
+                full_path = os.path.join(directory, name)
+                files.append(RemoteFile(os.path.relpath(full_path, self.root), os.path.getsize(full_path)))
+        return files
+
+    def read_range(self, file: RemoteFile, start: int, end: int) -> bytes:
+        with open(os.path.join(self.root, file.path), "rb") as f:
+            f.seek(start)
+            return f.read(end - start)
+
+
+def make_source(uri: str, workers: int):
+    if uri.startswith("s3://"):
+        return S3Source(uri, endpoint_url=os.getenv("SM_PREFETCH_S3_ENDPOINT_URL"), max_pool_connections=workers)
+    if uri.startswith("hf://"):
+        return HuggingFaceSource(uri, pool_size=workers)
+    if uri.startswith(("http://", "https://")):
+        return HTTPSource(uri, pool_size=workers)
+    return LocalSource(uri)
+
+
+def file_digest(path: str, algorithm: str) -> str:
+    digest = hashlib.new(algorithm)
+    with open(path, "rb") as f:
+        while chunk := f.read(8 * 2**20):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def marker_path(cache_dir: str, file: RemoteFile) -> str:
+    return os.path.join(cache_dir, MARKER_DIR, file.path + ".json")
+
+
+def is_cached(cache_dir: str, file: RemoteFile) -> bool:
+    """ A file is cached if it was verified before and its source didn't change since. """
+    try:
+        with open(marker_path(cache_dir, file)) as f:
+            marker = json.load(f)
+        return (marker["size"] == file.size and marker["checksum"] == list(file.checksum or [])
+                and os.path.getsize(os.path.join(cache_dir, file.path)) == file.size)
+    except (OSError, ValueError, KeyError):
+        return False
+
+
+class Prefetcher:
+    def __init__(self, source, cache_dir: str, workers: int = 32, chunk_size: int = 64 * 2**20):
+        self.source = source
+        self.cache_dir = cache_dir
+        self.workers = workers
+        self.chunk_size = chunk_size
+        self._lock = threading.Lock()
+        self.downloaded_bytes = 0
+
+    def run(self, patterns: list[str] | None = None) -> str:
+        started = time.perf_counter()
+        files = self.source.list_files()
+        if patterns:
+            files = [f for f in files if any(fnmatch.fnmatch(f.path, pattern) for pattern in patterns)]
+        missing = [f for f in files if not is_cached(self.cache_dir, f)]
+        log(f"{len(files)} files, {len(files) - len(missing)} already cached, "
+            f"{sum(f.size for f in missing) / 2**20:.1f} MiB to download")
+
+        # one task per chunk, the chunks of all files share the worker pool
+        remaining = {}
+        tasks = []
+        for file in missing:
+            partial = self._partial_path(file)
+            os.makedirs(os.path.dirname(partial), exist_ok=True)
+            with open(partial, "wb") as f:
+                f.truncate(file.size)
+            offsets = list(range(0, file.size, self.chunk_size)) or [0]
+            remaining[file.path] = len(offsets)
+            tasks.extend((file, start, min(start + self.chunk_size, file.size)) for start in offsets)
+
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            futures = [pool.submit(self._download_chunk, *task, remaining) for task in tasks]
+            done, pending = wait(futures, return_when=FIRST_EXCEPTION)
+            # a failed chunk fails the run, don't download the rest
+            for future in pending:
+                future.cancel()
+            for future in done:
+                future.result()
+
+        elapsed = time.perf_counter() - started
+        log(f"downloaded {self.downloaded_bytes / 2**20:.1f} MiB in {elapsed:.1f} s "
+            f"({self.downloaded_bytes / 2**20 / max(elapsed, 1e-9):.0f} MiB/s)")
+        return self.cache_dir
+
+    def _partial_path(self, file: RemoteFile) -> str:
+        return os.path.join(self.cache_dir, file.path + ".partial")
+
+    def _download_chunk(self, file: RemoteFile, start: int, end: int, remaining: dict[str, int]):
+        data = self.source.read_range(file, start, end) if end > start else b""
+        if len(data) != end - start:
+            raise RuntimeError(f"{file.path}: expected {end - start} bytes at {start}, got {len(data)}")
+        fd = os.open(self._partial_path(file), os.O_WRONLY)
+        try:
+            os.pwrite(fd, data, start)
+        finally:
+            os.close(fd)
+        with self._lock:
+            self.downloaded_bytes += len(data)
+            remaining[file.path] -= 1
+            done = remaining[file.path] == 0
+        if done:
+            self._finish(file)
+
+    def _finish(self, file: RemoteFile):
+        partial = self._partial_path(file)
+        if file.checksum is not None:
+            algorithm, expected = file.checksum
+            actual = file_digest(partial, algorithm)
+            if actual != expected:
+                os.remove(partial)
+                raise RuntimeError(f"{file.path}: {algorithm} mismatch, expected {expected}, got {actual}")
+        os.replace(partial, os.path.join(self.cache_dir, file.path))
+        marker = marker_path(self.cache_dir, file)
+        os.makedirs(os.path.dirname(marker), exist_ok=True)
+        with open(marker, "w") as f:
+            json.dump({"size": file.size, "checksum": list(file.checksum or [])}, f)
+        log(f"{file.path}: {file.size / 2**20:.1f} MiB done")
+
+
+def default_cache_dir(uri: str) -> str:
+    root = os.getenv("SM_PREFETCH_CACHE_DIR", "/opt/ml/weights-cache")
+    # one directory per source, so that switching models keeps both in the cache
+    return os.path.join(root, hashlib.sha256(uri.encode()).hexdigest()[:16])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Download model files in parallel into a local cache.')
+    parser.add_argument('--uri', default=os.getenv('SM_PREFETCH_URI'), help='s3://, hf://, http(s):// or a local directory')
+    parser.add_argument('--cache-dir', default=None, help='Defaults to a directory per URI under SM_PREFETCH_CACHE_DIR')
+    parser.add_argument('--workers', type=int, default=int(os.getenv('SM_PREFETCH_WORKERS', 32)))
+    parser.add_argument('--chunk-mb', type=int, default=int(os.getenv('SM_PREFETCH_CHUNK_MB', 64)))
+    parser.add_argument('--patterns', default=os.getenv('SM_PREFETCH_PATTERNS'),
+                        help='Comma separated glob patterns of the files to download, all files by default')
+    parser.add_argument('--clean', action='store_true', help='Remove the cache directory first')
+    args = parser.parse_args()
+    if not args.uri:
+        sys.exit("--uri or SM_PREFETCH_URI must be provided")
+
+    cache_dir = args.cache_dir or default_cache_dir(args.uri)
+    if args.clean:
+        shutil.rmtree(cache_dir, ignore_errors=True)
+    os.makedirs(cache_dir, exist_ok=True)
+    prefetcher = Prefetcher(make_source(args.uri, args.workers), cache_dir, workers=args.workers,
+                            chunk_size=args.chunk_mb * 2**20)
+    patterns = [p.strip() for p in args.patterns.split(",")] if args.patterns else None
+    print(prefetcher.run(patterns))
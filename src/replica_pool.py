@@ -0,0 +1,158 @@
+import asyncio
+import hashlib
+
+import httpx
+from prometheus_client import Counter, Gauge
+
+OUTSTANDING = Gauge("proxy_replica_outstanding_requests", "Requests being processed by each engine replica", ["replica"])
+HEALTHY = Gauge("proxy_replica_healthy", "1 if the replica passed its last health check", ["replica"])
+ROUTED = Counter("proxy_replica_requests_total", "Requests routed to each replica", ["replica"])
+AFFINITY = Counter("proxy_replica_affinity_total", "Requests with a prompt prefix by result: hit or spill", ["result"])
+
+
+class Replica:
+    def __init__(self, url: str, client: httpx.AsyncClient):
+        self.url = url
+        self.client = client
+        self.outstanding = 0
+        self.healthy = True
+        self._outstanding_gauge = OUTSTANDING.labels(url)
+        self._healthy_gauge = HEALTHY.labels(url)
+        self._routed = ROUTED.labels(url)
+        self._healthy_gauge.set(1)
+
+    def set_healthy(self, healthy: bool):
+        self.healthy = healthy
+        self._healthy_gauge.set(1 if healthy else 0)
+
+
+def prompt_prefix(payload: dict, max_chars: int) -> str | None:
+    """ The first characters of the prompt, requests sharing them share the prefix cache entries. """
+    if "prompt" in payload:
+        prompt = payload["prompt"]
+        return prompt[:max_chars] if isinstance(prompt, str) else None
+    parts = []
+    length = 0
+    for message in payload.get("messages") or []:
+        content = message.get("content")
+        if isinstance(content, list):
+            # the text parts only, images would make the key expensive to compute
+            content = "".join(part.get("text", "") for part in content if isinstance(part, dict))
+        if not isinstance(content, str):
+            continue
+        parts.append(f"{message.get('role')}:{content}\n")
+        length += len(parts[-1])
+        if length >= max_chars:
+            break
+    return "".join(parts)[:max_chars] or None
+
+
+class ReplicaPool:
+    """
+    Routes the requests to one of several vLLM replicas running on the same
+    instance, each on its own GPUs. Requests go to the replica with the fewest
+    outstanding requests. With prefix affinity, requests sharing the start of
+    their prompt prefer the same replica (rendezvous hashing), so vLLM's prefix
+    cache keeps hitting, unless that replica has `max_imbalance` more
+    outstanding requests than the least loaded one.
+
+    Replicas failing their health check or refusing connections are taken out
+    of rotation until a health check succeeds again.
+    """
+
+    def __init__(self, urls: list[str], pool_size: int, timeout: float, prefix_affinity_chars: int = 0,
+                 max_imbalance: int = 4, health_check_interval: float = 5.0):
+        self.prefix_affinity_chars = prefix_affinity_chars
+        self.max_imbalance = max_imbalance
+        self.health_check_interval = health_check_interval
+        # connections are split over the replicas
+        per_replica = max(1, pool_size // len(urls))
+        self.replicas = [
+            Replica(url, httpx.AsyncClient(
+                base_url=url,
+                limits=httpx.Limits(max_connections=per_replica, max_keepalive_connections=per_replica),
+                timeout=httpx.Timeout(timeout, connect=10),
+            ))
+            for url in urls
+        ]
+        self._next = 0
+        self._health_task: asyncio.Task | None = None
+
+    def start(self):
+        if len(self.replicas) > 1 and self.health_check_interval > 0:
+            self._health_task = asyncio.create_task(self._health_loop())
+
+    async def aclose(self):
+        if self._health_task is not None:
+            self._health_task.cancel()
+        await asyncio.gather(*(replica.client.aclose() for replica in self.replicas))
+
+    @property
+    def any_healthy(self) -> bool:
+        return any(replica.healthy for replica in self.replicas)
+
+    def acquire(self, payload: dict | None = None) -> Replica:
+        """ Pick a replica for the request, `release` must be called once it's done. """
+        candidates = [replica for replica in self.replicas if replica.healthy]
+        if not candidates:
+            # better to try than to fail, the health checks may lag behind
+            candidates = self.replicas
+        replica = None
+        if self.prefix_affinity_chars > 0 and payload is not None and len(candidates) > 1:
+            replica = self._pick_by_prefix(payload, candidates)
+        if replica is None:
+            replica = self._pick_least_outstanding(candidates)
+        replica.outstanding += 1
+        replica._outstanding_gauge.set(replica.outstanding)
+        replica._routed.inc()
+        return replica
+
+    def release(self, replica: Replica, failed: bool = False):
+        replica.outstanding -= 1
+        replica._outstanding_gauge.set(replica.outstanding)
+        if failed:
+            replica.set_healthy(False)
+
+    def _pick_least_outstanding(self, candidates: list[Replica]) -> Replica:
+        # start the scan at a rotating offset, so that ties are spread evenly
+        self._next = (self._next + 1) % len(candidates)
+        rotated = candidates[self._next:] + candidates[:self._next]
+        return min(rotated, key=lambda replica: replica.outstanding)
+
+    def _pick_by_prefix(self, payload: dict, candidates: list[Replica]) -> Replica | None:
+        prefix = prompt_prefix(payload, self.prefix_affinity_chars)
+        if prefix is None:
+            return None
+        key = prefix.encode()
+
+        def score(replica: Replica) -> bytes:
+            return hashlib.blake2b(key + replica.url.encode(), digest_size=8).digest()
+
+        least = min(replica.outstanding for replica in candidates)
+        ranked = sorted(candidates, key=score, reverse=True)
+        if ranked[0].outstanding <= least + self.max_imbalance:
+            AFFINITY.labels("hit").inc()
+            return ranked[0]
+        AFFINITY.labels("spill").inc()
+        # spill over to the next replicas of the ranking, the prefix stays on a few replicas
+        for replica in ranked[1:]:
+            if replica.outstanding <= least + self.max_imbalance:
+                return replica
+        return None
+
+    async def check_health(self) -> bool:
+        """ Check all the replicas at the same time, true if any is healthy. """
+        async def check(replica: Replica):
+            try:
+                response = await replica.client.get("/health", timeout=5)
+                replica.set_healthy(response.is_success)
+            except httpx.HTTPError:
+                replica.set_healthy(False)
+
+        await asyncio.gather(*(check(replica) for replica in self.replicas))
+        return self.any_healthy
+
+    async def _health_loop(self):
+        while True:
+            await asyncio.sleep(self.health_check_interval)
+            await self.check_health()
@@ -0,0 +1,154 @@
+import functools
+import json
+import re
+import sys
+import time
+from dataclasses import dataclass
+
+from prometheus_client import Counter, Histogram
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+TOKEN_BUCKETS = (1, 8, 32, 128, 512, 1024, 2048, 4096, 8192, 16384, 32768, 131072)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+
+BODY_PARSE = Histogram("proxy_body_parse_seconds", "Time to receive and parse the request body", ["route"], buckets=LATENCY_BUCKETS)
+QUEUE_TIME = Histogram("proxy_queue_seconds", "Time spent waiting for admission", ["route"], buckets=LATENCY_BUCKETS)
+UPSTREAM_TTFT = Histogram("proxy_upstream_ttft_seconds", "Time from forwarding the request to the first response byte", ["route"], buckets=LATENCY_BUCKETS)
+DURATION = Histogram("proxy_request_duration_seconds", "Time from the request to the end of the response", ["route"], buckets=LATENCY_BUCKETS)
+PROMPT_TOKENS = Histogram("proxy_prompt_tokens", "Prompt tokens reported in `usage`", ["route"], buckets=TOKEN_BUCKETS)
+COMPLETION_TOKENS = Histogram("proxy_completion_tokens", "Completion tokens reported in `usage`", ["route"], buckets=TOKEN_BUCKETS)
+REQUEST_BYTES = Histogram("proxy_request_bytes", "Size of the request body", ["route"], buckets=SIZE_BUCKETS)
+RESPONSE_BYTES = Histogram("proxy_response_bytes", "Size of the response body", ["route"], buckets=SIZE_BUCKETS)
+COMPRESSION_BYTES = Counter("proxy_compression_bytes_total", "Bytes before and after (de)compression", ["direction", "encoding", "form"])
+COMPRESSION_SECONDS = Counter("proxy_compression_seconds_total", "Time spent (de)compressing bodies", ["direction", "encoding"])
+
+# `usage` is the last field of vLLM responses and the last event of a stream,
+# so only the tail of the body has to be kept to find it.
+TAIL_BYTES = 2048
+PROMPT_TOKENS_RE = re.compile(rb'"prompt_tokens":\s*(\d+)')
+COMPLETION_TOKENS_RE = re.compile(rb'"completion_tokens":\s*(\d+)')
+
+EMF_NAMESPACE = "vLLMProxy"
+EMF_METRICS = [
+    ("BodyParseTime", "Milliseconds"), ("QueueTime", "Milliseconds"), ("UpstreamTTFT", "Milliseconds"),
+    ("Duration", "Milliseconds"), ("PromptTokens", "Count"), ("CompletionTokens", "Count"),
+    ("RequestBytes", "Bytes"), ("ResponseBytes", "Bytes"),
+]
+
+
+@functools.lru_cache(maxsize=None)
+def histograms_for(route: str) -> tuple:
+    """ The labelled children, looking them up on every request costs more than observing. """
+    return tuple(histogram.labels(route) for histogram in (
+        BODY_PARSE, QUEUE_TIME, UPSTREAM_TTFT, DURATION, PROMPT_TOKENS, COMPLETION_TOKENS, REQUEST_BYTES, RESPONSE_BYTES))
+
+
+def record_compression(direction: str, encoding: str, uncompressed: int, compressed: int, seconds: float):
+    """ `direction` is request for decompressed request bodies, response for compressed responses. """
+    COMPRESSION_BYTES.labels(direction, encoding, "uncompressed").inc(uncompressed)
+    COMPRESSION_BYTES.labels(direction, encoding, "compressed").inc(compressed)
+    COMPRESSION_SECONDS.labels(direction, encoding).inc(seconds)
+
+
+@dataclass
+class RequestTiming:
+    """ Timestamps of one /invocations request, filled in by the handler and the middleware. """
+    start: float
+    route: str = "unknown"
+    body_parse: float | None = None
+    queue: float | None = None
+    upstream_start: float | None = None
+    first_byte: float | None = None
+    request_bytes: int = 0
+    response_bytes: int = 0
+    prompt_tokens: int | None = None
+    completion_tokens: int | None = None
+    # set by the handler when it compresses the response, along with the tokens: the
+    # middleware only sees the compressed bytes then
+    uncompressed_bytes: int | None = None
+
+    def observe(self, end: float, emf: bool = False):
+        upstream_ttft = None
+        if self.upstream_start is not None and self.first_byte is not None:
+            upstream_ttft = self.first_byte - self.upstream_start
+        duration = end - self.start
+
+        values = (self.body_parse, self.queue, upstream_ttft, duration, self.prompt_tokens,
+                  self.completion_tokens, self.request_bytes, self.response_bytes)
+        for histogram, value in zip(histograms_for(self.route), values):
+            if value is not None:
+                histogram.observe(value)
+
+        if emf:
+            print_emf(self.route, dict(zip([name for name, _ in EMF_METRICS], values)))
+
+
+def print_emf(route: str, values: dict[str, float | int | None]):
+    """ Write the metrics to stdout in CloudWatch Embedded Metric Format. """
+    units = dict(EMF_METRICS)
+    metrics = {}
+    for name, value in values.items():
+        if value is None:
+            continue
+        metrics[name] = value * 1000 if units[name] == "Milliseconds" else value
+    record = {
+        "_aws": {
+            "Timestamp": int(time.time() * 1000),
+            "CloudWatchMetrics": [{
+                "Namespace": EMF_NAMESPACE,
+                "Dimensions": [["Route"]],
+                "Metrics": [{"Name": name, "Unit": units[name]} for name in metrics],
+            }],
+        },
+        "Route": route,
+        **metrics,
+    }
+    sys.stdout.write(json.dumps(record) + "\n")
+
+
+def parse_usage(tail: bytes) -> tuple[int | None, int | None]:
+    prompt = PROMPT_TOKENS_RE.findall(tail)
+    completion = COMPLETION_TOKENS_RE.findall(tail)
+    return (int(prompt[-1]) if prompt else None), (int(completion[-1]) if completion else None)
+
+
+class RequestMetricsMiddleware:
+    """
+    ASGI middleware timing the /invocations requests. It puts a
+    `RequestTiming` into `request.state.timing` for the handler to fill in
+    and watches the response messages for the first byte, the size, the
+    `usage` field and the end of the response.
+    """
+
+    def __init__(self, app, path: str = "/invocations", emf: bool = False):
+        self.app = app
+        self.path = path
+        self.emf = emf
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"] != self.path:
+            return await self.app(scope, receive, send)
+
+        timing = RequestTiming(start=time.perf_counter())
+        scope.setdefault("state", {})["timing"] = timing
+        tail = bytearray()
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.body":
+                body = message.get("body", b"")
+                if body:
+                    if timing.first_byte is None:
+                        timing.first_byte = time.perf_counter()
+                    timing.response_bytes += len(body)
+                    tail.extend(body[-TAIL_BYTES:])
+                    if len(tail) > TAIL_BYTES:
+                        del tail[:-TAIL_BYTES]
+                if not message.get("more_body", False):
+                    if timing.uncompressed_bytes is None:
+                        timing.prompt_tokens, timing.completion_tokens = parse_usage(bytes(tail))
+                    else:
+                        timing.response_bytes = timing.uncompressed_bytes
+                    timing.observe(time.perf_counter(), emf=self.emf)
+            await send(message)
+
+        await self.app(scope, receive, send_wrapper)
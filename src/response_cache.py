@@ -0,0 +1,225 @@
+import asyncio
+import hashlib
+import time
+from collections import OrderedDict
+from typing import Any, AsyncIterator, Awaitable, Callable
+
+from fastapi.responses import Response, StreamingResponse
+from prometheus_client import Counter, Gauge
+
+from json_codec import dumps, loads
+from sse_decoder import SSEDecoder
+from streaming import call_on_close
+
+CACHE_REQUESTS = Counter(
+    "proxy_cache_requests_total", "Cacheable requests by result: hit, miss or coalesced with an in-flight request",
+    ["result"])
+CACHE_BYTES = Gauge("proxy_cache_bytes", "Size of the cached responses")
+
+# Parameters which change how the response is delivered, not its content.
+DELIVERY_PARAMS = ("stream", "stream_options")
+
+
+def sse_event(data: dict[str, Any]) -> bytes:
+    return b"data: " + dumps(data) + b"\n\n"
+
+
+def assemble_completion(events: list[dict[str, Any]]) -> dict[str, Any] | None:
+    """
+    Build the non-streaming response from the streamed chunks. Returns None
+    for streams which can't be represented as plain text, e.g. tool calls,
+    and for those missing fields of the non-streaming response: logprobs, or
+    the usage of streams requested without `include_usage`.
+    """
+    if not events:
+        return None
+    first = events[0]
+    chat = first.get("object") == "chat.completion.chunk"
+    texts: dict[int, list[str]] = {}
+    finish_reasons: dict[int, str | None] = {}
+    stop_reasons: dict[int, str | int | None] = {}
+    usage = None
+    for event in events:
+        usage = event.get("usage") or usage
+        for choice in event.get("choices", []):
+            index = choice.get("index", 0)
+            if chat:
+                delta = choice.get("delta") or {}
+                if set(delta) - {"role", "content"}:
+                    return None
+                text = delta.get("content")
+            else:
+                text = choice.get("text")
+            if choice.get("logprobs") is not None:
+                return None
+            texts.setdefault(index, []).append(text or "")
+            finish_reasons[index] = choice.get("finish_reason") or finish_reasons.get(index)
+            if choice.get("stop_reason") is not None:
+                stop_reasons[index] = choice["stop_reason"]
+    if usage is None:
+        return None
+
+    choices = []
+    for index, parts in sorted(texts.items()):
+        choice: dict[str, Any] = {"index": index, "finish_reason": finish_reasons.get(index), "logprobs": None,
+                                  "stop_reason": stop_reasons.get(index)}
+        if chat:
+            choice["message"] = {"role": "assistant", "content": "".join(parts)}
+        else:
+            choice["text"] = "".join(parts)
+        choices.append(choice)
+    return {
+        "id": first.get("id"),
+        "object": "chat.completion" if chat else "text_completion",
+        "created": first.get("created"),
+        "model": first.get("model"),
+        "choices": choices,
+        "usage": usage,
+    }
+
+
+def replay_as_sse(response: dict[str, Any], include_usage: bool) -> list[bytes]:
+    """ The events of a streamed response carrying the same content as `response`. """
+    chat = response.get("object") == "chat.completion"
+    base = {key: response.get(key) for key in ("id", "created", "model")}
+    base["object"] = "chat.completion.chunk" if chat else "text_completion"
+    events = []
+    for choice in response.get("choices", []):
+        index = choice.get("index", 0)
+        if chat:
+            message = choice.get("message") or {}
+            content = {"delta": {"role": "assistant", "content": message.get("content") or ""}}
+            finish = {"delta": {}}
+        else:
+            content = {"text": choice.get("text") or ""}
+            finish = {"text": ""}
+        events.append(sse_event({**base, "choices": [{"index": index, **content, "finish_reason": None}]}))
+        events.append(sse_event({**base, "choices": [{"index": index, **finish, "finish_reason": choice.get("finish_reason"),
+                                                      "stop_reason": choice.get("stop_reason")}]}))
+    if include_usage and response.get("usage"):
+        events.append(sse_event({**base, "choices": [], "usage": response["usage"]}))
+    events.append(b"data: [DONE]\n\n")
+    return events
+
+
+class ResponseCache:
+    """
+    LRU cache of the responses to deterministic requests, bounded by the total
+    size of the cached bodies, with a time to live.
+
+    Identical requests arriving while the first one is still being processed
+    wait for its result instead of reaching the engine. Cached responses are
+    replayed as server-sent events for `stream: true` requests.
+    """
+
+    def __init__(self, max_bytes: int, ttl: float):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.size = 0
+        # key -> (expiration time, non-streaming response body)
+        self._entries: OrderedDict[str, tuple[float, bytes]] = OrderedDict()
+        self._inflight: dict[str, asyncio.Future] = {}
+
+    @staticmethod
+    def key_for(route: str, payload: dict[str, Any]) -> str | None:
+        """ The cache key of the request, None if its response may vary between calls. """
+        if route != "/v1/embeddings":
+            if payload.get("temperature") != 0 or payload.get("n", 1) != 1:
+                return None
+        params = {key: value for key, value in payload.items() if key not in DELIVERY_PARAMS}
+        return hashlib.sha256(dumps([route, params], sort_keys=True)).hexdigest()
+
+    def get(self, key: str) -> bytes | None:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires, body = entry
+        if expires < time.monotonic():
+            self._remove(key)
+            return None
+        self._entries.move_to_end(key)
+        return body
+
+    def put(self, key: str, body: bytes):
+        if len(body) > self.max_bytes:
+            return
+        if key in self._entries:
+            self._remove(key)
+        self._entries[key] = (time.monotonic() + self.ttl, body)
+        self.size += len(body)
+        while self.size > self.max_bytes:
+            self._remove(next(iter(self._entries)))
+        CACHE_BYTES.set(self.size)
+
+    def _remove(self, key: str):
+        _, body = self._entries.pop(key)
+        self.size -= len(body)
+        CACHE_BYTES.set(self.size)
+
+    async def handle(self, key: str, payload: dict[str, Any],
+                     call_upstream: Callable[[], Awaitable[Response]]) -> Response:
+        body = self.get(key)
+        if body is not None:
+            CACHE_REQUESTS.labels("hit").inc()
+            return self._replay(body, payload)
+
+        inflight = self._inflight.get(key)
+        if inflight is not None:
+            CACHE_REQUESTS.labels("coalesced").inc()
+            body = await asyncio.shield(inflight)
+            if body is not None:
+                return self._replay(body, payload)
+            # the first request failed or its response can't be cached
+            return await call_upstream()
+
+        CACHE_REQUESTS.labels("miss").inc()
+        self._inflight[key] = asyncio.get_running_loop().create_future()
+        try:
+            response = await call_upstream()
+        except BaseException:
+            self._finish(key, None)
+            raise
+        if response.status_code != 200:
+            self._finish(key, None)
+        elif isinstance(response, StreamingResponse):
+            response.body_iterator = self._tee(key, response.body_iterator)
+            # a no-op once the stream completed, else it lets the coalesced requests go upstream
+            response = call_on_close(response, lambda: self._finish(key, None))
+        else:
+            self._finish(key, bytes(response.body))
+        return response
+
+    def _finish(self, key: str, body: bytes | None):
+        if body is not None:
+            self.put(key, body)
+        future = self._inflight.pop(key, None)
+        if future is not None and not future.done():
+            future.set_result(body)
+
+    async def _tee(self, key: str, chunks: AsyncIterator[bytes]) -> AsyncIterator[bytes]:
+        """ Pass the streamed chunks through and cache the response once the stream completed. """
+        decoder: SSEDecoder | None = SSEDecoder()
+        events: list[dict[str, Any]] = []
+        body = None
+        try:
+            async for chunk in chunks:
+                if decoder is not None:
+                    try:
+                        events.extend(decoder.feed(chunk))
+                    except ValueError:
+                        # not a regular completion stream, just pass it through
+                        decoder = None
+                yield chunk
+            if decoder is not None and decoder.done:
+                response = assemble_completion(events)
+                body = dumps(response) if response is not None else None
+        finally:
+            self._finish(key, body)
+
+    @staticmethod
+    def _replay(body: bytes, payload: dict[str, Any]) -> Response:
+        if not payload.get("stream"):
+            return Response(content=body, media_type="application/json")
+        include_usage = bool((payload.get("stream_options") or {}).get("include_usage"))
+        events = replay_as_sse(loads(body), include_usage)
+        return StreamingResponse(iter(events), media_type="text/event-stream")
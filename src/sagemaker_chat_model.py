@@ -0,0 +1,229 @@
+import asyncio
+from typing import Any, AsyncIterator, Iterable, Iterator
+
+from botocore.response import StreamingBody  # type: ignore
+from langchain_aws.llms.sagemaker_endpoint import LLMContentHandler
+from langchain_core.callbacks import AsyncCallbackManagerForLLMRun, CallbackManagerForLLMRun
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk, BaseMessage
+from langchain_core.messages.utils import convert_to_openai_messages
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+from pydantic import Field, PrivateAttr
+
+from json_codec import dumps
+from sigv4_client import AsyncSageMakerRuntimeClient, SageMakerRuntimeClient
+from sse_decoder import SSEDecoder, decode_events
+
+
+async def close_on_cancel(client: AsyncSageMakerRuntimeClient):
+    """ Wait until cancelled, then close `client` in the event loop its connections belong to. """
+    try:
+        await asyncio.Future()
+    finally:
+        await client.aclose()
+
+
+class OpenAIMessagesHandler(LLMContentHandler):
+    content_type: str = "application/json"
+    accepts: str = "application/json"
+
+    def transform_input(
+        self, prompt: str | BaseMessage | list[BaseMessage],
+        model_kwargs: dict) -> bytes:
+        # Construct the payload as expected by the OpenAI-compatible API
+        messages = convert_to_openai_messages(prompt)
+        if not isinstance(messages, list):
+            messages = [messages]
+        input_data = {
+            "messages": messages,
+            **model_kwargs
+        }
+        # straight to bytes, the messages may carry multi-MB base64 images
+        return dumps(input_data)
+
+    def transform_output(self, output: bytes) -> str:
+        # Parse the JSON response from the SageMaker endpoint. In streaming mode
+        # `output` is a single SSE line, otherwise the whole response body.
+        if isinstance(output, StreamingBody):
+            output = output.read()
+        elif not isinstance(output, bytes):
+            raise ValueError("Unexpected output type")
+
+        return "".join(self.content_of(response_json) for response_json in decode_events(output))
+
+    @staticmethod
+    def content_of(response_json: dict) -> str:
+        """ Text of the first choice of a response or of a streamed chunk. """
+        # the final chunk with `usage` has no choices
+        if not response_json.get('choices'):
+            return ""
+        choice = response_json['choices'][0]
+        if 'message' in choice:
+            return choice['message']['content'] or ""
+        return choice['delta'].get('content') or ""
+
+
+def usage_metadata_of(response_json: dict) -> dict[str, int] | None:
+    usage = response_json.get("usage")
+    if not usage:
+        return None
+    return {
+        "input_tokens": usage.get("prompt_tokens", 0),
+        "output_tokens": usage.get("completion_tokens", 0),
+        "total_tokens": usage.get("total_tokens", 0),
+    }
+
+
+class SagemakerChatModel(BaseChatModel):
+    """
+    LangChain chat model for a vLLM SageMaker endpoint with native async support.
+
+    Unlike `SagemakerEndpoint`, `ainvoke`, `astream` and `abatch` don't block
+    the event loop, so parallel calls actually run concurrently. The number of
+    in-flight requests of one model instance is bounded by `max_concurrency`.
+
+    Example:
+        chat = SagemakerChatModel(endpoint_name="vllm-on-sagemaker", model_kwargs={"model": "Qwen/Qwen2.5-VL-3B-Instruct"})
+        answers = await chat.abatch([[HumanMessage(content=q)] for q in questions])
+    """
+
+    endpoint_name: str
+    region_name: str | None = None
+    profile_name: str | None = 'default'
+    # e.g. a local stand-in for the SageMaker runtime
+    endpoint_url: str | None = None
+    model_kwargs: dict[str, Any] = Field(default_factory=dict)
+    # use the streaming API for `invoke`, so that callbacks receive the tokens
+    streaming: bool = False
+    max_concurrency: int = 16
+    # "gzip" or "zstd": send compressed request bodies, e.g. for images, and receive compressed responses
+    compression: str | None = None
+    content_handler: OpenAIMessagesHandler = Field(default_factory=OpenAIMessagesHandler)
+
+    _client: SageMakerRuntimeClient | None = PrivateAttr(default=None)
+    _aclient: AsyncSageMakerRuntimeClient | None = PrivateAttr(default=None)
+    _semaphore: asyncio.Semaphore | None = PrivateAttr(default=None)
+    # the event loop the async client and the semaphore belong to
+    _loop: asyncio.AbstractEventLoop | None = PrivateAttr(default=None)
+    # closes the async client when cancelled, see `_bind_loop`
+    _closer: asyncio.Task | None = PrivateAttr(default=None)
+
+    @property
+    def _llm_type(self) -> str:
+        return "sagemaker-openai-chat"
+
+    @property
+    def _identifying_params(self) -> dict[str, Any]:
+        return {"endpoint_name": self.endpoint_name, "model_kwargs": self.model_kwargs}
+
+    @property
+    def client(self) -> SageMakerRuntimeClient:
+        if self._client is None:
+            self._client = SageMakerRuntimeClient(
+                region=self.region_name, profile_name=self.profile_name,
+                endpoint_url=self.endpoint_url, pool_size=self.max_concurrency, compression=self.compression)
+        return self._client
+
+    def _bind_loop(self):
+        """
+        The async client and the semaphore only work in the event loop they were
+        first used in, every new loop (e.g. another `asyncio.run`) gets its own.
+        The connections of a client can only be closed in its loop too: a task
+        waits for the loop to shut down, `asyncio.run` cancels the tasks left at
+        its end, and closes the client then.
+        """
+        loop = asyncio.get_running_loop()
+        if self._loop is loop:
+            return
+        if self._closer is not None and not self._closer.done() and not self._loop.is_closed():
+            # the previous loop is still running, e.g. in another thread
+            self._loop.call_soon_threadsafe(self._closer.cancel)
+        self._loop = loop
+        self._aclient = AsyncSageMakerRuntimeClient(
+            region=self.region_name, profile_name=self.profile_name,
+            endpoint_url=self.endpoint_url, pool_size=self.max_concurrency, compression=self.compression)
+        self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        self._closer = loop.create_task(close_on_cancel(self._aclient))
+
+    @property
+    def aclient(self) -> AsyncSageMakerRuntimeClient:
+        self._bind_loop()
+        return self._aclient
+
+    @property
+    def semaphore(self) -> asyncio.Semaphore:
+        self._bind_loop()
+        return self._semaphore
+
+    def _body(self, messages: list[BaseMessage], stop: list[str] | None, stream: bool, **kwargs: Any) -> bytes:
+        model_kwargs = {**self.model_kwargs, **kwargs}
+        if stop:
+            model_kwargs["stop"] = stop
+        if stream:
+            model_kwargs["stream"] = True
+            model_kwargs.setdefault("stream_options", {"include_usage": True})
+        return self.content_handler.transform_input(messages, model_kwargs)
+
+    def _chat_result(self, body: bytes) -> ChatResult:
+        text = ""
+        usage = None
+        for response_json in decode_events(body):
+            text += self.content_handler.content_of(response_json)
+            usage = usage_metadata_of(response_json) or usage
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=text, usage_metadata=usage))])
+
+    def _chunks(self, events: Iterable[dict]) -> Iterator[ChatGenerationChunk]:
+        for response_json in events:
+            text = self.content_handler.content_of(response_json)
+            usage = usage_metadata_of(response_json)
+            if text or usage:
+                yield ChatGenerationChunk(message=AIMessageChunk(content=text, usage_metadata=usage))
+
+    def _generate(self, messages: list[BaseMessage], stop: list[str] | None = None,
+                  run_manager: CallbackManagerForLLMRun | None = None, **kwargs: Any) -> ChatResult:
+        response = self.client.invoke(self.endpoint_name, self._body(messages, stop, stream=False, **kwargs))
+        return self._chat_result(response.content)
+
+    def _stream(self, messages: list[BaseMessage], stop: list[str] | None = None,
+                run_manager: CallbackManagerForLLMRun | None = None, **kwargs: Any) -> Iterator[ChatGenerationChunk]:
+        decoder = SSEDecoder()
+        body = self._body(messages, stop, stream=True, **kwargs)
+        for payload_part in self.client.invoke_stream(self.endpoint_name, body):
+            for chunk in self._chunks(decoder.feed(payload_part)):
+                if run_manager:
+                    run_manager.on_llm_new_token(chunk.text, chunk=chunk)
+                yield chunk
+        # the last event may lack the blank line ending it
+        for chunk in self._chunks(decoder.flush()):
+            if run_manager:
+                run_manager.on_llm_new_token(chunk.text, chunk=chunk)
+            yield chunk
+
+    async def _agenerate(self, messages: list[BaseMessage], stop: list[str] | None = None,
+                         run_manager: AsyncCallbackManagerForLLMRun | None = None, **kwargs: Any) -> ChatResult:
+        body = self._body(messages, stop, stream=False, **kwargs)
+        async with self.semaphore:
+            response = await self.aclient.invoke(self.endpoint_name, body)
+        return self._chat_result(response.content)
+
+    async def _astream(self, messages: list[BaseMessage], stop: list[str] | None = None,
+                       run_manager: AsyncCallbackManagerForLLMRun | None = None,
+                       **kwargs: Any) -> AsyncIterator[ChatGenerationChunk]:
+        decoder = SSEDecoder()
+        body = self._body(messages, stop, stream=True, **kwargs)
+        async with self.semaphore:
+            async for payload_part in self.aclient.invoke_stream(self.endpoint_name, body):
+                for chunk in self._chunks(decoder.feed(payload_part)):
+                    if run_manager:
+                        await run_manager.on_llm_new_token(chunk.text, chunk=chunk)
+                    yield chunk
+            for chunk in self._chunks(decoder.flush()):
+                if run_manager:
+                    await run_manager.on_llm_new_token(chunk.text, chunk=chunk)
+                yield chunk
+
+    async def abatch(self, inputs, config=None, *, return_exceptions: bool = False, **kwargs: Any):
+        # the default of LangChain is unbounded, the semaphore keeps the rest waiting anyway
+        if config is None:
+            config = {"max_concurrency": self.max_concurrency}
+        return await super().abatch(inputs, config, return_exceptions=return_exceptions, **kwargs)
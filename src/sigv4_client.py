@@ -0,0 +1,231 @@
+import functools
+from typing import Any, AsyncIterator, Iterator
+
+import boto3  # type: ignore
+import httpx
+import requests
+from botocore.auth import SigV4Auth  # type: ignore
+from botocore.awsrequest import AWSRequest  # type: ignore
+from botocore.eventstream import EventStreamBuffer  # type: ignore
+
+from compression import (CUSTOM_ATTRIBUTES_HEADER, ENCODINGS, add_custom_attributes, compress, decompress,
+                         get_custom_attribute)
+from invocation_policy import AsyncHedgedInvoker, HedgedInvoker, InvocationPolicy
+from json_codec import dumps
+
+SERVICE_NAME = "sagemaker"
+# routes the request to an inference component, for endpoints created with --scale-to-zero
+INFERENCE_COMPONENT_HEADER = "X-Amzn-SageMaker-Inference-Component"
+# smaller bodies aren't worth the CPU
+COMPRESSION_MIN_BYTES = 1024
+
+
+@functools.lru_cache(maxsize=None)
+def get_session(profile_name: str | None = 'default') -> boto3.Session:
+    """
+    Sessions are expensive to build (config files, credential chain), so one
+    session per profile is shared by the whole process.
+    """
+    return boto3.Session(profile_name=profile_name)
+
+
+def runtime_url(region: str) -> str:
+    domain = "amazonaws.com.cn" if region.startswith("cn-") else "amazonaws.com"
+    return f"https://runtime.sagemaker.{region}.{domain}"
+
+
+class SigV4Signer:
+    """
+    Signs requests with the credentials of a boto3 session. The credentials
+    are resolved once and reused; botocore refreshes temporary credentials
+    (instance roles, SSO, assumed roles) by itself when they are about to expire.
+    """
+
+    def __init__(self, session: boto3.Session, region: str, service: str = SERVICE_NAME):
+        self.region = region
+        self.service = service
+        self._credentials = session.get_credentials()
+        if self._credentials is None:
+            raise ValueError("No AWS credentials found")
+
+    def sign(self, method: str, url: str, body: bytes, headers: dict[str, str]) -> dict[str, str]:
+        """ Return `headers` extended with the SigV4 authentication headers. """
+        credentials = self._credentials.get_frozen_credentials()
+        request = AWSRequest(method=method, url=url, data=body, headers=headers)
+        SigV4Auth(credentials, self.service, self.region).add_auth(request)
+        return dict(request.headers.items())
+
+
+def iter_payload_parts(chunks: Iterator[bytes]) -> Iterator[bytes]:
+    """ Unwrap the bytes of `PayloadPart` events from an `application/vnd.amazon.eventstream` body. """
+    buffer = EventStreamBuffer()
+    for chunk in chunks:
+        buffer.add_data(chunk)
+        for message in buffer:
+            yield from _payload_of(message)
+
+
+async def aiter_payload_parts(chunks: AsyncIterator[bytes]) -> AsyncIterator[bytes]:
+    buffer = EventStreamBuffer()
+    async for chunk in chunks:
+        buffer.add_data(chunk)
+        for message in buffer:
+            for payload in _payload_of(message):
+                yield payload
+
+
+def _payload_of(message) -> Iterator[bytes]:
+    headers = message.headers
+    if headers.get(":message-type") == "exception":
+        raise RuntimeError(f"{headers.get(':exception-type')}: {message.payload.decode('utf-8', 'replace')}")
+    if headers.get(":event-type") == "PayloadPart" and message.payload:
+        yield message.payload
+
+
+class _BaseClient:
+    """
+    With `compression` ("gzip" or "zstd"), request bodies are sent compressed and
+    the complete responses are received compressed, see `src/compression.py`.
+    With a `policy`, `invoke` hedges slow requests and retries throttled ones,
+    see `src/invocation_policy.py`; streams are sent once, as they are.
+    """
+
+    def __init__(self, region: str | None = None, profile_name: str | None = 'default',
+                 endpoint_url: str | None = None, session: boto3.Session | None = None,
+                 compression: str | None = None):
+        if compression is not None and compression not in ENCODINGS:
+            raise ValueError(f"Unsupported compression {compression}, expected one of {', '.join(ENCODINGS)}")
+        self.compression = compression
+        session = session or get_session(profile_name)
+        self.region = region or session.region_name
+        if self.region is None:
+            raise ValueError("AWS region must be provided")
+        self.endpoint_url = (endpoint_url or runtime_url(self.region)).rstrip('/')
+        self.signer = SigV4Signer(session, self.region)
+
+    def _prepare(self, endpoint_name: str, payload: dict[str, Any] | bytes,
+                 stream: bool, headers: dict[str, str] | None = None) -> tuple[str, bytes, dict[str, str]]:
+        path = "invocations-response-stream" if stream else "invocations"
+        url = f"{self.endpoint_url}/endpoints/{endpoint_name}/{path}"
+        body = payload if isinstance(payload, bytes) else dumps(payload)
+        headers = {"Content-Type": "application/json", "Accept": "application/json", **(headers or {})}
+        if self.compression is not None:
+            attributes = {"accept_encoding": self.compression} if not stream else {}
+            if len(body) >= COMPRESSION_MIN_BYTES:
+                body = compress(body, self.compression)
+                attributes["content_encoding"] = self.compression
+            if attributes:
+                headers = add_custom_attributes(headers, **attributes)
+        return url, body, self.signer.sign("POST", url, body, headers)
+
+    @staticmethod
+    def _decoded(content: bytes, headers) -> bytes | None:
+        """ The decompressed response body, None if it isn't compressed. """
+        encoding = get_custom_attribute(headers.get(CUSTOM_ATTRIBUTES_HEADER), "content_encoding")
+        return decompress(content, encoding) if encoding else None
+
+
+class SageMakerRuntimeClient(_BaseClient):
+    """
+    Thread-safe client for `/invocations` that keeps a pool of keep-alive
+    connections to the SageMaker runtime, so repeated calls don't pay for the
+    session setup and the TLS handshake.
+    """
+
+    def __init__(self, region: str | None = None, profile_name: str | None = 'default',
+                 endpoint_url: str | None = None, session: boto3.Session | None = None,
+                 pool_size: int = 32, timeout: float = 600, compression: str | None = None,
+                 policy: InvocationPolicy | None = None):
+        super().__init__(region, profile_name, endpoint_url, session, compression)
+        self.timeout = timeout
+        # the hedges run in threads, which share the connection pool
+        self.invoker = HedgedInvoker(policy, max_workers=pool_size) if policy else None
+        self.http = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.http.mount("http://", adapter)
+        self.http.mount("https://", adapter)
+
+    def invoke(self, endpoint_name: str, payload: dict[str, Any] | bytes,
+               headers: dict[str, str] | None = None) -> requests.Response:
+        url, body, headers = self._prepare(endpoint_name, payload, stream=False, headers=headers)
+        if self.invoker is not None:
+            return self.invoker.invoke(lambda: self._post(url, body, headers))
+        return self._post(url, body, headers)
+
+    def _post(self, url: str, body: bytes, headers: dict[str, str]) -> requests.Response:
+        response = self.http.post(url, data=body, headers=headers, timeout=self.timeout)
+        response.raise_for_status()
+        decoded = self._decoded(response.content, response.headers)
+        if decoded is not None:
+            # what requests does itself for the encodings it decodes, `.json()` and `.text` read it
+            response._content = decoded
+        return response
+
+    def invoke_stream(self, endpoint_name: str, payload: dict[str, Any] | bytes,
+                      headers: dict[str, str] | None = None) -> Iterator[bytes]:
+        """ Yield the model output (SSE bytes) as the PayloadParts arrive. """
+        url, body, headers = self._prepare(endpoint_name, payload, stream=True, headers=headers)
+        with self.http.post(url, data=body, headers=headers, timeout=self.timeout, stream=True) as response:
+            response.raise_for_status()
+            yield from iter_payload_parts(response.iter_content(chunk_size=None))
+
+    def close(self):
+        if self.invoker is not None:
+            self.invoker.close()
+        self.http.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class AsyncSageMakerRuntimeClient(_BaseClient):
+    """ asyncio variant of `SageMakerRuntimeClient`, backed by a pooled `httpx.AsyncClient`. """
+
+    def __init__(self, region: str | None = None, profile_name: str | None = 'default',
+                 endpoint_url: str | None = None, session: boto3.Session | None = None,
+                 pool_size: int = 100, timeout: float = 600, compression: str | None = None,
+                 policy: InvocationPolicy | None = None):
+        super().__init__(region, profile_name, endpoint_url, session, compression)
+        self.invoker = AsyncHedgedInvoker(policy) if policy else None
+        self.http = httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size),
+            timeout=timeout,
+        )
+
+    async def invoke(self, endpoint_name: str, payload: dict[str, Any] | bytes,
+                     headers: dict[str, str] | None = None) -> httpx.Response:
+        url, body, headers = self._prepare(endpoint_name, payload, stream=False, headers=headers)
+        if self.invoker is not None:
+            return await self.invoker.invoke(lambda: self._post(url, body, headers))
+        return await self._post(url, body, headers)
+
+    async def _post(self, url: str, body: bytes, headers: dict[str, str]) -> httpx.Response:
+        response = await self.http.post(url, content=body, headers=headers)
+        response.raise_for_status()
+        decoded = self._decoded(response.content, response.headers)
+        if decoded is not None:
+            response = httpx.Response(response.status_code, headers=response.headers, content=decoded,
+                                      request=response.request)
+        return response
+
+    async def invoke_stream(self, endpoint_name: str, payload: dict[str, Any] | bytes,
+                            headers: dict[str, str] | None = None) -> AsyncIterator[bytes]:
+        url, body, headers = self._prepare(endpoint_name, payload, stream=True, headers=headers)
+        async with self.http.stream("POST", url, content=body, headers=headers) as response:
+            if response.is_error:
+                await response.aread()
+                response.raise_for_status()
+            async for payload_part in aiter_payload_parts(response.aiter_raw()):
+                yield payload_part
+
+    async def aclose(self):
+        await self.http.aclose()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.aclose()
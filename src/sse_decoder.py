@@ -0,0 +1,142 @@
+import json
+import re
+from typing import Any, Iterable, Iterator
+
+from json_codec import loads
+
+# Events are separated by an empty line, the SSE spec allows both LF and CRLF line endings.
+EVENT_BOUNDARY = re.compile(rb"\r?\n\r?\n")
+DONE = b"[DONE]"
+# the field names of the SSE spec, b"" is a comment
+SSE_FIELDS = (b"", b"data", b"event", b"id", b"retry")
+
+
+class SSEDecoder:
+    """
+    Incremental decoder for the responses of the OpenAI-compatible API.
+
+    Chunks can be split at arbitrary positions (e.g. SageMaker PayloadParts) and
+    a single chunk may carry several `data:` events. Bytes are appended to a
+    buffer, and only the not yet scanned tail is searched for event boundaries,
+    so decoding is linear in the size of the stream.
+
+    Non-streaming responses (a plain JSON body without SSE framing) are
+    accumulated and decoded by `flush`. A body which is neither, e.g. the
+    text of an error page, raises ValueError.
+    """
+
+    def __init__(self):
+        self._buffer = bytearray()
+        self._scan_pos = 0
+        self._is_sse: bool | None = None
+        self.done = False
+
+    def feed(self, chunk: bytes) -> list[dict[str, Any]]:
+        """ Add a chunk and return the events completed by it. """
+        self._buffer += chunk
+        if self._is_sse is None:
+            head = self._buffer.lstrip()
+            if not head:
+                return []
+            # a plain JSON body starts with an object or an array
+            self._is_sse = head[:1] not in (b"{", b"[")
+        if not self._is_sse:
+            return []
+
+        events = []
+        start = 0
+        while True:
+            match = EVENT_BOUNDARY.search(self._buffer, self._scan_pos)
+            if match is None:
+                break
+            event = self._parse_event(self._buffer[start:match.start()])
+            start = self._scan_pos = match.end()
+            if event is not None:
+                events.append(event)
+        if start:
+            del self._buffer[:start]
+        # the boundary may be split between chunks, re-scan the last 3 bytes next time
+        self._scan_pos = max(len(self._buffer) - 3, 0)
+        return events
+
+    def flush(self) -> list[dict[str, Any]]:
+        """ Return whatever is left in the buffer once the stream has ended. """
+        data = bytes(self._buffer).strip()
+        self._buffer.clear()
+        self._scan_pos = 0
+        if not data:
+            return []
+        if self._is_sse:
+            event = self._parse_event(data)
+        else:
+            event = self._parse_data(data)
+        return [event] if event is not None else []
+
+    def _parse_event(self, raw: bytes | bytearray) -> dict[str, Any] | None:
+        data_lines = []
+        for line in raw.splitlines():
+            field, _, value = line.partition(b":")
+            # lines starting with ':' are comments, other fields (event:, id:) are not used
+            if field == b"data":
+                data_lines.append(value[1:] if value.startswith(b" ") else value)
+            elif field not in SSE_FIELDS:
+                # neither SSE nor JSON, e.g. the text or HTML of an error page
+                raise ValueError(f"Unexpected response: {bytes(raw[:200])!r}")
+        if not data_lines:
+            return None
+        return self._parse_data(b"\n".join(data_lines))
+
+    def _parse_data(self, data: bytes) -> dict[str, Any] | None:
+        if data.strip() == DONE:
+            self.done = True
+            return None
+        try:
+            return loads(data)
+        except json.JSONDecodeError as e:
+            raise ValueError(f"Unexpected response: {data[:200]!r}") from e
+
+
+class SSEFramer:
+    """
+    Re-frames a stream split at arbitrary positions (e.g. SageMaker PayloadParts)
+    into whole events, without decoding them, for passing it on to clients that
+    expect each chunk to end on an event boundary.
+    """
+
+    def __init__(self):
+        self._buffer = bytearray()
+        self._scan_pos = 0
+
+    def feed(self, chunk: bytes) -> bytes:
+        """ Add a chunk and return the events completed by it, b"" if there are none. """
+        self._buffer += chunk
+        end = 0
+        while True:
+            match = EVENT_BOUNDARY.search(self._buffer, self._scan_pos)
+            if match is None:
+                break
+            end = self._scan_pos = match.end()
+        events = bytes(self._buffer[:end])
+        del self._buffer[:end]
+        self._scan_pos = max(len(self._buffer) - 3, 0)
+        return events
+
+    def flush(self) -> bytes:
+        """ The rest of the stream, terminated as an event if it isn't empty. """
+        rest = bytes(self._buffer).strip()
+        self._buffer.clear()
+        self._scan_pos = 0
+        return rest + b"\n\n" if rest else b""
+
+
+def iter_events(chunks: Iterable[bytes]) -> Iterator[dict[str, Any]]:
+    """ Decode a whole stream of byte chunks into response objects. """
+    decoder = SSEDecoder()
+    for chunk in chunks:
+        yield from decoder.feed(chunk)
+    yield from decoder.flush()
+
+
+def decode_events(data: bytes) -> list[dict[str, Any]]:
+    """ Decode a complete body, an SSE line or a full JSON response. """
+    return list(iter_events([data]))
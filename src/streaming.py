@@ -0,0 +1,35 @@
+import inspect
+from typing import Awaitable, Callable
+
+from fastapi.responses import StreamingResponse
+from starlette.types import Receive, Scope, Send
+
+
+class ClosingStreamingResponse(StreamingResponse):
+    """
+    A StreamingResponse which runs its `on_close` callbacks once it is over:
+    sent, failed, or abandoned by a client which disconnected before the body
+    was iterated at all, when the `finally` of a body generator never runs.
+    """
+    on_close: list[Callable[[], Awaitable[None] | None]]
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            for callback in reversed(self.on_close):
+                result = callback()
+                if inspect.isawaitable(result):
+                    await result
+
+
+def call_on_close(response: StreamingResponse,
+                  callback: Callable[[], Awaitable[None] | None]) -> ClosingStreamingResponse:
+    """ `response` (its body, status and headers) with `callback` run once it is over, see ClosingStreamingResponse. """
+    if not isinstance(response, ClosingStreamingResponse):
+        closing = ClosingStreamingResponse.__new__(ClosingStreamingResponse)
+        closing.__dict__.update(response.__dict__)
+        closing.on_close = []
+        response = closing
+    response.on_close.append(callback)
+    return response
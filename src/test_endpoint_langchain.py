@@ -1,61 +1,18 @@
 # %%
 import argparse
-import json
+import asyncio
 
-import boto3  # type: ignore
-from botocore.response import StreamingBody  # type: ignore
-from langchain_aws.llms.sagemaker_endpoint import LLMContentHandler, SagemakerEndpoint
+from langchain_aws.llms.sagemaker_endpoint import SagemakerEndpoint
 from langchain_core.callbacks.streaming_stdout import StreamingStdOutCallbackHandler
-from langchain_core.messages import BaseMessage, HumanMessage
-from langchain_core.messages.utils import convert_to_openai_messages
+from langchain_core.messages import HumanMessage
 
+from sagemaker_chat_model import OpenAIMessagesHandler, SagemakerChatModel
+from sigv4_client import get_session
 
-# %%
-def get_aws_region(profile_name: str = 'default') -> str:
-    session = boto3.Session(profile_name=profile_name)
-    return session.region_name
 
 # %%
-class OpenAIMessagesHandler(LLMContentHandler):
-    content_type: str = "application/json"
-    accepts: str = "application/json"
-
-    def transform_input(
-        self, prompt: str | BaseMessage | list[BaseMessage],
-        model_kwargs: dict) -> bytes:
-        # Construct the payload as expected by the OpenAI-compatible API
-        messages = convert_to_openai_messages(prompt)
-        if not isinstance(messages, list):
-            messages = [messages]
-        input_data = {
-            "messages": messages,
-            **model_kwargs
-        }
-        return json.dumps(input_data).encode("utf-8")
-
-    def transform_output(self, output: bytes) -> str:
-        # Parse the JSON response from the SageMaker endpoint
-        if isinstance(output, bytes):
-            decoded = output.decode("utf-8").strip("data: ")
-        elif isinstance(output, StreamingBody):
-            decoded = output.read().decode("utf-8")
-        else:
-            raise ValueError("Unexpected output type")
-        try:
-            response_json = json.loads(decoded)
-        except json.JSONDecodeError as e:
-            if (not decoded) or (decoded == "[DONE]"):
-                return ""
-            else:
-                raise ValueError(f"Unexpected response: {decoded}") from e
-
-        choice = response_json['choices'][0]
-        if 'message' in choice:
-            return choice['message']['content']
-        else:
-            if 'content' in choice['delta']:
-                return choice['delta']['content']
-        return decoded
+def get_aws_region(profile_name: str = 'default') -> str:
+    return get_session(profile_name).region_name
 
 
 if __name__ == "__main__":
@@ -98,3 +55,17 @@ if __name__ == "__main__":
     )
     response = endpoint.invoke(prompt)
     print(response)
+
+    print("\n\n=========== Testing async batch API ===========")
+    chat = SagemakerChatModel(
+        endpoint_name=args.endpoint,
+        region_name=args.region,
+        model_kwargs={
+            "model": args.model,
+            "temperature": 0.7,
+            "max_tokens": 150},
+        max_concurrency=8,
+    )
+    prompts = [[HumanMessage(content=f"Give me a fun fact about the number {i}.")] for i in range(8)]
+    for message in asyncio.run(chat.abatch(prompts)):
+        print(message.content)
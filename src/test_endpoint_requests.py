@@ -1,17 +1,18 @@
 import argparse
 
-import boto3  # type: ignore
-import requests
 from requests_aws4auth import AWS4Auth
 
+from invocation_policy import InvocationPolicy
+from sigv4_client import SageMakerRuntimeClient, get_session
+from sse_decoder import iter_events
+
 
 def get_aws_region(profile_name: str = 'default') -> str:
-    session = boto3.Session(profile_name=profile_name)
-    return session.region_name
+    return get_session(profile_name).region_name
 
 def get_aws_auth(profile_name: str = 'default'):
-    session = boto3.Session(profile_name=profile_name)
-    credentials = session.get_credentials()
+    session = get_session(profile_name)
+    credentials = session.get_credentials().get_frozen_credentials()
     aws_auth = AWS4Auth(
         credentials.access_key,
         credentials.secret_key,
@@ -26,14 +27,14 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("--endpoint", type=str, required=True)
     parser.add_argument("--model", type=str, required=True)
+    parser.add_argument("--hedge", action="store_true",
+                        help="Hedge slow requests and retry throttled ones, see src/invocation_policy.py")
     args = parser.parse_args()
 
+    # The client keeps the credentials and a pool of keep-alive connections,
+    # create it once and reuse it for all requests.
+    client = SageMakerRuntimeClient(region=get_aws_region(), policy=InvocationPolicy() if args.hedge else None)
 
-    region = get_aws_region()
-    aws_auth = get_aws_auth()
-
-    endpoint = f"https://runtime.sagemaker.{region}.amazonaws.com/endpoints/{args.endpoint}/invocations"
-    headers = {"Content-Type": "application/json"}
     payload = {
         "model": args.model,
         "messages": [
@@ -50,5 +51,13 @@ if __name__ == "__main__":
     }
 
     print("\n\n=========== Testing non-streaming API ===========")
-    response = requests.post(endpoint, auth=aws_auth, json=payload, headers=headers)
+    response = client.invoke(args.endpoint, payload)
     print(response.json())
+    if client.invoker is not None:
+        print(client.invoker.summary())
+
+    print("\n\n=========== Testing streaming API ===========")
+    for data in iter_events(client.invoke_stream(args.endpoint, {**payload, "stream": True})):
+        for choice in data.get("choices", []):
+            print(choice["delta"].get("content") or "", end="", flush=True)
+    print("")
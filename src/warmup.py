@@ -0,0 +1,66 @@
+import asyncio
+import json
+import sys
+import time
+from typing import Callable
+
+import httpx
+
+
+def parse_warmup_prompts(value: str | None, model: str | None, select_route: Callable[[dict], str] | None = None,
+                         max_tokens: int = 8) -> list[dict]:
+    """
+    Read the warmup requests from a JSON list. Strings are sent as a chat
+    message, objects are sent as they are, like the body of /invocations.
+    With `select_route`, objects it has no route for raise ValueError here
+    rather than once the warmup runs.
+    """
+    if not value:
+        return []
+    payloads = []
+    for item in json.loads(value):
+        if isinstance(item, str):
+            item = {"messages": [{"role": "user", "content": item}], "max_tokens": max_tokens, "temperature": 0}
+        elif not isinstance(item, dict):
+            raise ValueError(f"Warmup prompts must be strings or objects, got {item!r}")
+        if select_route is not None:
+            select_route(item)
+        if model and "model" not in item:
+            item = {**item, "model": model}
+        payloads.append(item)
+    return payloads
+
+
+async def wait_until_healthy(upstream: httpx.AsyncClient, timeout: float, interval: float = 1.0):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            response = await upstream.get("/health", timeout=5)
+            if response.is_success:
+                return
+        except httpx.HTTPError:
+            pass
+        if time.monotonic() >= deadline:
+            raise TimeoutError(f"vLLM not healthy after {timeout:.0f} s")
+        await asyncio.sleep(interval)
+
+
+async def warm_up(upstream: httpx.AsyncClient, payloads: list[dict], select_route: Callable[[dict], str],
+                  timeout: float) -> float:
+    """
+    Wait for vLLM to load the model, then send the warmup requests at the same
+    time, so that the first real requests don't pay for the CUDA graph capture,
+    the kernel autotuning and the allocation of the KV cache blocks.
+    Returns the seconds spent on the warmup requests.
+    """
+    await wait_until_healthy(upstream, timeout)
+    started = time.perf_counter()
+
+    async def send(payload: dict):
+        response = await upstream.post(select_route(payload), json=payload, timeout=timeout)
+        if not response.is_success:
+            # a failing warmup request doesn't make the server unusable, report it and go on
+            print(f"Warmup request failed with {response.status_code}: {response.text[:200]}", file=sys.stderr)
+
+    await asyncio.gather(*(send(payload) for payload in payloads))
+    return time.perf_counter() - started